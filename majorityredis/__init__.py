@@ -9,3 +9,6 @@ retry_condition
 
 from .api import MajorityRedis
 MajorityRedis
+
+from .codec import Codec
+Codec
@@ -1,13 +1,18 @@
 from functools import partial
 import random
+import redis
 import sys
 import threading
+import weakref
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from . import exceptions
 from . import log
+from . import util
+from .clockdrift import ClockDrift
 from .lockingqueue import LockingQueue
-from .lock import Lock
+from .streamqueue import StreamQueue
+from .lock import Lock, RWLock, Waiters
 from .getset import GetSet
 
 
@@ -23,10 +28,33 @@ def _map_async(func, *iterables):
     return (f.result() for f in as_completed(futures))
 
 
+def _warmup(client, n_connections):
+    """Open `n_connections` to the redis server and return them to the pool"""
+    pool = client.connection_pool
+    conns = []
+    try:
+        for _ in range(n_connections):
+            conn = pool.get_connection('PING')
+            conns.append(conn)
+            conn.connect()
+    except redis.RedisError as err:
+        log.warn("Could not open connection to redis server", extra=dict(
+            error=err, error_type=type(err).__name__, redis_client=client))
+    finally:
+        for conn in conns:
+            pool.release(conn)
+    return client
+
+
 class MajorityRedis(object):
     def __init__(self, clients, n_servers, lock_timeout=30, polling_interval=25,
                  run_async=_run_async, map_async=_map_async,
-                 getset_history_prefix='', threadsafe=False):
+                 getset_history_prefix='', threadsafe=False,
+                 clock_drift_interval=None, relative_ttl=False,
+                 read_repair_async=True, read_repair_probability=1.,
+                 read_repair_max_per_second=1000, coalesce_window=None,
+                 read_quorum=None, write_quorum=None, codec=None,
+                 getset_tombstone_ttl=86400):
         """Initializes MajorityRedis connection to multiple independent
         non-replicated Redis Instances.  This MajorityRedis client contains
         algorithms and operations based on majority vote of the redis servers.
@@ -54,19 +82,64 @@ class MajorityRedis(object):
             By default, uses Python's threading module.
         `map_async` - a function of form map(func, iterable) that maps func on
             iterable sequence.  By default, uses Python's threading module.
-        `getset_history_prefix` - a prefix for a key that majorityredis uses to
-            store the history of reads and writes to redis keys.
+            It must start its work when called, not when its results are
+            iterated, or requests given a `timeout` are abandoned.
+        `getset_history_prefix` - a prefix for the keys that majorityredis
+            uses to store the time of the most recent write to each redis key.
         `threadsafe` (bool) This applies to instances of Lock and LockingQueue.
           By default, instances of a class share ownership of the
           values they can modify.  For instance, if lock1 locks a key,
           lock2 can unlock that same key.  If `threadsafe` is true, however,
           ownership is isolated to the instance, and lock2 cannot unlock
           lock1's locked keys.
+        `clock_drift_interval` - if given, sample the clock of each redis
+            server every `clock_drift_interval` seconds in the background.
+            Locks are considered invalid early by the estimated clock drift.
+            By default, assume there is no clock drift.
+        `relative_ttl` (bool) - if True, locks expire after a relative number
+            of milliseconds (PEXPIRE) rather than at an absolute time
+            in whole seconds (EXPIREAT).  Lock validity is then measured on
+            the local monotonic clock, so lock_timeout may be less than
+            a second and servers' clocks need not be synchronized.
+        `read_repair_async` (bool) - if True, get(...) returns without
+            waiting for stale servers to be healed.  Repairs are coalesced
+            and sent to stale servers in batches by a background thread.
+        `read_repair_probability` (float) - the chance, from 0 to 1, that
+            a get(...) heals stale servers.
+        `read_repair_max_per_second` - max number of keys that background
+            read repair heals per second.
+        `coalesce_window` - if given, the lua scripts that concurrent threads
+            run on a server within this many seconds (ie .0002) are sent
+            as one pipeline.  See util.CoalescingClient
+        `read_quorum`, `write_quorum` - number of servers that get(...) reads
+            from and set(...), incrby(...) and delete(...) must write to.
+            read_quorum + write_quorum must be greater than n_servers, so
+            every read sees the latest write.  A small read_quorum makes
+            reads faster and more available at the cost of writes.
+            By default, both are n_servers // 2 + 1.
+            Lock and LockingQueue always require this strict majority.
+        `codec` - if given, set(...) encodes values with codec.encode(value)
+            and get(...) decodes them with codec.decode(data), ie to
+            serialize and compress values.  See codec.Codec
+        `getset_tombstone_ttl` - number of seconds to remember that a key was
+            deleted.  A server that misses a delete and is unreachable for
+            longer than this may bring the deleted value back.
+            0 means remember forever.
         """
         if len(clients) < n_servers // 2 + 1:
             raise exceptions.MajorityRedisException(
                 "Must connect to at least half of the redis servers to"
                 " obtain majority")
+        read_quorum = read_quorum or n_servers // 2 + 1
+        write_quorum = write_quorum or n_servers // 2 + 1
+        if read_quorum + write_quorum <= n_servers:
+            raise exceptions.MajorityRedisException(
+                "read_quorum + write_quorum must be greater than n_servers,"
+                " or reads may miss the latest write")
+        if max(read_quorum, write_quorum) > len(clients):
+            raise exceptions.MajorityRedisException(
+                "Must connect to at least read_quorum and write_quorum"
+                " redis servers")
         _socket_timeout = max(
             c.connection_pool.connection_kwargs['socket_timeout']
             for c in clients)
@@ -81,23 +154,124 @@ class MajorityRedis(object):
                 "It was not the case that"
                 " polling_interval < lock_timeout."
                 " The socket_timeout is a config setting on your redis clients")
+        if coalesce_window:
+            clients = [util.CoalescingClient(cli, coalesce_window)
+                       for cli in clients]
         self._run_async = run_async
         self._client_id = random.randint(1, sys.maxsize)
         self._clients = clients
-        self._clock_drift = 0  # TODO
+        self._clock = ClockDrift(clients)
         self._map_async = map_async
         self._n_servers = n_servers
+        self._read_quorum = read_quorum
+        self._write_quorum = write_quorum
         self._polling_interval = polling_interval
         self._lock_timeout = lock_timeout
         self._getset_history_prefix = getset_history_prefix
+        self._getset_tombstone_ttl = getset_tombstone_ttl
         self._threadsafe = threadsafe
+        self._relative_ttl = relative_ttl
+        self._read_repair_async = read_repair_async
+        self._read_repair_probability = read_repair_probability
+        self._read_repair_max_per_second = read_repair_max_per_second
+        self._clock_drift_interval = clock_drift_interval
+        self._codec = codec
+        self._fork_handlers = weakref.WeakSet()  # Lock and LockingQueue
+        self._waiters = Waiters(self)
+        util.FORK_HANDLERS.add(self)
+        if clock_drift_interval:
+            self._run_async(
+                self._clock.run_forever, clock_drift_interval, map_async,
+                lock_timeout)
 
-        getset = GetSet(self)
+        self._getset = getset = GetSet(self)
         self.get = getset.get
         self.set = getset.set
         self.ttl = getset.ttl
         self.incrby = getset.incrby
+        self.get_counter = getset.get_counter
         self.delete = getset.delete
         self.exists = getset.exists
+        self.watch = getset.watch
+        self.unwatch = getset.unwatch
+        self.migrate_getset_history = getset.migrate_history
         self.Lock = partial(Lock, self)
+        self.RWLock = partial(RWLock, self)
         self.LockingQueue = partial(LockingQueue, self)
+        self.StreamQueue = partial(StreamQueue, self)
+
+    @classmethod
+    def from_urls(cls, urls, n_servers=None, max_connections=50,
+                  socket_timeout=.5, socket_connect_timeout=None,
+                  socket_keepalive=True, health_check_interval=30,
+                  warmup_connections=1, **kwargs):
+        """Connect to each redis server in `urls` through a
+        BlockingConnectionPool and return a MajorityRedis instance.
+
+        Every operation sends one request to each server at the same time,
+        so each pool needs about one connection per concurrent operation.
+        When all connections to a server are in use, requests wait up to
+        `socket_timeout` seconds for one to free up rather than opening more.
+
+        `urls` - a list of redis urls, like "redis://host:6379/0"
+        `n_servers` - the number of Redis servers in your cluster.
+            By default, the number of urls.
+        `max_connections` - max number of connections to each server.
+            Should be at least the number of operations your threads run at
+            once, plus one per lock or queue item extended in the background.
+        `socket_timeout` - seconds to wait for a response from a server
+        `socket_connect_timeout` - seconds to wait for a new connection.
+            By default, the same as socket_timeout
+        `socket_keepalive` (bool) - enable TCP keepalive, so dead
+            connections to unreachable servers are noticed
+        `health_check_interval` - PING a connection before using it if it
+            was idle for this many seconds
+        `warmup_connections` - number of connections to open to each server
+            now, so the first requests do not wait on a TCP handshake.
+            Unreachable servers are skipped.
+        `kwargs` - passed to MajorityRedis.__init__
+        """
+        pool_kwargs = dict(
+            max_connections=max_connections, timeout=socket_timeout,
+            socket_timeout=socket_timeout,
+            socket_connect_timeout=socket_connect_timeout or socket_timeout,
+            socket_keepalive=socket_keepalive,
+            health_check_interval=health_check_interval)
+        clients = [
+            redis.StrictRedis(connection_pool=redis.BlockingConnectionPool
+                              .from_url(url, **pool_kwargs))
+            for url in urls]
+        mr = cls(clients, n_servers or len(clients), **kwargs)
+        if warmup_connections:
+            list(mr._map_async(
+                lambda cli: _warmup(
+                    cli, min(warmup_connections, max_connections)),
+                clients))
+        return mr
+
+    def _after_fork(self):
+        """In a forked child process, get a new client_id and connections,
+        and restart the background threads that did not survive the fork"""
+        self._client_id = random.randint(1, sys.maxsize)
+        for cli in self._clients:
+            cli.connection_pool.reset()
+            if isinstance(cli, util.CoalescingClient):
+                cli._after_fork()
+        self._getset._after_fork()
+        self._waiters._after_fork()
+        if self._clock_drift_interval:
+            self._run_async(
+                self._clock.run_forever, self._clock_drift_interval,
+                self._map_async, self._lock_timeout)
+        for obj in list(self._fork_handlers):
+            obj._after_fork()
+
+    @property
+    def _clock_drift(self):
+        """Max number of seconds the clocks of the redis servers are known
+        to differ from the local clock.
+        With relative ttls, only the rate at which clocks tick matters, so
+        use the Redlock drift factor instead"""
+        if self._relative_ttl:
+            return self._lock_timeout * .01 + .002
+        return self._clock.cluster_drift
@@ -0,0 +1,170 @@
+"""
+Benchmarks.
+
+Compare the bytes each codec sends to the servers and its CPU cost:
+
+    $ python -m majorityredis.benchmark codecs --size 100000 --n-servers 3
+
+Compare the throughput of LockingQueue and StreamQueue.  This writes to
+the given redis servers:
+
+    $ python -m majorityredis.benchmark queues --items 1000 \
+        --url redis://r1:6379 --url redis://r2:6379 --url redis://r3:6379
+"""
+import argparse
+import json
+import random
+import time
+
+from .codec import Codec
+from .streamqueue import StreamQueue
+
+
+def sample_value(size):
+    """Return a JSON-like object that serializes to about `size` bytes"""
+    rv = []
+    n = 0
+    while n < size:
+        record = dict(
+            id=len(rv), name='user%d' % random.randint(0, 10000),
+            tags=random.sample(['a', 'b', 'c', 'd', 'e', 'f'], 3),
+            score=round(random.random(), 4), active=random.random() < .5)
+        rv.append(record)
+        n += len(json.dumps(record)) + 1
+    return rv
+
+
+def bench_codecs(codecs, obj, n_servers=3, repeat=100):
+    """Encode and decode `obj` with each of the named `codecs`.
+
+    `codecs` - a list of (name, codec, serialized) tuples.  If serialized,
+        the codec receives the JSON string of obj rather than obj.
+    `n_servers` - every set(...) sends the value to each server
+
+    Return a list of dicts with the encoded size, the bytes sent to the
+    servers by one set(...), and the CPU microseconds to encode and decode.
+    """
+    rows = []
+    raw = json.dumps(obj)
+    for name, codec, serialized in codecs:
+        value = raw if serialized else obj
+        t = time.process_time()
+        for _ in range(repeat):
+            data = codec.encode(value)
+        t_encode = (time.process_time() - t) / repeat
+        t = time.process_time()
+        for _ in range(repeat):
+            codec.decode(data)
+        t_decode = (time.process_time() - t) / repeat
+        rows.append(dict(
+            codec=name, bytes=len(data), wire_bytes=len(data) * n_servers,
+            encode_us=t_encode * 1e6, decode_us=t_decode * 1e6))
+    return rows
+
+
+def default_codecs():
+    codecs = [
+        ('raw', Codec(compress_threshold=None), True),
+        ('zlib', Codec(), True),
+        ('json', Codec('json', compress_threshold=None), False),
+        ('json+zlib', Codec('json'), False),
+        ('json+zlib1', Codec('json', compress_level=1), False),
+    ]
+    try:
+        codecs.extend([
+            ('msgpack', Codec('msgpack', compress_threshold=None), False),
+            ('msgpack+zlib', Codec('msgpack'), False),
+        ])
+    except ImportError:
+        pass
+    return codecs
+
+
+def bench_queues(mr_client, n_items=1000, queue_path=None):
+    """Put, get and consume `n_items` with each queue engine, and time
+    size().  Return a list of dicts with the operations per second.
+
+    Stop getting once no item was gotten for twice the lock timeout, and
+    delete the queues from the servers when done"""
+    queue_path = queue_path or 'majorityredis_benchmark:%x' % (
+        random.getrandbits(32))
+    rows = []
+    for name, queue in [
+            ('LockingQueue', mr_client.LockingQueue(queue_path + ':lq')),
+            ('StreamQueue', mr_client.StreamQueue(queue_path + ':sq'))]:
+        row = dict(queue=name)
+        h_ks = []
+        try:
+            t = time.time()
+            for i in range(n_items):
+                h_ks.append(queue.put(str(i))[1])
+            row['put_per_s'] = n_items / (time.time() - t)
+            t = time.time()
+            n = 0
+            t_last = t
+            while n < n_items and \
+                    time.time() - t_last < 2 * mr_client._lock_timeout:
+                got = queue.get(extend_lock=False)
+                if got is None:
+                    continue
+                queue.consume(got[1])
+                n += 1
+                t_last = time.time()
+            row['get_consume_per_s'] = n / (time.time() - t)
+            t = time.time()
+            for _ in range(100):
+                queue.size(queued=True, taken=False)
+            row['size_ms'] = (time.time() - t) * 10
+        finally:
+            _delete_queue(mr_client, queue, h_ks)
+        rows.append(row)
+    return rows
+
+
+def _delete_queue(mr_client, queue, h_ks, batch_size=500):
+    """Delete the keys of a benchmarked queue from every server.
+    The h_k of each LockingQueue item is also a key"""
+    keys = [v for k, v in sorted(queue._params.items())
+            if k.startswith('Q')]
+    if not isinstance(queue, StreamQueue):
+        keys.extend(h_ks)
+    for cli in mr_client._clients:
+        for i in range(0, len(keys), batch_size):
+            cli.delete(*keys[i:i + batch_size])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    subparsers = parser.add_subparsers(dest='benchmark')
+    p = subparsers.add_parser('codecs', help='bytes on the wire and CPU cost')
+    p.add_argument('--size', type=int, default=10000,
+                   help='approximate size of the value in bytes')
+    p.add_argument('--n-servers', type=int, default=3)
+    p.add_argument('--repeat', type=int, default=100)
+    p = subparsers.add_parser('queues', help='LockingQueue vs StreamQueue')
+    p.add_argument('--url', action='append', required=True,
+                   help='url of a redis server.  Pass once per server')
+    p.add_argument('--items', type=int, default=1000)
+    ns = parser.parse_args(argv)
+    if ns.benchmark == 'queues':
+        from .api import MajorityRedis
+        rows = bench_queues(MajorityRedis.from_urls(ns.url), ns.items)
+        print('%-14s %10s %18s %8s' % (
+            'queue', 'put_per_s', 'get_consume_per_s', 'size_ms'))
+        for row in rows:
+            print('%(queue)-14s %(put_per_s)10.1f %(get_consume_per_s)18.1f'
+                  ' %(size_ms)8.2f' % row)
+        return
+    if ns.benchmark != 'codecs':
+        parser.error("choose a benchmark")
+    rows = bench_codecs(
+        default_codecs(), sample_value(ns.size), ns.n_servers, ns.repeat)
+    print('%-14s %10s %12s %11s %11s' % (
+        'codec', 'bytes', 'wire_bytes', 'encode_us', 'decode_us'))
+    for row in rows:
+        print('%(codec)-14s %(bytes)10d %(wire_bytes)12d'
+              ' %(encode_us)11.1f %(decode_us)11.1f' % row)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Estimate how far the clock of each redis server is from the local clock.
+
+Locks expire on each server according to that server's clock, but we decide
+whether a lock is still valid according to our own clock.  The difference
+between the two, plus the uncertainty introduced by network round trips,
+is the clock drift.
+"""
+from collections import deque
+import time
+
+from . import log
+
+
+class ClockDrift(object):
+    """
+    Periodically samples the TIME command on each redis server and keeps a
+    bound on the clock drift of each server and of the cluster as a whole.
+    """
+    def __init__(self, clients, n_samples=5, n_probes=3):
+        """
+        `clients` - a list of redis.StrictRedis clients
+        `n_samples` - number of recent samples to remember for each server.
+        `n_probes` - number of round trips per sample.  We keep the round
+            trip with the smallest latency, since it has the least error.
+        """
+        self._clients = clients
+        self._n_probes = n_probes
+        self._samples = dict((cli, deque(maxlen=n_samples)) for cli in clients)
+        self._running = False
+
+    def _probe(self, client):
+        """Return (offset, rtt) in seconds, where offset is how far ahead
+        the server's clock is of the local clock"""
+        best = None
+        for _ in range(self._n_probes):
+            t_start = time.time()
+            secs, usecs = client.time()
+            t_end = time.time()
+            rtt = t_end - t_start
+            if best is None or rtt < best[1]:
+                best = (secs + usecs / 1e6 - (t_start + t_end) / 2., rtt)
+        return best
+
+    def _sample(self, client):
+        try:
+            return client, self._probe(client)
+        except Exception as err:
+            log.debug("Could not sample server time", extra=dict(
+                error=err, error_type=type(err).__name__,
+                redis_client=client))
+            return client, err
+
+    def update(self, map_async):
+        """Sample the time on all servers.  Return the cluster drift"""
+        for client, offset_rtt in map_async(self._sample, self._clients):
+            if not isinstance(offset_rtt, Exception):
+                self._samples[client].append(offset_rtt)
+        return self.cluster_drift
+
+    def server_drift(self, client):
+        """Return a bound, in seconds, on the drift between the local clock
+        and the given server's clock, or 0 if it was never sampled"""
+        samples = self._samples.get(client)
+        if not samples:
+            return 0
+        # the sample with smallest round trip is the most accurate.  The
+        # server read its clock at some point during that round trip, so
+        # its true offset is within rtt / 2 of the measured offset.
+        offset, rtt = min(samples, key=lambda x: x[1])
+        return abs(offset) + rtt / 2.
+
+    @property
+    def cluster_drift(self):
+        """Return the largest drift bound across all servers"""
+        return max(self.server_drift(cli) for cli in self._clients)
+
+    def run_forever(self, interval, map_async, lock_timeout=None):
+        """Update the drift estimates every `interval` seconds until stop()"""
+        self._running = True
+        while self._running:
+            drift = self.update(map_async)
+            if lock_timeout and drift > lock_timeout / 2.:
+                log.warn(
+                    "Clock drift is large compared to lock_timeout",
+                    extra=dict(clock_drift=drift, lock_timeout=lock_timeout))
+            time.sleep(interval)
+
+    def stop(self):
+        self._running = False
@@ -0,0 +1,111 @@
+"""
+Codecs encode the values that GetSet stores, so that large values use less
+bandwidth and memory on each of the N servers.
+
+    >>> mr = MajorityRedis(clients, 3, codec=Codec('json'))
+    >>> mr.set('key', {'a': [1, 2, 3]})
+    >>> mr.get('key')
+    {'a': [1, 2, 3]}
+
+An encoded value starts with a header: a magic prefix and a byte that
+marks how it was serialized and whether it was compressed.  Values without
+a header, like those written before the codec was enabled or by
+incrby(...), and values that fail to decode are returned as they are
+stored.  None is stored as an empty value, as it is without a codec.
+"""
+import json
+import zlib
+
+
+# an encoded value starts with MAGIC and one byte from HEADERS.  The magic
+# prefix makes it unlikely that a raw value is mistaken for an encoded one
+MAGIC = b'\x00mrc'
+# header of an encoded value: (serializer, compressed)
+HEADERS = {
+    MAGIC + b'\x01': (None, False),
+    MAGIC + b'\x02': (None, True),
+    MAGIC + b'\x03': ('json', False),
+    MAGIC + b'\x04': ('json', True),
+    MAGIC + b'\x05': ('msgpack', False),
+    MAGIC + b'\x06': ('msgpack', True),
+}
+_HEADER_LEN = len(MAGIC) + 1
+_HEADER_BYTES = {v: k for k, v in HEADERS.items()}
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, str):
+        value = str(value)
+    return value.encode('utf-8')
+
+
+class Codec(object):
+    """
+    Serialize values and compress them with zlib if they are large.
+
+    `serializer` - None to store strings and bytes as they are,
+        'json', or 'msgpack', which requires the msgpack package.
+    `compress_threshold` - compress values of at least this many bytes.
+        Compressed values are only kept if they are smaller.
+        None disables compression.
+    `compress_level` - zlib compression level, from 1 (fastest) to 9
+    """
+    def __init__(self, serializer=None, compress_threshold=1024,
+                 compress_level=6):
+        if serializer not in (None, 'json', 'msgpack'):
+            raise UserWarning("serializer must be None, 'json' or 'msgpack'")
+        if serializer == 'msgpack':
+            import msgpack
+            self._msgpack = msgpack
+        self._serializer = serializer
+        self._compress_threshold = compress_threshold
+        self._compress_level = compress_level
+
+    def __repr__(self):
+        return '%s(%r, compress_threshold=%r)' % (
+            type(self).__name__, self._serializer, self._compress_threshold)
+
+    def encode(self, value):
+        """Return the bytes to store for `value`"""
+        if value is None:
+            return b''
+        if self._serializer == 'json':
+            data = json.dumps(value, separators=(',', ':')).encode('utf-8')
+        elif self._serializer == 'msgpack':
+            data = self._msgpack.packb(value, use_bin_type=True)
+        else:
+            data = _to_bytes(value)
+        compressed = False
+        if self._compress_threshold is not None and \
+                len(data) >= self._compress_threshold:
+            zdata = zlib.compress(data, self._compress_level)
+            if len(zdata) < len(data):
+                data, compressed = zdata, True
+        return _HEADER_BYTES[(self._serializer, compressed)] + data
+
+    def decode(self, data):
+        """Return the value stored as `data`.  Data without a header, or
+        that fails to decode, is returned as it is"""
+        if not data:
+            return data
+        try:
+            serializer, compressed = HEADERS[data[:_HEADER_LEN]]
+        except KeyError:
+            return data
+        if serializer == 'msgpack':
+            msgpack = getattr(self, '_msgpack', None)
+            if msgpack is None:
+                import msgpack
+        try:
+            value = data[_HEADER_LEN:]
+            if compressed:
+                value = zlib.decompress(value)
+            if serializer == 'json':
+                return json.loads(value.decode('utf-8'))
+            elif serializer == 'msgpack':
+                return msgpack.unpackb(value, raw=False)
+            return value
+        except Exception:  # a raw value that happens to look encoded
+            return data
@@ -1,3 +1,6 @@
+import random
+import redis
+import threading
 import time
 from itertools import chain
 from collections import defaultdict
@@ -8,69 +11,219 @@ from . import log
 
 
 SCRIPTS = dict(
-
-    # returns (prev_value, prev_timestamp) and set value if ts is new enough
+    # keys:
+    # path = the redis key storing the value
+    # meta = a hash storing metadata about the value at path:
+    #   ts - timestamp of the most recent write to path
+    #   token - the largest fencing token a writer has given for path
+    #   After path is deleted, meta remains as a tombstone, so that stale
+    #   servers cannot bring the deleted value back.
+    #
+    # args:
+    # channel = the pub/sub channel of the path.  Scripts that modify
+    #   the path publish the timestamp of the write on it.  See Watcher
+    # tombstone_ttl = number of seconds to keep a tombstone.  0 is forever
+    # px = number of milliseconds until the value expires, or ''.
+    #   The meta hash expires tombstone_ttl seconds after the value, so
+    #   stale servers cannot bring an expired value back either.
+    #
+    # scripts that modify a path return
+    # (prev_value, prev_timestamp, result, prev_pttl)
+
+    # returns (prev_value, prev_timestamp, prev_pttl) and set value if ts is
+    # new enough
     # returns exception if did not set (due to nx or xx)
-    gs_set=dict(keys=('path', 'hist'), args=('ts', 'val', 'nx_or_xx'),
+    # returns exception if given a fencing token older than one already seen
+    gs_set=dict(keys=('path', 'meta'),
+                args=('ts', 'val', 'nx_or_xx', 'token', 'px', 'tombstone_ttl',
+                      'channel'),
                 script="""
-local oldts = redis.call("ZSCORE", KEYS[2], KEYS[1])
+local meta = redis.call("HMGET", KEYS[2], "ts", "token")
+if '' ~= ARGV[4] and tonumber(meta[2] or 0) > tonumber(ARGV[4]) then
+  return {err="stale token"} end
+local oldts = meta[1]
 local oldval = redis.call("GET", KEYS[1])
+local oldpttl = redis.call("PTTL", KEYS[1])
 if oldts ~= false and tonumber(oldts) > tonumber(ARGV[1]) then
-  return {oldval, oldts, 0}
+  return {oldval, oldts, 0, oldpttl}
 else
   -- set value
-  local rv
-  if '' == ARGV[3] then
-    rv = redis.call("SET", KEYS[1], ARGV[2])
-  else
-    rv = redis.call("SET", KEYS[1], ARGV[2], ARGV[3]) end
-  redis.call("ZADD", KEYS[2], tonumber(ARGV[1]), KEYS[1])
-  if false == oldts then return {false, false, rv} end
-  return {oldval, oldts, rv}
+  local cmd = {"SET", KEYS[1], ARGV[2]}
+  if '' ~= ARGV[5] then
+    table.insert(cmd, "PX")
+    table.insert(cmd, ARGV[5]) end
+  if '' ~= ARGV[3] then table.insert(cmd, ARGV[3]) end
+  local rv = redis.call(unpack(cmd))
+  redis.call("HSET", KEYS[2], "ts", ARGV[1])
+  if '' ~= ARGV[4] then redis.call("HSET", KEYS[2], "token", ARGV[4]) end
+  if rv and '' ~= ARGV[5] and 0 < tonumber(ARGV[6]) then
+    redis.call("PEXPIRE", KEYS[2], ARGV[5] + 1000 * ARGV[6])
+  elseif rv then
+    redis.call("PERSIST", KEYS[2]) end
+  if rv then redis.call("PUBLISH", ARGV[7], ARGV[1]) end
+  if false == oldts then return {false, false, rv, oldpttl} end
+  return {oldval, oldts, rv, oldpttl}
 end
 """),
 
     # returns (prev_value, prev_timestamp, deleted_key)
-    gs_delete=dict(keys=('path', 'hist'), args=('ts', ), script="""
-local oldts = redis.call("ZSCORE", KEYS[2], KEYS[1])
+    gs_delete=dict(keys=('path', 'meta'),
+                   args=('ts', 'tombstone_ttl', 'channel'),
+                   script="""
+local oldts = redis.call("HGET", KEYS[2], "ts")
 local oldval = redis.pcall("GET", KEYS[1])
+local oldpttl = redis.call("PTTL", KEYS[1])
 if oldts ~= false and tonumber(oldts) > tonumber(ARGV[1]) then
-  return {oldval, oldts, 0}
+  return {oldval, oldts, 0, oldpttl}
 else
   local rv = redis.call("DEL", KEYS[1])
-  redis.call("ZADD", KEYS[2], tonumber(ARGV[1]), KEYS[1])
-  if false == oldts then return {false, false, rv} end
-  return {oldval, oldts, rv}
+  redis.call("HSET", KEYS[2], "ts", ARGV[1])
+  if 0 < tonumber(ARGV[2]) then
+    redis.call("EXPIRE", KEYS[2], ARGV[2]) end
+  redis.call("PUBLISH", ARGV[3], ARGV[1])
+  if false == oldts then return {false, false, rv, oldpttl} end
+  return {oldval, oldts, rv, oldpttl}
 end
 """),
 
     # returns incremented value in form (rv, timestamp)
-    gs_incrby=dict(keys=('path', 'hist'), args=('ts', 'val'), script="""
-local oldts = redis.call("ZSCORE", KEYS[2], KEYS[1])
+    # returns exception if given a fencing token older than one already seen
+    gs_incrby=dict(keys=('path', 'meta'),
+                   args=('ts', 'val', 'token', 'channel'),
+                   script="""
+local meta = redis.call("HMGET", KEYS[2], "ts", "token")
+if '' ~= ARGV[3] and tonumber(meta[2] or 0) > tonumber(ARGV[3]) then
+  return {err="stale token"} end
+local oldts = meta[1]
 local oldval = redis.pcall("GET", KEYS[1])
+local oldpttl = redis.call("PTTL", KEYS[1])
 if oldts ~= false and tonumber(oldts) > tonumber(ARGV[1]) then
-  return {oldval, oldts, 0}
+  return {oldval, oldts, 0, oldpttl}
 else
   local rv = redis.call("INCRBY", KEYS[1], ARGV[2])
-  redis.call("ZADD", KEYS[2], tonumber(ARGV[1]), KEYS[1])
-  if false == oldts then return {false, false, rv} end
-  return {oldval, oldts, rv}
+  redis.call("HSET", KEYS[2], "ts", ARGV[1])
+  if '' ~= ARGV[3] then redis.call("HSET", KEYS[2], "token", ARGV[3]) end
+  if -1 == oldpttl or -2 == oldpttl then redis.call("PERSIST", KEYS[2]) end
+  redis.call("PUBLISH", ARGV[4], ARGV[1])
+  if false == oldts then return {false, false, rv, oldpttl} end
+  return {oldval, oldts, rv, oldpttl}
 end
 """),
 
-    # returns gotten value or nil in form (rv, timestamp)
-    gs_get=dict(keys=('path', 'hist'), args=(), script="""
-return {redis.call("GET", KEYS[1]), redis.call("ZSCORE", KEYS[2], KEYS[1])}
+    # returns gotten value or nil in form (rv, timestamp, pttl)
+    gs_get=dict(keys=('path', 'meta'), args=(), script="""
+return {redis.call("GET", KEYS[1]), redis.call("HGET", KEYS[2], "ts"),
+        redis.call("PTTL", KEYS[1])}
 """),
 
     # returns 1 if exists 0 otherwise in form (rv, timestamp)
-    gs_exists=dict(keys=('path', 'hist'), args=(), script="""
-return {redis.call("EXISTS", KEYS[1]), redis.call("ZSCORE", KEYS[2], KEYS[1])}
+    gs_exists=dict(keys=('path', 'meta'), args=(), script="""
+return {redis.call("EXISTS", KEYS[1]), redis.call("HGET", KEYS[2], "ts")}
 """),
 
     # returns -2, -1, or a num >=0 in form (rv, timestamp)
-    gs_ttl=dict(keys=('path', 'hist'), args=(), script="""
-return {redis.call("TTL", KEYS[1]), redis.call("ZSCORE", KEYS[2], KEYS[1])}
+    gs_ttl=dict(keys=('path', 'meta'), args=(), script="""
+return {redis.call("TTL", KEYS[1]), redis.call("HGET", KEYS[2], "ts")}
+"""),
+
+    # heal many paths at once, for paths whose ts is newer than ours
+    # heal_keys = for each path: path, meta
+    # heals = for each path: ts, "set" or "del", value, px
+    # returns number of paths healed
+    gs_heal_many=dict(
+        keys=('heal_keys', ), args=('tombstone_ttl', 'heals'), script="""
+local n = 0
+for i = 1, #KEYS, 2 do
+  local j = 2 * i
+  local oldts = redis.call("HGET", KEYS[i + 1], "ts")
+  if false == oldts or tonumber(oldts) < tonumber(ARGV[j]) then
+    redis.call("HSET", KEYS[i + 1], "ts", ARGV[j])
+    if "del" == ARGV[j + 1] then
+      redis.call("DEL", KEYS[i])
+      if 0 < tonumber(ARGV[1]) then
+        redis.call("EXPIRE", KEYS[i + 1], ARGV[1]) end
+    elseif '' ~= ARGV[j + 3] then
+      redis.call("SET", KEYS[i], ARGV[j + 2], "PX", ARGV[j + 3])
+      if 0 < tonumber(ARGV[1]) then
+        redis.call("PEXPIRE", KEYS[i + 1], ARGV[j + 3] + 1000 * ARGV[1])
+      else redis.call("PERSIST", KEYS[i + 1]) end
+    else
+      redis.call("SET", KEYS[i], ARGV[j + 2])
+      redis.call("PERSIST", KEYS[i + 1])
+    end
+    n = n + 1
+  end
+end
+return n
+"""),
+
+    # conflict-free counters (PN-counters).
+    # counter = a hash with two fields per client that incremented the path:
+    #   "<client_id>:p" - the sum of the client's positive increments
+    #   "<client_id>:n" - the sum of the client's negative increments
+    #   and "total", the cached sum of all p fields minus all n fields.
+    # Fields only grow, so merging servers takes the max of each field.
+    # Nothing removes the fields of clients that are gone: a client_id is new
+    # for every MajorityRedis instance and fork, so the hash grows by two
+    # fields for each of them.  Folding old fields into one would break the
+    # max merge, since a server that missed the fold would count them twice.
+
+    # merge counts into the counter, and keep the total up to date.
+    # fields = for each field: name, count
+    # returns the total
+    gs_counter_merge=dict(keys=('counter', ), args=('fields', ), script="""
+for i = 1, #ARGV, 2 do
+  local old = tonumber(redis.call("HGET", KEYS[1], ARGV[i]) or 0)
+  local new = tonumber(ARGV[i + 1])
+  if old < new then
+    redis.call("HSET", KEYS[1], ARGV[i], ARGV[i + 1])
+    if ":n" == string.sub(ARGV[i], -2) then
+      redis.call("HINCRBY", KEYS[1], "total", old - new)
+    else
+      redis.call("HINCRBY", KEYS[1], "total", new - old) end
+  end
+end
+return redis.call("HGET", KEYS[1], "total") or 0
+"""),
+
+    # returns the counter as a flat list of field, count pairs
+    gs_counter_get=dict(keys=('counter', ), args=(), script="""
+return redis.call("HGETALL", KEYS[1])
+"""),
+
+    # returns the cached total of the counter, or nil
+    gs_counter_total=dict(keys=('counter', ), args=(), script="""
+return redis.call("HGET", KEYS[1], "total")
+"""),
+
+    # move timestamps from the old history sorted set, hist, into the meta
+    # hash of each path.  Also move fencing tokens out of the old fence keys.
+    # migrate_keys = for each path: path, meta, fence
+    # scores = the timestamp of each path in hist
+    # returns number of paths migrated
+    gs_migrate=dict(
+        keys=('hist', 'migrate_keys'), args=('tombstone_ttl', 'scores'),
+        script="""
+local n = 0
+for i = 2, #KEYS, 3 do
+  local score = ARGV[2 + (i - 2) / 3]
+  local ts = redis.call("HGET", KEYS[i + 1], "ts")
+  if false == ts or tonumber(ts) < tonumber(score) then
+    redis.call("HSET", KEYS[i + 1], "ts", score)
+    if 0 == redis.call("EXISTS", KEYS[i]) and 0 < tonumber(ARGV[1]) then
+      redis.call("EXPIRE", KEYS[i + 1], ARGV[1]) end
+  end
+  local token = redis.call("GET", KEYS[i + 2])
+  if token then
+    local oldtoken = redis.call("HGET", KEYS[i + 1], "token")
+    if false == oldtoken or tonumber(oldtoken) < tonumber(token) then
+      redis.call("HSET", KEYS[i + 1], "token", token) end
+    redis.call("DEL", KEYS[i + 2])
+  end
+  redis.call("ZREM", KEYS[1], KEYS[i])
+  n = n + 1
+end
+return n
 """),
 )
 
@@ -80,32 +233,131 @@ class GetSet(object):
         """
         `mr_client` - an instance of the MajorityRedis client.
         """
-        self._getset_hist_key = '%s%s' % (
-            mr_client._getset_history_prefix, '.majorityredis_getset_history')
+        self._getset_prefix = mr_client._getset_history_prefix
         self._mr = mr_client
+        self._repairer = ReadRepairer(
+            self, mr_client._read_repair_max_per_second)
+        self._counters_lock = threading.Lock()
+        self._counters = {}  # {path: (p, n)} our counts for each counter
+        self._watcher = Watcher(self)
+
+    def _after_fork(self):
+        """The child has a new client_id, so it starts counting from 0"""
+        self._counters_lock = threading.Lock()
+        self._counters = {}
+        self._repairer._after_fork()
+        self._watcher._after_fork()
+
+    def _keys(self, path):
+        """Return the redis keys and pub/sub channel used for the given path"""
+        return dict(
+            path=path,
+            meta='%s.majorityredis_getset_meta:%s' % (
+                self._getset_prefix, path),
+            counter='%s.majorityredis_counter:%s' % (
+                self._getset_prefix, path),
+            channel='%s.majorityredis_getset_watch:%s' % (
+                self._getset_prefix, path))
+
+    def watch(self, path, callback):
+        """
+        Call callback(path, value) whenever the value at path changes,
+        rather than polling get(path).  value is None if path was deleted.
+
+        Each write announces its timestamp on every server it reaches.
+        When a server announces a write newer than the last value we called
+        back with, we read path from the majority and call back only if the
+        most recent value is newer.  Callbacks run in background threads,
+        possibly concurrently, and all watched paths share one subscriber
+        connection per server.
+        """
+        self._watcher.watch(path, callback)
+
+    def unwatch(self, path, callback=None):
+        """Stop calling `callback`, or all callbacks, on changes to path"""
+        self._watcher.unwatch(path, callback)
 
-    def exists(self, path):
+    def migrate_history(self, batch_size=500):
+        """
+        Move write timestamps out of the sorted set that older versions of
+        majorityredis kept for all keys, ".majorityredis_getset_history",
+        and into the metadata kept for each key.  The sorted set is
+        consumed in batches with ZSCAN, so this does not block Redis and
+        may run while clients are reading and writing.
+
+        Return the number of keys migrated on each server, in the
+        same order as the clients
+        """
+        hist = '%s%s' % (self._getset_prefix, '.majorityredis_getset_history')
+        return [self._migrate_history(cli, hist, batch_size)
+                for cli in self._mr._clients]
+
+    def _migrate_history(self, client, hist, batch_size):
+        n, cursor = 0, 0
+        while True:
+            cursor, items = client.zscan(hist, cursor, count=batch_size)
+            if items:
+                migrate_keys = []
+                for path, _ in items:
+                    path = util.to_str(path)
+                    migrate_keys.extend((
+                        path, self._keys(path)['meta'],
+                        '%s.majorityredis_getset_fence:%s' % (
+                            self._getset_prefix, path)))
+                for _, rv in util.run_script(
+                        SCRIPTS, self._mr._map_async, 'gs_migrate', [client],
+                        hist=hist, migrate_keys=migrate_keys,
+                        tombstone_ttl=self._mr._getset_tombstone_ttl,
+                        scores=[repr(score) for _, score in items]):
+                    if isinstance(rv, Exception):
+                        raise rv
+                    n += rv
+            if not cursor:
+                return n
+
+    def exists(self, path, timeout=None):
         """Return True if path exists.  False otherwise.
         Does not try to heal nodes with incorrect values."""
-        return bool(self._read_value('gs_exists', path))
+        return bool(self._read_value(
+            'gs_exists', path, deadline=util.get_deadline(timeout)))
 
-    def ttl(self, path):
+    def ttl(self, path, timeout=None):
         """Calculate the ttl at given path"""
-        return self._read_value('gs_ttl', path)
+        return self._read_value(
+            'gs_ttl', path, deadline=util.get_deadline(timeout))
 
-    def get(self, path):
-        """Return value at given path, or None if it does not exist"""
-        return self._read_value('gs_get', path, heal=True)
+    def get(self, path, timeout=None):
+        """Return value at given path, or None if it does not exist
 
-    def set(self, path, value, retry_condition=None, nx=None, xx=None):
+        `timeout` (num) Max num seconds to wait for the servers, including
+            healing stale servers unless read repair is async.  Servers that
+            have not responded in time are abandoned and count as failures.
+            The other GetSet operations accept the same `timeout`.
+        """
+        val = self._read_value(
+            'gs_get', path, heal=True, deadline=util.get_deadline(timeout))
+        if self._mr._codec is not None and val is not None:
+            return self._mr._codec.decode(val)
+        return val
+
+    def set(self, path, value, retry_condition=None, nx=None, xx=None,
+            token=None, ex=None, px=None, timeout=None):
         """
-        Set value at given path.  nx and xx are redis SET options.  We do not
-        support ex and px.
+        Set value at given path.  nx, xx, ex and px are redis SET options.
+
+        `ex` (num) expire the value after this many seconds
+        `px` (int) expire the value after this many milliseconds
+
+        `token` (int) a fencing token returned by Lock.lock().  If given,
+            servers reject this write if they have already accepted a write
+            to this path with a larger token.
 
         `retry_condition` (func) continually retry calling this function until
             we successfully put to >50% of servers or a max limit is reached.
             see majorityredis.util.retry_condition for details
             retry_condition=retry_condition(nretry=10, ...)
+        `timeout` (num) Max num seconds to wait for the servers, across all
+            retries.  Servers that have not responded in time are abandoned.
 
         Return True if successful
         Return False if I safely didn't set on any servers.
@@ -118,21 +370,38 @@ class GetSet(object):
         """
         if nx and xx:
             raise UserWarning("cannot set both NX and XX")
+        if ex is not None and px is not None:
+            raise UserWarning("cannot set both EX and PX")
+        if ex is not None:
+            px = int(ex * 1000)
         if value is None:
             value = ''
+        elif self._mr._codec is not None:
+            value = self._mr._codec.encode(value)
+        deadline = util.get_deadline(timeout)
         if retry_condition:
-            func = retry_condition(self._set, lambda rv: rv is True,
-                                   raise_on_err=False)
+            # stop retrying once out of time
+            func = retry_condition(
+                self._set,
+                lambda rv: rv is True or util.time_left(deadline) == 0,
+                raise_on_err=False)
         else:
             func = self._set
-        return func(path, value, nx=nx, xx=xx)
+        rv = func(path, value, nx=nx, xx=xx, token=token, px=px,
+                  deadline=deadline)
+        if isinstance(rv, Exception):
+            raise rv
+        return rv
 
-    def _set(self, path, value, nx, xx):
+    def _set(self, path, value, nx, xx, token, px, deadline=None):
         return bool(self._modify_path(
-            path, 'gs_set',
-            val=value, nx_or_xx=(nx and 'NX') or (xx and 'XX') or ''))
+            path, 'gs_set', deadline=deadline,
+            val=value, nx_or_xx=(nx and 'NX') or (xx and 'XX') or '',
+            token='' if token is None else token,
+            px='' if px is None else px,
+            tombstone_ttl=self._mr._getset_tombstone_ttl))
 
-    def delete(self, path):
+    def delete(self, path, timeout=None):
         """
         Delete key identified by `path`.
 
@@ -140,35 +409,161 @@ class GetSet(object):
         Raise exception if I set on less than majority.  At this point, the
         key is in an inconsistent state and should be modified.
         """
-        return bool(self._modify_path(path, 'gs_delete'))
+        return bool(self._modify_path(
+            path, 'gs_delete', deadline=util.get_deadline(timeout),
+            tombstone_ttl=self._mr._getset_tombstone_ttl))
 
-    def incrby(self, path, value=1):
+    def incrby(self, path, value=1, token=None, timeout=None, crdt=False):
         """
         Increment the value stored at given path
         Return the incremented value
-        """
-        return int(self._modify_path(path, 'gs_incrby', val=value))
 
-    def _heal(self, path, responses, winner, fail_cnt):
+        `token` (int) a fencing token returned by Lock.lock().  See set(...)
+        `crdt` (bool) If True, path is a conflict-free counter, which you
+            read with get_counter(path) rather than get(path).
+            Each client keeps its own counts on every server, so increments
+            from many clients never conflict, need no retries and are not
+            lost.  Return the total on the servers we incremented, which
+            may not yet include increments from other clients.
+            The counter is stored apart from the value at path, so
+            get(path), exists(path) and delete(path) ignore it.  It keeps
+            two fields for every MajorityRedis instance (and fork) that
+            ever incremented it, and these are never compacted, so
+            get_counter(path) and sync slow down as short-lived clients
+            come and go.  Prefer incrementing from long-lived clients.
+        """
+        if crdt:
+            if token is not None:
+                raise UserWarning("cannot use a fencing token with crdt")
+            return self._incrby_counter(
+                path, value, util.get_deadline(timeout))
+        return int(self._modify_path(
+            path, 'gs_incrby', deadline=util.get_deadline(timeout), val=value,
+            token='' if token is None else token))
+
+    def _incrby_counter(self, path, value, deadline):
+        with self._counters_lock:
+            p, n = self._counters.get(path, (0, 0))
+            if value >= 0:
+                p += value
+            else:
+                n -= value
+            self._counters[path] = (p, n)
+        # send our counts rather than the increment, so a server that
+        # missed an earlier increment catches up, and retries are harmless
+        cid = self._mr._client_id
+        totals = []
+        for _, total in util.run_script(
+                SCRIPTS, self._mr._map_async, 'gs_counter_merge',
+                self._mr._clients, deadline=deadline,
+                fields=['%s:p' % cid, p, '%s:n' % cid, n],
+                **self._keys(path)):
+            if isinstance(total, Exception):
+                continue
+            totals.append(int(total))
+            if len(totals) >= self._mr._write_quorum:
+                break
+        if len(totals) < self._mr._write_quorum:
+            raise exceptions.NoMajority(
+                "Could not increment the counter on enough servers to reach"
+                " write_quorum.  The increment is sent again with our next"
+                " increment of this path")
+        return max(totals)
+
+    def get_counter(self, path, cached=False, timeout=None):
+        """Return the value of a counter incremented with
+        incrby(path, crdt=True), or 0 if it does not exist.
+
+        Merge the counts of the servers we read from, and heal the servers
+        that are behind.
+
+        `cached` (bool) If True, read only the total that each server keeps,
+            rather than the counts of every client.  This is faster for
+            counters incremented by many clients, but may miss increments
+            that other servers received until the servers are healed.
+        `timeout` (num) Max num seconds to wait for the servers.  See get(...)
+        """
+        responses = []
+        for cli, rv in util.run_script(
+                SCRIPTS, self._mr._map_async,
+                'gs_counter_total' if cached else 'gs_counter_get',
+                self._mr._clients, deadline=util.get_deadline(timeout),
+                **self._keys(path)):
+            if isinstance(rv, Exception):
+                continue
+            responses.append((cli, rv))
+            if len(responses) >= self._mr._read_quorum:
+                break
+        if len(responses) < self._mr._read_quorum:
+            raise exceptions.NoMajority(
+                "Got errors from too many redis servers to reach read_quorum")
+        if cached:
+            return max(int(rv or 0) for _, rv in responses)
+        counts = []
+        merged = {}
+        for cli, rv in responses:
+            cnts = {util.to_str(field): int(cnt)
+                    for field, cnt in zip(rv[::2], rv[1::2])}
+            cnts.pop('total', None)
+            counts.append((cli, cnts))
+            for field, cnt in cnts.items():
+                merged[field] = max(cnt, merged.get(field, 0))
+        if random.random() < self._mr._read_repair_probability:
+            self._heal_counter(path, counts, merged)
+        return sum(-cnt if field.endswith(':n') else cnt
+                   for field, cnt in merged.items())
+
+    def _heal_counter(self, path, counts, merged):
+        """Send each server the counts it is behind on.
+        Return without checking results"""
+        for cli, cnts in counts:
+            fields = []
+            for field, cnt in merged.items():
+                if cnts.get(field, 0) < cnt:
+                    fields.extend((field, cnt))
+            if fields:
+                util.run_script(
+                    SCRIPTS, self._mr._map_async, 'gs_counter_merge', [cli],
+                    fields=fields, **self._keys(path))
+
+    def _heal(self, path, responses, winner, fail_cnt, pttl=None):
         """Update the clients with stale values.
-        Return without checking results.  Even try servers that just failed"""
-        outdated_clients = (
-            cli for cli, val_ts in responses if val_ts != winner)
+        Return without checking results.  Even try servers that just failed
+
+        `pttl` - milliseconds until the winning value expires.
+            Stale servers receive the remaining ttl of the winner.
+
+        The winner is healed as it is stored, so a value encoded by a codec
+        is not encoded again.
+        """
+        outdated_clients = self._outdated_clients(responses, winner)
         val, ts = winner[0], winner[1]
         if val is None:
             util.run_script(
                 SCRIPTS, self._mr._map_async, 'gs_delete', outdated_clients,
-                path=path, hist=self._getset_hist_key, ts=ts)
+                ts=ts, tombstone_ttl=self._mr._getset_tombstone_ttl,
+                **self._keys(path))
         else:
             util.run_script(
                 SCRIPTS, self._mr._map_async, 'gs_set', outdated_clients,
-                path=path, hist=self._getset_hist_key, val=val, ts=ts,
-                nx_or_xx='')
-
-    def _parse_responses(self, gen):
+                val=val, ts=ts, nx_or_xx='', token='',
+                px=pttl if pttl and pttl > 0 else '',
+                tombstone_ttl=self._mr._getset_tombstone_ttl,
+                **self._keys(path))
+
+    def _outdated_clients(self, responses, winner):
+        """Return the clients in `responses` that don't have the winning
+        (value, timestamp) pair, including those that sent exceptions"""
+        return (
+            cli for cli, val_ts in responses
+            if isinstance(val_ts, Exception) or val_ts[:2] != winner[:2])
+
+    def _parse_responses(self, gen, quorum):
         """Evaluate result of calling a lua script on redis servers where
 
         `gen` generator of form (client, (return_value, timestamp))
+        `quorum` number of responses to review before returning, if they
+            have timestamps.  The remaining responses are not waited for.
 
         Return (responses, winner, fail_cnt) where
           - responses is an iterable containing (client, val_ts) pairs
@@ -178,7 +573,6 @@ class GetSet(object):
         responses = []
         winner = (None, None)
         failed = []
-        quorum = self._mr._n_servers // 2 + 1
         for client, val_ts in gen:
             if isinstance(val_ts, Exception):
                 failed.append((client, val_ts))
@@ -197,12 +591,13 @@ class GetSet(object):
             # no timestamps exist for this key.
             # choose most frequently occurring value, in case the history isn't
             # used for this key.
-            lst = [tuple(x[1]) for x in responses]
-            winner = max(set(lst), key=lst.count)
+            lst = [tuple(x[1][:2]) for x in responses]
+            best = max(set(lst), key=lst.count)
+            winner = next(x[1] for x in responses if x[1][:2] == best)
         return chain(responses, failed, gen), winner, len(failed)
 
     def _modify_path(self, path, script_name,
-                     rv_from_winner=False, **script_params):
+                     rv_from_winner=False, deadline=None, **script_params):
         """
         Modify a key on all servers.  The type of modification is determined by
         `script_name`.  Assume the scripts called by this function all
@@ -210,14 +605,19 @@ class GetSet(object):
         The given function, `is_consistent_given_exceptions` should specially
         handle any error messages returned by the script to determine if the
         state of the modified path is still consistent in the cluster.
+
+        `deadline` - stop waiting for servers at this time.  Abandoned
+            servers count as failures.  See util.run_script
         """
         ts = time.time()
         gen = util.run_script(
             SCRIPTS, self._mr._map_async, script_name, self._mr._clients,
-            path=path, hist=self._getset_hist_key, ts=ts, **script_params)
-        responses, winner, fail_cnt = self._parse_responses(gen)
+            deadline=deadline, ts=ts,
+            **dict(self._keys(path), **script_params))
+        responses, winner, fail_cnt = self._parse_responses(
+            gen, self._mr._write_quorum)
 
-        if fail_cnt > self._mr._n_servers // 2:
+        if fail_cnt > self._mr._n_servers - self._mr._write_quorum:
             if self._is_modify_path_consistent_given_error(responses):
                 return False  # state is consistent. didn't update anything
             raise exceptions.NoMajority(
@@ -231,7 +631,8 @@ class GetSet(object):
             log.debug("Someone else set a value after my request")
             # this would happen if there are long network delays or
             # communication issues.  propagate the winner value
-            self._heal(path, responses, winner, fail_cnt)
+            self._heal(path, responses, winner, fail_cnt,
+                       pttl=winner[3] if len(winner) > 3 else None)
             return False
 
     def _is_modify_path_consistent_given_error(self, gen):
@@ -239,39 +640,248 @@ class GetSet(object):
         On operations that modify key paths (ie the SET or DEL operations),
         If the majority of set operations failed because something prevented
         the modification (ie nx or xx for SET. or key does not exist for DEL),
-        we only maintain consistency if, on the majority of servers,
+        we only maintain consistency if, on a write quorum of servers,
         the previous (val, ts) is the same
         """
+        quorum = self._mr._write_quorum
         cnt = defaultdict(int)
         for n, (cli, val_ts) in enumerate(gen):
-            if not isinstance(val_ts, Exception):
-                continue
+            if not isinstance(val_ts, redis.ResponseError):
+                continue  # an unreachable server tells us nothing
             cnt[tuple(str(val_ts).split(':')[-2:])] += 1
-            if n + 1 < self._mr._n_servers // 2 + 1:
+            if n + 1 < quorum:
                 continue
-            if any(val > self._mr._n_servers // 2 for val in cnt.values()):
+            if any(val >= quorum for val in cnt.values()):
                 return True
         return False
 
-    def _read_value(self, script_name, path, heal=False):
+    def _read_value(self, script_name, path, heal=False, deadline=None):
         """Run script on all servers and return the value on the server
         with most recent data.
 
         `heal` (bool) if True, make all servers look like the most up to
             date server.  Warning: if heal=True and the return value is not
             the value of at the path, you will overwrite the key with bad data!
+        `deadline` - stop waiting for servers at this time.  See _modify_path
         """
         gen = util.run_script(
             SCRIPTS, self._mr._map_async, script_name, self._mr._clients,
-            path=path, hist=self._getset_hist_key)
-        responses, winner, fail_cnt = self._parse_responses(gen)
+            deadline=deadline, **self._keys(path))
+        responses, winner, fail_cnt = self._parse_responses(
+            gen, self._mr._read_quorum)
 
         if fail_cnt == self._mr._n_servers:
             raise exceptions.NoMajority(
                 "Got errors from all redis servers")
-        if heal:
-            self._heal(path, responses, winner, fail_cnt)
-        if fail_cnt >= self._mr._n_servers // 2 + 1:
+        if heal and random.random() < self._mr._read_repair_probability:
+            pttl = winner[2] if len(winner) > 2 else None
+            if self._mr._read_repair_async:
+                self._repairer.add(path, responses, winner, pttl)
+            else:
+                self._heal(path, responses, winner, fail_cnt, pttl=pttl)
+        if fail_cnt > self._mr._n_servers - self._mr._read_quorum:
             raise exceptions.NoMajority(
-                "Got errors from majority of redis servers")
+                "Got errors from too many redis servers to reach read_quorum")
         return winner[0]
+
+
+class Watcher(object):
+    """
+    Calls back on changes to watched GetSet paths.  See GetSet.watch(...)
+
+    Subscribes to the channel of each watched path on every server, and
+    checks a path in the background whenever a server announces a write.
+    """
+    def __init__(self, getset):
+        self._getset = getset
+        self._mr = getset._mr
+        self._lock = threading.Lock()
+        self._callbacks = {}  # {path: [callback, ...]}
+        self._ts = {}  # {path: timestamp of the value we last called back}
+        self._subscriber = util.Subscriber(
+            self._mr, self._on_message, self._on_error)
+
+    def _after_fork(self):
+        """Our listening threads and connections belong to the parent"""
+        self._lock = threading.Lock()
+        self._callbacks = {}
+        self._ts = {}
+        self._subscriber._after_fork()
+
+    def watch(self, path, callback):
+        with self._lock:
+            new = path not in self._callbacks
+            self._callbacks.setdefault(path, []).append(callback)
+        if new:
+            self._subscriber.subscribe(self._getset._keys(path)['channel'])
+            self._check(path, initial=True)
+
+    def unwatch(self, path, callback=None):
+        with self._lock:
+            callbacks = self._callbacks.get(path, [])
+            if callback is None:
+                del callbacks[:]
+            elif callback in callbacks:
+                callbacks.remove(callback)
+            if callbacks or path not in self._callbacks:
+                return
+            self._callbacks.pop(path)
+            self._ts.pop(path, None)
+        self._subscriber.unsubscribe(self._getset._keys(path)['channel'])
+
+    def _on_message(self, client, channel, data):
+        """A server announced a write.  Check the path off the listening
+        thread, so slow callbacks do not delay other notifications"""
+        path = channel[len(self._getset._keys('')['channel']):]
+        last = self._ts.get(path)
+        if last is None or float(data) > last:
+            self._mr._run_async(self._check, path)
+
+    def _on_error(self, client):
+        """We may have missed writes while disconnected from the server"""
+        for path in list(self._callbacks):
+            self._mr._run_async(self._check, path)
+
+    def _check(self, path, initial=False):
+        """Read path from the majority and call back if the most recent
+        value is newer than the last one we called back with.
+        If `initial`, only remember the timestamp of the current value"""
+        gen = util.run_script(
+            SCRIPTS, self._mr._map_async, 'gs_get', self._mr._clients,
+            **self._getset._keys(path))
+        responses, winner, fail_cnt = self._getset._parse_responses(
+            gen, self._mr._read_quorum)
+        if winner[1] is None or \
+                fail_cnt > self._mr._n_servers - self._mr._read_quorum:
+            return
+        ts = float(winner[1])
+        with self._lock:
+            last = self._ts.get(path)
+            if path not in self._callbacks or last is not None and ts <= last:
+                return
+            self._ts[path] = ts
+            callbacks = list(self._callbacks[path])
+        if initial:
+            return
+        val = winner[0]
+        if self._mr._codec is not None and val is not None:
+            val = self._mr._codec.decode(val)
+        for callback in callbacks:
+            try:
+                callback(path, val)
+            except Exception as err:
+                log.warn("Watch callback failed", extra=dict(
+                    error=err, error_type=type(err).__name__, path=path,
+                    callback=callback))
+
+
+class ReadRepairer(object):
+    """
+    Heals stale servers in the background on behalf of GetSet reads.
+
+    Reads hand over the responses they got, and a background thread waits
+    for the slow servers, works out which servers are stale, coalesces
+    repairs for the same path (keeping the newest winner), and then sends
+    each stale server one batch of repairs at a time.
+    """
+    def __init__(self, getset, max_per_second=1000, interval=.05,
+                 batch_size=100):
+        """
+        `getset` - the GetSet instance whose paths we repair
+        `max_per_second` - max number of paths to repair per second
+        `interval` - seconds to wait and collect repairs before sending them
+        `batch_size` - max number of paths sent to a server in one request
+        """
+        self._getset = getset
+        self._mr = getset._mr
+        self._max_per_interval = max(1, int(max_per_second * interval))
+        self._interval = interval
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+        self._received = []  # [(path, responses, winner, pttl, t_received)]
+        self._pending = {}  # {path: [winner, pttl, t_received, clients]}
+        self._running = False
+
+    def _after_fork(self):
+        """The parent process still repairs the reads it received, and our
+        background thread did not survive the fork"""
+        self._lock = threading.Lock()
+        self._received = []
+        self._pending = {}
+        self._running = False
+
+    def add(self, path, responses, winner, pttl):
+        """Schedule a repair of `path` using the responses of a read.
+        Return immediately, even if some responses have not arrived yet"""
+        if winner[1] is None:
+            return  # without a timestamp, we cannot tell which value is new
+        with self._lock:
+            self._received.append(
+                (path, responses, winner, pttl, util.monotonic()))
+            if self._running:
+                return
+            self._running = True
+        self._mr._run_async(self._run)
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            self._coalesce()
+            with self._lock:
+                if not self._pending and not self._received:
+                    self._running = False
+                    return
+                batch = []
+                for path in list(self._pending)[:self._max_per_interval]:
+                    batch.append((path, self._pending.pop(path)))
+            try:
+                self._repair(batch)
+            except Exception as err:
+                log.warn("Failed to repair stale servers", extra=dict(
+                    error=err, error_type=type(err).__name__))
+
+    def _coalesce(self):
+        """Find the stale servers for each received read.  This waits for
+        the slow servers that reads did not wait for."""
+        with self._lock:
+            received, self._received = self._received, []
+        for path, responses, winner, pttl, t_received in received:
+            clients = set(self._getset._outdated_clients(responses, winner))
+            if not clients:
+                continue
+            with self._lock:
+                prev = self._pending.get(path)
+                if prev is None or float(prev[0][1]) < float(winner[1]):
+                    self._pending[path] = [winner, pttl, t_received, clients]
+                elif prev[0][:2] == winner[:2]:
+                    prev[3].update(clients)
+
+    def _repair(self, batch):
+        """Send each stale server the repairs it needs, in batches"""
+        by_client = defaultdict(list)
+        now = util.monotonic()
+        for path, (winner, pttl, t_received, clients) in batch:
+            val, ts = winner[0], winner[1]
+            if pttl is not None and pttl > 0:
+                pttl = int(pttl - 1000 * (now - t_received))
+                if pttl <= 0:
+                    val = None  # it expired while waiting to be repaired
+            heal = (ts, 'del' if val is None else 'set',
+                    '' if val is None else val,
+                    pttl if val is not None and pttl and pttl > 0 else '')
+            for cli in clients:
+                by_client[cli].append((path, heal))
+        list(self._mr._map_async(self._repair_client, list(by_client.items())))
+
+    def _repair_client(self, client_heals):
+        client, heals = client_heals
+        for i in range(0, len(heals), self._batch_size):
+            heal_keys, heal_args = [], []
+            for path, heal in heals[i:i + self._batch_size]:
+                keys = self._getset._keys(path)
+                heal_keys.extend((keys['path'], keys['meta']))
+                heal_args.extend(heal)
+            list(util.run_script(
+                SCRIPTS, self._mr._map_async, 'gs_heal_many', [client],
+                heal_keys=heal_keys, heals=heal_args,
+                tombstone_ttl=self._mr._getset_tombstone_ttl))
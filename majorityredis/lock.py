@@ -1,63 +1,256 @@
 import random
 import sys
+import threading
 import time
 
 from . import util
 from . import log
 from . import exceptions
 
+
+# sets server_ms to the time on the server in milliseconds.  Scripts that
+# read the clock must replicate their effects rather than the script itself.
+SERVER_TIME = """
+if redis.replicate_commands then redis.replicate_commands() end
+local t = redis.call("TIME")
+local server_ms = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+"""
+
+# returns the first live member of waiters, after removing dead ones
+FIRST_WAITER = SERVER_TIME + """
+local function first_waiter(waiters, waiting)
+  redis.call("ZREMRANGEBYSCORE", waiting, "-inf", server_ms)
+  local head = redis.call("ZRANGE", waiters, 0, 0)[1]
+  while head and not redis.call("ZSCORE", waiting, head) do
+    redis.call("ZREM", waiters, head)
+    head = redis.call("ZRANGE", waiters, 0, 0)[1]
+  end
+  return head
+end
+"""
+
 SCRIPTS = dict(
 
-    # returns 1 if locked, 0 if could not lock.
-    # return exception if invalid expireat (ie lock is already expired)
-    l_lock=dict(keys=('path', ), args=('client_id', 'expireat'), script="""
-if 1 == redis.call("SETNX", KEYS[1], ARGV[1]) then
-    if 1 == redis.call("EXPIREAT", KEYS[1], ARGV[2]) then return 1
-    else
-      redis.call("DEL", KEYS[1])
-      return {err="invalid expireat"} end
-elseif ARGV[1] == redis.call("GET", KEYS[1]) then
-    if 1 ~= redis.call("EXPIREAT", KEYS[1], ARGV[2]) then
-      redis.call("DEL", KEYS[1])
-      return {err="invalid expireat"} end
-    return 1
-else return 0 end
+    # keys:
+    # path = the lock.  a string containing the client_id of the owner
+    # fence = a counter used to generate fencing tokens for the path
+    # readers = sorted set of client_ids that hold a shared (read) lock on
+    #   the path, scored by the time on the server, in milliseconds, when
+    #   the read lock expires
+    # waiters = sorted set of clients waiting in line for the lock, scored by
+    #   arrival time on the server.  Members look like "client_id:randint".
+    #   This is also the pub/sub channel used to wake up waiters.
+    # waiting = the members of waiters, scored by the time on the server,
+    #   in milliseconds, when they stop waiting unless they are refreshed
+    #
+    # args:
+    # waiter = the member of waiters that identifies this client, or ''
+    # waiter_ttl = milliseconds that a waiter stays in line if not refreshed
+
+    # returns a fencing token (> 0) if locked, 0 if could not lock.
+    # refreshes our place in line, if waiting.
+    # return exception if invalid expiry (ie lock is already expired)
+    l_lock=dict(
+        keys=('path', 'fence', 'readers', 'waiters', 'waiting'),
+        args=('client_id', 'expire_cmd', 'expiry', 'waiter', 'waiter_ttl'),
+        script=FIRST_WAITER + """
+if "" ~= ARGV[4] then
+    redis.call("ZADD", KEYS[4], "NX", server_ms, ARGV[4])
+    redis.call("ZADD", KEYS[5], server_ms + tonumber(ARGV[5]), ARGV[4])
+end
+if ARGV[1] ~= redis.call("GET", KEYS[1]) then
+    redis.call("ZREMRANGEBYSCORE", KEYS[3], "-inf", server_ms)
+    if 0 ~= redis.call("ZCARD", KEYS[3]) then return 0 end
+    local head = first_waiter(KEYS[4], KEYS[5])
+    if head and head ~= ARGV[4] then return 0 end
+    if 1 ~= redis.call("SETNX", KEYS[1], ARGV[1]) then return 0 end
+end
+if 1 ~= redis.call(ARGV[2], KEYS[1], ARGV[3]) then
+    redis.call("DEL", KEYS[1])
+    return {err="invalid expiry"} end
+return redis.call("INCR", KEYS[2])
 """),
 
-    # returns 1 if unlocked, 0 otherwise
-    l_unlock=dict(keys=('path', ), args=('client_id', ), script="""
+    # raise the fencing counter to at least the given token.
+    # returns 1 if we still own the lock, 0 otherwise
+    l_fence=dict(keys=('path', 'fence'), args=('client_id', 'token'), script="""
+if ARGV[1] ~= redis.call("GET", KEYS[1]) then return 0 end
+if tonumber(redis.call("GET", KEYS[2]) or 0) < tonumber(ARGV[2]) then
+    redis.call("SET", KEYS[2], ARGV[2]) end
+return 1
+"""),
+
+    # returns 1 if unlocked, 0 otherwise.  wakes up the first live waiter.
+    l_unlock=dict(
+        keys=('path', 'waiters', 'waiting'), args=('client_id', ),
+        script=FIRST_WAITER + """
 local rv = redis.call("GET", KEYS[1])
 if rv == ARGV[1] then
-    return redis.call("DEL", KEYS[1])
+    rv = redis.call("DEL", KEYS[1])
+    local head = first_waiter(KEYS[2], KEYS[3])
+    if head then redis.call("PUBLISH", KEYS[2], head) end
+    return rv
 elseif rv == false then return 1
 else return 0 end
+"""),
+
+    # get in line for the lock.  returns 1
+    l_wait=dict(
+        keys=('waiters', 'waiting'), args=('waiter', 'waiter_ttl'),
+        script=SERVER_TIME + """
+redis.call("ZADD", KEYS[1], "NX", server_ms, ARGV[1])
+redis.call("ZADD", KEYS[2], server_ms + tonumber(ARGV[2]), ARGV[1])
+return 1
+"""),
+
+    # get out of line for the lock.  returns 1
+    l_unwait=dict(keys=('waiters', 'waiting'), args=('waiter', ), script="""
+redis.call("ZREM", KEYS[1], ARGV[1])
+redis.call("ZREM", KEYS[2], ARGV[1])
+return 1
 """),
 
     # returns 1 if got lock extended, 0 otherwise
     l_extend_lock=dict(
-        keys=('path', ), args=('expireat', 'client_id'), script="""
-if ARGV[2] == redis.call("GET", KEYS[1]) then
-    return redis.call("EXPIREAT", KEYS[1], ARGV[1])
+        keys=('path', ), args=('expire_cmd', 'expiry', 'client_id'), script="""
+if ARGV[3] == redis.call("GET", KEYS[1]) then
+    return redis.call(ARGV[1], KEYS[1], ARGV[2])
 else return 0 end
 """),
-)
 
+    # The *_many scripts operate on many paths at once.
+    # lock_keys = for each path: path, fence, readers, waiters, waiting
+
+    # returns a fencing token for each path if locked all of them, 0 if
+    # could not lock all of them.
+    l_lock_many=dict(
+        keys=('lock_keys', ), args=('client_id', 'expire_cmd', 'expiry'),
+        script=FIRST_WAITER + """
+for i = 1, #KEYS, 5 do
+  if ARGV[1] ~= redis.call("GET", KEYS[i]) then
+    if 1 == redis.call("EXISTS", KEYS[i]) then return 0 end
+    redis.call("ZREMRANGEBYSCORE", KEYS[i + 2], "-inf", server_ms)
+    if 0 ~= redis.call("ZCARD", KEYS[i + 2]) then return 0 end
+    if first_waiter(KEYS[i + 3], KEYS[i + 4]) then return 0 end
+  end
+end
+local tokens = {}
+for i = 1, #KEYS, 5 do
+  redis.call("SET", KEYS[i], ARGV[1])
+  if 1 ~= redis.call(ARGV[2], KEYS[i], ARGV[3]) then
+    for j = 1, i, 5 do redis.call("DEL", KEYS[j]) end
+    return {err="invalid expiry"} end
+  table.insert(tokens, redis.call("INCR", KEYS[i + 1]))
+end
+return tokens
+"""),
+
+    # raise the fencing counter of each path to at least the given token.
+    # returns 1 if we still own all the locks, 0 otherwise
+    l_fence_many=dict(
+        keys=('lock_keys', ), args=('client_id', 'tokens'), script="""
+for i = 1, #KEYS, 5 do
+  if ARGV[1] ~= redis.call("GET", KEYS[i]) then return 0 end
+end
+for i = 1, #KEYS, 5 do
+  local token = tonumber(ARGV[2 + (i - 1) / 5])
+  if tonumber(redis.call("GET", KEYS[i + 1]) or 0) < token then
+    redis.call("SET", KEYS[i + 1], token) end
+end
+return 1
+"""),
+
+    # returns 1 if unlocked all paths, 0 if someone else owns any of them.
+    # wakes up the first live waiter of each path we unlocked
+    l_unlock_many=dict(
+        keys=('lock_keys', ), args=('client_id', ), script=FIRST_WAITER + """
+local rv = 1
+for i = 1, #KEYS, 5 do
+  local owner = redis.call("GET", KEYS[i])
+  if owner == ARGV[1] then
+    redis.call("DEL", KEYS[i])
+    local head = first_waiter(KEYS[i + 3], KEYS[i + 4])
+    if head then redis.call("PUBLISH", KEYS[i + 3], head) end
+  elseif owner ~= false then rv = 0 end
+end
+return rv
+"""),
+
+    # returns 1 if extended the lock on all paths, 0 otherwise
+    l_extend_lock_many=dict(
+        keys=('lock_keys', ), args=('expire_cmd', 'expiry', 'client_id'),
+        script="""
+local rv = 1
+for i = 1, #KEYS, 5 do
+  if ARGV[3] == redis.call("GET", KEYS[i]) then
+    if 1 ~= redis.call(ARGV[1], KEYS[i], ARGV[2]) then rv = 0 end
+  else rv = 0 end
+end
+return rv
+"""),
+
+    # returns number of readers if got a read lock, 0 otherwise.
+    # readers wait behind live waiters so that writers do not starve.
+    rw_rlock=dict(
+        keys=('path', 'readers', 'waiters', 'waiting'),
+        args=('client_id', 'reader_ttl'), script=FIRST_WAITER + """
+if 1 == redis.call("EXISTS", KEYS[1]) then return 0 end
+if first_waiter(KEYS[3], KEYS[4]) then return 0 end
+redis.call("ZREMRANGEBYSCORE", KEYS[2], "-inf", server_ms)
+redis.call("ZADD", KEYS[2], server_ms + tonumber(ARGV[2]), ARGV[1])
+return redis.call("ZCARD", KEYS[2])
+"""),
+
+    # returns 1.  wakes up the first live waiter if there are no more readers
+    rw_runlock=dict(
+        keys=('readers', 'waiters', 'waiting'), args=('client_id', ),
+        script=FIRST_WAITER + """
+redis.call("ZREM", KEYS[1], ARGV[1])
+if 0 == redis.call("ZCARD", KEYS[1]) then
+  local head = first_waiter(KEYS[2], KEYS[3])
+  if head then redis.call("PUBLISH", KEYS[2], head) end
+end
+return 1
+"""),
+
+    # returns 1 if got read lock extended, 0 otherwise
+    rw_extend_rlock=dict(
+        keys=('readers', ), args=('client_id', 'reader_ttl'),
+        script=SERVER_TIME + """
+local score = redis.call("ZSCORE", KEYS[1], ARGV[1])
+if false == score or tonumber(score) <= server_ms then return 0 end
+redis.call("ZADD", KEYS[1], server_ms + tonumber(ARGV[2]), ARGV[1])
+return 1
+"""),
+)
 
 class Lock(object):
     """
     A Distributed Lock implementation for Redis.  The is a variant of the
     Redlock algorithm.
+
+    Each successful lock returns a fencing token.  Tokens for a given path
+    increase monotonically across lock holders, so downstream storage can
+    reject writes from a client whose lock has since expired.  The token
+    counter for a path is stored in the redis key, ".<path>.fence".
     """
-    def __init__(self, mr_client):
+    def __init__(self, mr_client, reentrant=False):
         """
         `mr_client` - an instance of the MajorityRedis client.
+        `reentrant` (bool) - if True, locking a path this instance already
+            holds increments a hold count and returns the current token
+            rather than failing.  The path is unlocked once unlock() is called
+            as many times as lock() succeeded.  Locks that are not extended
+            in the background are only reentered until they expire, unless
+            you call extend_lock().
         """
         self._mr = mr_client
+        self._reentrant = reentrant
+        self._holds = {}  # {(mode, path): [hold_count, lock_rv, t_expireat]}
+        self._holds_lock = threading.Lock()
         self._lock_timeout = mr_client._lock_timeout
-        if mr_client._threadsafe:
-            self._client_id = random.randint(1, sys.maxsize)
-        else:
-            self._client_id = mr_client._client_id
+        self._set_client_id()
+        mr_client._fork_handlers.add(self)
 
         if self._lock_timeout < self._mr._polling_interval:
             log.warn((
@@ -66,9 +259,23 @@ class Lock(object):
                     lock_timeout=self._lock_timeout,
                     polling_interval=self._mr._polling_interval))
 
-    def lock(self, path, wait_for=None, extend_lock=True):
+    def _set_client_id(self):
+        if self._mr._threadsafe:
+            self._client_id = random.randint(1, sys.maxsize)
+        else:
+            self._client_id = self._mr._client_id
+
+    def _after_fork(self):
+        """Locks held by the parent process belong to the parent"""
+        self._holds = {}
+        self._holds_lock = threading.Lock()
+        self._set_client_id()
+
+    def lock(self, path, wait_for=None, extend_lock=True, fair=False,
+             timeout=None):
         """
-        Attempt to lock a path on the majority of servers. Return True or False
+        Attempt to lock a path on the majority of servers.
+        Return a fencing token (a positive int) if locked, or False otherwise.
 
         `wait_for` (int) Max num seconds to wait to acquire a lock if it is
             currently not lockable (owned by someone else or too many Server
@@ -81,7 +288,24 @@ class Lock(object):
             extend_lock() before the lock times out.
             If a function, assume True and call function(h_k) if we
             ever fail to extend the lock.
+        `fair` (bool) If True and `wait_for` is given, wait in line for the
+            lock.  Clients that waited longest get the lock first, and
+            unlock() wakes up the next client in line rather than having
+            all waiters poll.
+        `timeout` (num) Max num seconds this call may take, including
+            waiting for the lock.  Servers that have not responded in time
+            are abandoned and count as failures.
         """
+        held = self._reenter(('w', path))
+        if held:
+            return held
+        # the lock expires no earlier than a lease that starts now
+        t_expireat, _ = util.get_lease(
+            self._lock_timeout, self._mr._relative_ttl)
+        deadline = util.get_deadline(timeout)
+        if wait_for and fair:
+            return self._hold(('w', path), self._lock_fair(
+                path, extend_lock, wait_for, deadline), t_expireat)
         if not wait_for:
             func = self._lock
         else:
@@ -93,13 +317,20 @@ class Lock(object):
                 if isinstance(rv, Exception):
                     return False
                 # stop retrying if got lock OR if exceeded the timeout
-                return bool(rv) or time.time() - tstart > wait_for
+                return bool(rv) or time.time() - tstart > wait_for \
+                    or util.time_left(deadline) == 0
 
             def backoff_func(prev_delay):
                 # calculate how many seconds to try to acquire lock again
                 # based on how much time we have left in ttl
                 ttlstart = time.time()
-                ttl = self._mr.ttl(path)
+                try:
+                    ttl = self._mr.ttl(
+                        path, timeout=util.time_left(deadline))
+                except exceptions.MajorityRedisException:
+                    # too many servers failed or we ran out of time.  Poll
+                    # until wait_for runs out rather than raising
+                    ttl = self._mr._polling_interval
                 if ttl == -2:
                     return 0  # node does not exist.  lockable immediately
                 elif ttl == -1:
@@ -107,6 +338,8 @@ class Lock(object):
                 # bound ttl between (0 <= ttl <= secs_left_before_timeout)
                 ttl = max(0, ttl - (time.time() - ttlstart) / 2.)
                 ttl = min(ttl, wait_for - (time.time() - tstart))
+                if deadline is not None:
+                    ttl = min(ttl, util.time_left(deadline))
                 return ttl
 
             func = util.retry_condition(
@@ -114,43 +347,315 @@ class Lock(object):
             )(
                 self._lock, condition_func)
         try:
-            return func(path, extend_lock)
+            return self._hold(
+                ('w', path), func(path, extend_lock, deadline=deadline),
+                t_expireat)
         except exceptions.TooManyRetries:
             return False
 
-    def _lock(self, path, extend_lock):
+    def _lock_fair(self, path, extend_lock, wait_for, deadline=None):
         """
-        Attempt to lock a path on the majority of servers. Return True or False
+        Get in line for the lock on all servers and try to lock the path
+        every time a server announces that the path was unlocked, until we
+        get the lock or `wait_for` seconds pass.
+        Return a fencing token or False
         """
-        t_start, t_expireat = util.get_expireat(self._lock_timeout)
-        locks = util.run_script(
+        t_deadline = time.time() + wait_for
+        if deadline is not None:
+            t_deadline = min(
+                t_deadline, time.time() + util.time_left(deadline))
+        waiter = "%s:%s" % (self._client_id, random.randint(1, sys.maxsize))
+        keys = self._keys(path)
+        # subscribe before getting in line so we cannot miss an unlock
+        wake = self._mr._waiters.add(keys['waiters'], waiter)
+        try:
+            list(util.run_script(
+                SCRIPTS, self._mr._map_async, 'l_wait', self._mr._clients,
+                deadline=deadline, waiter=waiter,
+                waiter_ttl=int(self._lock_timeout * 1000), **keys))
+            while True:
+                wake.clear()
+                # each attempt also refreshes our place in line, which
+                # expires after lock_timeout so that dead waiters leave it
+                token = self._lock(path, extend_lock, waiter, deadline)
+                secs_left = t_deadline - time.time()
+                if token or secs_left <= 0:
+                    return token
+                # if the lock expires rather than being unlocked, nobody
+                # wakes us up, so try again after at most polling_interval
+                wake.wait(min(secs_left, self._mr._polling_interval))
+        finally:
+            self._mr._waiters.remove(keys['waiters'], waiter)
+            list(util.run_script(
+                SCRIPTS, self._mr._map_async, 'l_unwait', self._mr._clients,
+                deadline=deadline, waiter=waiter, **keys))
+
+    def _lock(self, path, extend_lock, waiter='', deadline=None):
+        """
+        Attempt to lock a path on the majority of servers.
+        Return a fencing token or False
+
+        `waiter` - our place in line if waiting for the lock fairly
+        `deadline` - stop waiting for servers at this time.
+            See util.run_script
+        """
+        t_expireat, lease = util.get_lease(
+            self._lock_timeout, self._mr._relative_ttl)
+        locks = list(util.run_script(
             SCRIPTS, self._mr._map_async, 'l_lock', self._mr._clients,
-            path=path, client_id=self._client_id, expireat=t_expireat)
-        n, locked_clients = 0, []
-        for cli, is_locked in locks:
-            if is_locked == 1:
-                n += 1
-                locked_clients.append(cli)
-        if n < self._mr._n_servers // 2 + 1:
-            self.unlock(path, clients=locked_clients)
+            deadline=deadline, client_id=self._client_id, waiter=waiter,
+            waiter_ttl=int(self._lock_timeout * 1000),
+            **dict(lease, **self._keys(path))))
+        tokens = [(cli, token) for cli, token in locks
+                  if not isinstance(token, Exception) and token > 0]
+        # abandoned servers may still lock the path after we gave up on them
+        locked_clients = [cli for cli, _ in tokens] + [
+            cli for cli, token in locks
+            if isinstance(token, exceptions.Timeout)]
+        if len(tokens) < self._mr._n_servers // 2 + 1:
+            self._unlock(path, locked_clients, deadline)
+            return False
+        token = self._fence(path, tokens, deadline)
+        if not token:
+            self._unlock(path, locked_clients, deadline)
             return False
         if not util.lock_still_valid(
-                t_expireat, self._mr._clock_drift, self._mr._polling_interval):
+                t_expireat, self._mr._clock_drift, self._mr._polling_interval,
+                self._mr._relative_ttl):
             return False
         if extend_lock:
             util.continually_extend_lock_in_background(
                 path, self.extend_lock, self._mr._polling_interval,
                 self._mr._run_async, extend_lock, self._client_id)
+        return token
+
+    def _fence(self, path, tokens, deadline=None):
+        """Choose the fencing token for a lock we hold on the majority.
+
+        `tokens` - a list of (client, token) pairs from servers we locked
+
+        The token is the max of the per-server counters.  Servers whose
+        counter is behind are raised to it, so that any later lock holder,
+        which must share at least one server with our majority, receives a
+        larger token.  Return the token, or False if we could not raise
+        the counter on a majority of servers.
+        """
+        token = max(t for _, t in tokens)
+        behind = [cli for cli, t in tokens if t != token]
+        if not behind:
+            return token
+        fenced = util.run_script(
+            SCRIPTS, self._mr._map_async, 'l_fence', behind,
+            deadline=deadline, client_id=self._client_id, token=token,
+            **self._keys(path))
+        cnt = len(tokens) - len(behind) + sum(x[1] == 1 for x in fenced)
+        if cnt < self._mr._n_servers // 2 + 1:
+            return False
+        return token
+
+    def lock_many(self, paths, extend_lock=True):
+        """
+        Attempt to lock all of the given paths on the majority of servers.
+        Each server locks either all of the paths or none of them, so
+        locking many paths together cannot deadlock with another client.
+
+        Return a dict mapping each path to its fencing token if locked all
+        paths, or False otherwise.
+
+        `paths` - an iterable of at least one path to lock
+        `extend_lock` - If True, extends the locks on all paths in the
+            background until unlock_many() is called or we can no longer
+            extend them.  If a function, assume True and call
+            function(paths) if we ever fail to extend the locks.
+        """
+        paths = tuple(sorted(set(paths)))
+        if not paths:
+            raise UserWarning("Must give at least one path to lock")
+        t_expireat, lease = util.get_lease(
+            self._lock_timeout, self._mr._relative_ttl)
+        locks = util.run_script(
+            SCRIPTS, self._mr._map_async, 'l_lock_many', self._mr._clients,
+            client_id=self._client_id, lock_keys=self._many_keys(paths),
+            **lease)
+        tokens = [(cli, rv) for cli, rv in locks if isinstance(rv, tuple)]
+        locked_clients = [cli for cli, _ in tokens]
+        if len(tokens) < self._mr._n_servers // 2 + 1:
+            self._unlock_many(paths, locked_clients)
+            return False
+        path_tokens = self._fence_many(paths, tokens)
+        if not path_tokens:
+            self._unlock_many(paths, locked_clients)
+            return False
+        if not util.lock_still_valid(
+                t_expireat, self._mr._clock_drift, self._mr._polling_interval,
+                self._mr._relative_ttl):
+            return False
+        if extend_lock:
+            util.continually_extend_lock_in_background(
+                paths, self.extend_lock_many, self._mr._polling_interval,
+                self._mr._run_async, extend_lock, self._client_id)
+        return dict(zip(paths, path_tokens))
+
+    def _fence_many(self, paths, tokens):
+        """Choose the fencing token of each path for locks we hold on the
+        majority.  See _fence(...)
+
+        `tokens` - a list of (client, tokens_for_each_path) pairs
+        """
+        path_tokens = tuple(max(x) for x in zip(*(t for _, t in tokens)))
+        behind = [cli for cli, t in tokens if t != path_tokens]
+        if not behind:
+            return path_tokens
+        fenced = util.run_script(
+            SCRIPTS, self._mr._map_async, 'l_fence_many', behind,
+            client_id=self._client_id, tokens=path_tokens,
+            lock_keys=self._many_keys(paths))
+        cnt = len(tokens) - len(behind) + sum(x[1] == 1 for x in fenced)
+        if cnt < self._mr._n_servers // 2 + 1:
+            return False
+        return path_tokens
+
+    def unlock_many(self, paths):
+        """Remove the locks on all given `paths` that were created by this
+        client.  Return % of servers where all of the paths are unlocked"""
+        return self._unlock_many(tuple(sorted(set(paths))), None)
+
+    def _unlock_many(self, paths, clients):
+        clients = clients or self._mr._clients
+        locks = util.run_script(
+            SCRIPTS, self._mr._map_async, 'l_unlock_many', clients,
+            client_id=self._client_id, lock_keys=self._many_keys(paths))
+        cnt = sum(is_unlocked for _, is_unlocked in locks
+                  if not isinstance(is_unlocked, Exception))
+        util.remove_background_thread(paths, self._client_id)
+        return 100. * cnt / self._mr._n_servers
+
+    def extend_lock_many(self, paths):
+        """
+        Extend the locks on all of the given paths.  See extend_lock(...)
+
+        Returns one of the following:
+            0 if failed to extend the locks
+            the time in the future when the locks will expire
+        """
+        paths = tuple(sorted(set(paths)))
+        t_expireat, lease = util.get_lease(
+            self._lock_timeout, self._mr._relative_ttl)
+        locks = list(util.run_script(
+            SCRIPTS, self._mr._map_async, 'l_extend_lock_many',
+            self._mr._clients, client_id=self._client_id,
+            lock_keys=self._many_keys(paths), **lease))
+        cnt = sum(x[1] == 1 for x in locks)
+        if cnt < self._mr._n_servers // 2 + 1:
+            return False
+        # Re-lock the minority of servers where the locks are lost, as
+        # extend_lock(...) does
+        if util.lock_still_valid(
+                t_expireat, self._mr._clock_drift, self._mr._polling_interval,
+                self._mr._relative_ttl):
+            list(util.run_script(
+                SCRIPTS, self._mr._map_async, 'l_lock_many',
+                [x[0] for x in locks if x[1] != 1],
+                client_id=self._client_id, lock_keys=self._many_keys(paths),
+                **lease))
+        if util.lock_still_valid(
+                t_expireat, self._mr._clock_drift, self._mr._polling_interval,
+                self._mr._relative_ttl):
+            return t_expireat
+        return False
+
+    def _many_keys(self, paths):
+        """Return the redis keys used to lock all of the given paths, in the
+        order the *_many lua scripts expect"""
+        rv = []
+        for path in paths:
+            keys = self._keys(path)
+            rv.extend((keys['path'], keys['fence'], keys['readers'],
+                       keys['waiters'], keys['waiting']))
+        return rv
+
+    def _keys(self, path):
+        """Return the redis keys used to lock the given path"""
+        return dict(path=path, fence='.%s.fence' % path,
+                    readers='.%s.readers' % path,
+                    waiters='.%s.waiters' % path,
+                    waiting='.%s.waiting' % path)
+
+    def _task_id(self, mode):
+        """Identifies this client's locks of the given mode ('w' or 'r')
+        in util.BACKGROUND_TASKS, so that a read and a write lock on the
+        same path are extended independently"""
+        if mode == 'w':
+            return self._client_id
+        return (mode, self._client_id)
+
+    def _still_valid(self, mode, t_expireat):
+        return util.lock_still_valid(
+            t_expireat, self._mr._clock_drift, self._mr._polling_interval,
+            self._mr._relative_ttl)
+
+    def _reenter(self, key):
+        """If reentrant and this instance still holds the lock identified by
+        `key`, increment the hold count and return what the lock returned.
+        We trust that we still hold locks extended in the background, and
+        other locks until they expire, as extended by extend_lock()"""
+        if not self._reentrant:
+            return
+        with self._holds_lock:
+            held = self._holds.get(key)
+            if not held:
+                return
+            if (key[1], self._task_id(key[0])) in util.BACKGROUND_TASKS \
+                    or self._still_valid(key[0], held[2]):
+                held[0] += 1
+                return held[1]
+
+    def _hold(self, key, rv, t_expireat):
+        """Record that the lock identified by `key` was acquired and
+        lasts until at least `t_expireat`"""
+        if self._reentrant and rv:
+            with self._holds_lock:
+                held = self._holds.setdefault(key, [0, rv, t_expireat])
+                held[0] += 1
+                held[1:] = [rv, t_expireat]
+        return rv
+
+    def _extend_hold(self, key, t_expireat):
+        """Record that the lock identified by `key` was extended"""
+        if self._reentrant and t_expireat:
+            with self._holds_lock:
+                held = self._holds.get(key)
+                if held:
+                    held[2] = t_expireat
         return t_expireat
 
+    def _release(self, key):
+        """Decrement the hold count of the lock identified by `key`.
+        Return True if the lock should actually be released"""
+        if not self._reentrant:
+            return True
+        with self._holds_lock:
+            held = self._holds.get(key)
+            if held and held[0] > 1:
+                held[0] -= 1
+                return False
+            self._holds.pop(key, None)
+            return True
+
     def unlock(self, path, clients=None):
         """Remove the lock at given `path` as long as the lock was created
         by this client.
-        Return % of servers where this key is currently unlocked"""
+        Return % of servers where this key is currently unlocked.
+        If reentrant and the lock is still held, return 0"""
+        if not self._release(('w', path)):
+            return 0.
+        return self._unlock(path, clients)
+
+    def _unlock(self, path, clients, deadline=None):
         clients = clients or self._mr._clients
         locks = util.run_script(
             SCRIPTS, self._mr._map_async, 'l_unlock', clients,
-            path=path, client_id=self._client_id)
+            deadline=deadline, client_id=self._client_id, **self._keys(path))
         cnt = sum(is_unlocked for _, is_unlocked in locks
                   if not isinstance(is_unlocked, Exception))
         util.remove_background_thread(path, self._client_id)
@@ -164,12 +669,15 @@ class Lock(object):
 
         Returns one of the following:
             0 if failed to extend_lock
-            number of seconds since epoch in the future when lock will expire
+            the time in the future when lock will expire.  This is seconds
+            since epoch, or a time on the local monotonic clock if using
+            relative_ttl.
         """
-        t_start, t_expireat = util.get_expireat(self._lock_timeout)
+        t_expireat, lease = util.get_lease(
+            self._lock_timeout, self._mr._relative_ttl)
         locks = list(util.run_script(
             SCRIPTS, self._mr._map_async, 'l_extend_lock', self._mr._clients,
-            path=path, client_id=self._client_id, expireat=t_expireat))
+            path=path, client_id=self._client_id, **lease))
         cnt = sum(x[1] == 1 for x in locks)
         if cnt < self._mr._n_servers // 2 + 1:
             return False
@@ -181,13 +689,143 @@ class Lock(object):
         # 2b. unlock() on all
         # 2c. re-lock (via l_lock) on all
         if util.lock_still_valid(
-                t_expireat, self._mr._clock_drift, self._mr._polling_interval):
+                t_expireat, self._mr._clock_drift, self._mr._polling_interval,
+                self._mr._relative_ttl):
             # list(...) makes us block until response received from all servers
             list(util.run_script(
                 SCRIPTS, self._mr._map_async, 'l_lock',
                 [x[0] for x in locks if x[1] != 1],
-                path=path, client_id=self._client_id, expireat=t_expireat))
+                client_id=self._client_id, waiter='', waiter_ttl=0,
+                **dict(lease, **self._keys(path))))
         if util.lock_still_valid(
-                t_expireat, self._mr._clock_drift, self._mr._polling_interval):
-            return t_expireat
+                t_expireat, self._mr._clock_drift, self._mr._polling_interval,
+                self._mr._relative_ttl):
+            return self._extend_hold(('w', path), t_expireat)
+        return False
+
+
+class RWLock(Lock):
+    """
+    A Distributed Read/Write Lock.  Many clients may hold a shared read lock
+    on a path at the same time, but only one client may hold the exclusive
+    write lock, and only while nobody holds a read lock.
+
+    lock(), unlock() and extend_lock() manage the write lock exactly like
+    Lock does.  rlock(), runlock() and extend_rlock() manage read locks.
+
+    Read locks expire after lock_timeout according to each server's clock,
+    so they are safe from clock skew between clients even if not using
+    relative_ttl.  This requires redis 3.2 or later.
+    """
+
+    def _still_valid(self, mode, t_expireat):
+        if mode == 'w':
+            return super(RWLock, self)._still_valid(mode, t_expireat)
+        # read locks are leased on the local monotonic clock
+        return util.lock_still_valid(
+            t_expireat, self._mr._clock_drift, self._mr._polling_interval,
+            True)
+
+    def rlock(self, path, extend_lock=True):
+        """
+        Attempt to get a shared lock on a path on the majority of servers.
+        Return True if locked, False otherwise.
+
+        `extend_lock` - see Lock.lock(...)
+        """
+        held = self._reenter(('r', path))
+        if held:
+            return held
+        t_expireat, _ = util.get_lease(self._lock_timeout, True)
+        locks = util.run_script(
+            SCRIPTS, self._mr._map_async, 'rw_rlock', self._mr._clients,
+            client_id=self._client_id,
+            reader_ttl=int(self._lock_timeout * 1000), **self._keys(path))
+        locked_clients = [cli for cli, n in locks
+                          if not isinstance(n, Exception) and n > 0]
+        if len(locked_clients) < self._mr._n_servers // 2 + 1:
+            self._runlock(path, locked_clients)
+            return False
+        if not self._still_valid('r', t_expireat):
+            return False
+        if extend_lock:
+            util.continually_extend_lock_in_background(
+                path, self.extend_rlock, self._mr._polling_interval,
+                self._mr._run_async, extend_lock, self._task_id('r'))
+        return self._hold(('r', path), True, t_expireat)
+
+    def runlock(self, path, clients=None):
+        """Remove this client's shared lock at given `path`.
+        Return % of servers where this client no longer holds a read lock.
+        If reentrant and the read lock is still held, return 0"""
+        if not self._release(('r', path)):
+            return 0.
+        return self._runlock(path, clients)
+
+    def _runlock(self, path, clients):
+        clients = clients or self._mr._clients
+        locks = util.run_script(
+            SCRIPTS, self._mr._map_async, 'rw_runlock', clients,
+            client_id=self._client_id, **self._keys(path))
+        cnt = sum(is_unlocked for _, is_unlocked in locks
+                  if not isinstance(is_unlocked, Exception))
+        util.remove_background_thread(path, self._task_id('r'))
+        return 100. * cnt / self._mr._n_servers
+
+    def extend_rlock(self, path):
+        """
+        Extend the shared lock on given path.  See Lock.extend_lock(...)
+
+        Returns one of the following:
+            0 if failed to extend the read lock
+            the time on the local monotonic clock when the lock will expire
+        """
+        t_expireat, _ = util.get_lease(self._lock_timeout, True)
+        locks = util.run_script(
+            SCRIPTS, self._mr._map_async, 'rw_extend_rlock', self._mr._clients,
+            client_id=self._client_id,
+            reader_ttl=int(self._lock_timeout * 1000), **self._keys(path))
+        cnt = sum(x[1] == 1 for x in locks)
+        if cnt < self._mr._n_servers // 2 + 1:
+            return False
+        if self._still_valid('r', t_expireat):
+            return self._extend_hold(('r', path), t_expireat)
         return False
+
+
+class Waiters(object):
+    """
+    Wakes up clients waiting in line for a lock.  See Lock.lock(fair=True)
+
+    All waiters of a MajorityRedis client share one pubsub per server.
+    Servers announce who is first in line for a path on the path's waiters
+    channel, and we set the event of that waiter.
+    """
+    def __init__(self, mr_client):
+        self._lock = threading.Lock()
+        self._events = {}  # {waiter: event}
+        self._subscriber = util.Subscriber(mr_client, self._on_message)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._events = {}
+        self._subscriber._after_fork()
+
+    def add(self, channel, waiter):
+        """Return an event that is set whenever a server says that `waiter`
+        is first in line on `channel`"""
+        event = threading.Event()
+        with self._lock:
+            self._events[waiter] = event
+        self._subscriber.subscribe(channel)
+        return event
+
+    def remove(self, channel, waiter):
+        with self._lock:
+            self._events.pop(waiter, None)
+        self._subscriber.unsubscribe(channel)
+
+    def _on_message(self, client, channel, data):
+        event = self._events.get(util.to_str(data))
+        if event is not None:
+            event.set()
@@ -2,6 +2,8 @@
 Distributed Locking Queue for Redis adapted from the Redlock algorithm.
 """
 import random
+import re
+import redis
 import sys
 import time
 from itertools import chain
@@ -9,75 +11,190 @@ from itertools import chain
 from . import util
 from . import exceptions
 from . import log
+from .runner import Workers
 
 
+# The score of an item in the queue, Q, is priority * 2**32 + insert_time,
+# parsed from its key, h_k.  Each time an item is locked, its score is bumped
+# by 1, as if it were put a second later, so contended or failing items
+# make way for others of the same priority.  A float score has 53 bits of
+# precision, so priority is capped at MAX_PRIORITY to keep items of the same
+# priority in insert order to within half a millisecond.
+MAX_PRIORITY = 2 ** 10 - 1
+SCORE = """
+local function base_score(h_k)
+  local priority, t = string.match(h_k, "^(%-?%d+):(%d+%.?%d*):")
+  if nil == priority then return 0 end
+  return tonumber(priority) * 4294967296 + tonumber(t)
+end
+local function enqueue(Q, h_k)
+  redis.call("ZADD", Q, "NX", base_score(h_k), h_k)
+end
+local function bump(Q, h_k, n)
+  enqueue(Q, h_k)
+  redis.call("ZINCRBY", Q, n, h_k)
+end
+"""
+
+# Move up to 100 due items from the delayed set, Qd, into the queue, Q.
+# Bounding the number moved per call keeps dequeue cheap.
+PROMOTE = SCORE + """
+local function promote(Q, Qd, now)
+  local due = redis.call("ZRANGEBYSCORE", Qd, "-inf", now, "LIMIT", 0, 100)
+  for _,h_k in ipairs(due) do
+    redis.call("ZREM", Qd, h_k)
+    if "completed" ~= redis.call("GET", h_k) then
+      enqueue(Q, h_k)
+    end
+  end
+  return #due
+end
+"""
+
+# Move an item that was delivered too many times to the dead-letter set, QD
+DEAD_LETTER = """
+local function dead_letter(h_k, Q, Qd, QD, now)
+  redis.call("ZREM", Q, h_k)
+  redis.call("ZREM", Qd, h_k)
+  if false == redis.call("ZSCORE", QD, h_k) then
+    redis.call("ZADD", QD, now, h_k)
+  end
+end
+"""
+
+# The uid at the end of the key, h_k, of items put by this version
+UID = re.compile(r'^[0-9a-f]{16}$')
+
 # Lua scripts that are sent to redis
 SCRIPTS = dict(
     # keys:
-    # h_k = ordered hash of key in form:  priority:insert_time_since_epoch:key
+    # h_k = ordered hash of key in form:  priority:insert_time_since_epoch:uid
+    #       where uid is a random hex id.  Items put by older versions of
+    #       majorityredis have the item itself in place of the uid.
     # Q = sorted set of queued keys, h_k
     # Qi = sorted set mapping h_k to key for all known queued or completed items
+    # Qd = sorted set of delayed keys, h_k, scored by the time they are due
+    # Qc = hash mapping h_k to the number of times it was delivered, that is,
+    #      locked on the majority of servers by get()
+    # QD = sorted set of dead-lettered keys, h_k, scored by time of death
+    # Qp = hash mapping h_k to the item, or payload, that was put
     #
     # args:
-    # expireat = seconds_since_epoch, presumably in the future
+    # expire_cmd = EXPIREAT or PEXPIRE, the command used to expire a lock
+    # expiry = seconds_since_epoch in the future (EXPIREAT)
+    #          or milliseconds from now (PEXPIRE)
     # client_id = unique owner of the lock
     # randint = a random integer that changes every time script is called
+    # now = seconds since epoch on the client
+    # eta = seconds since epoch when a delayed item is due, or ""
+    # item = the payload that was put
+    # completed_ttl = seconds to remember that an item was completed, or ""
+    #                 to remember forever
+    # max_deliveries = number of deliveries after which an item is
+    #                  dead-lettered, or "" to never dead-letter
+    # min_score, max_score = get only items with scores in this range, as in
+    #                        ZRANGEBYSCORE
 
     # returns 1
-    lq_put=dict(keys=('Q', 'h_k'), args=(), script="""
-redis.call("ZINCRBY", KEYS[1], 0, KEYS[2])
+    lq_put=dict(
+        keys=('Q', 'h_k', 'Qd', 'Qp'), args=('eta', 'item'),
+        script=SCORE + """
+redis.call("HSET", KEYS[4], KEYS[2], ARGV[2])
+if "" ~= ARGV[1] then
+  redis.call("ZADD", KEYS[3], ARGV[1], KEYS[2])
+else
+  enqueue(KEYS[1], KEYS[2])
+end
 return 1
 """),
 
-    # returns 1 if got an item, and returns an error otherwise
-    lq_get=dict(keys=('Q', ), args=('client_id', 'expireat'), script="""
-local h_k = redis.call("ZRANGE", KEYS[1], 0, 0)[1]
+    # returns number of delayed items moved into the queue
+    lq_promote=dict(keys=('Q', 'Qd'), args=('now', ), script=PROMOTE + """
+return promote(KEYS[1], KEYS[2], ARGV[1])
+"""),
+
+    # returns {h_k, payload} if got an item, where payload is nil if not
+    # known.  returns an error otherwise
+    lq_get=dict(
+        keys=('Q', 'Qd', 'Qp'),
+        args=('client_id', 'expire_cmd', 'expiry', 'now',
+              'min_score', 'max_score'),
+        script=PROMOTE + """
+promote(KEYS[1], KEYS[2], ARGV[4])
+-- take the first of the next 100 items in the band that nobody has locked
+local h_k
+for _,k in ipairs(redis.call(
+    "ZRANGEBYSCORE", KEYS[1], ARGV[5], ARGV[6], "LIMIT", 0, 100)) do
+  local rv = redis.call("GET", k)
+  if "completed" == rv then
+    redis.call("ZREM", KEYS[1], k)
+  elseif false == rv then
+    h_k = k
+    break
+  end
+end
 if nil == h_k then return {err="queue empty"} end
-if false == redis.call("SET", h_k, ARGV[1], "NX") then
-  return {err="already locked"} end
-if 1 ~= redis.call("EXPIREAT", h_k, ARGV[2]) then
-  return {err="invalid expireat"} end
-redis.call("ZINCRBY", KEYS[1], 1, h_k)
-return h_k
+redis.call("SET", h_k, ARGV[1])
+if 1 ~= redis.call(ARGV[2], h_k, ARGV[3]) then
+  return {err="invalid expiry"} end
+bump(KEYS[1], h_k, 1)
+return {h_k, redis.call("HGET", KEYS[3], h_k)}
 """),
 
     # returns 1 if got lock. Returns an error otherwise
     lq_lock=dict(
-        keys=('h_k', 'Q'), args=('expireat', 'randint', 'client_id'), script="""
-if false == redis.call("SET", KEYS[1], ARGV[3], "NX") then  -- did not get lock
+        keys=('h_k', 'Q', 'Qd'),
+        args=('expire_cmd', 'expiry', 'randint', 'client_id'),
+        script=SCORE + """
+if false == redis.call("SET", KEYS[1], ARGV[4], "NX") then  -- did not get lock
   local rv = redis.call("GET", KEYS[1])
   if rv == "completed" then
     redis.call("ZREM", KEYS[2], KEYS[1])
     return {err="already completed"}
-  elseif rv == ARGV[3] then
-    if 1 ~= redis.call("EXPIREAT", KEYS[1], ARGV[1]) then
-      return {err="invalid expireat"} end
+  elseif rv == ARGV[4] then
+    if 1 ~= redis.call(ARGV[1], KEYS[1], ARGV[2]) then
+      return {err="invalid expiry"} end
     return 1
   else
-    local score = tonumber(redis.call("ZSCORE", KEYS[2], KEYS[1]))
-    math.randomseed(tonumber(ARGV[2]))
-    local num = math.random(math.floor(score) + 1)
+    -- the more often it was bumped, the less likely we bump it again
+    local score = redis.call("ZSCORE", KEYS[2], KEYS[1])
+    local bumps = 0
+    if score then bumps = tonumber(score) - base_score(KEYS[1]) end
+    math.randomseed(tonumber(ARGV[3]))
+    local num = math.random(math.floor(math.max(bumps, 0)) + 1)
     if num ~= 1 then
-      redis.call("ZINCRBY", KEYS[2], (num-1)/score, KEYS[1])
+      bump(KEYS[2], KEYS[1], (num-1)/bumps)
     end
     return {err="already locked"}
   end
 else
-  if 1 ~= redis.call("EXPIREAT", KEYS[1], ARGV[1]) then
-    return {err="invalid expireat"} end
-  redis.call("ZINCRBY", KEYS[2], 1, KEYS[1])
+  if 1 ~= redis.call(ARGV[1], KEYS[1], ARGV[2]) then
+    return {err="invalid expiry"} end
+  bump(KEYS[2], KEYS[1], 1)
+  redis.call("ZREM", KEYS[3], KEYS[1])  -- due here, if not yet promoted
   return 1
 end
+"""),
+
+    # counts a delivery of an item, unless it was already delivered
+    # max_deliveries times.  returns the number of earlier deliveries
+    lq_delivered=dict(
+        keys=('h_k', 'Qc'), args=('max_deliveries', ), script="""
+local n = tonumber(redis.call("HGET", KEYS[2], KEYS[1]) or 0)
+if "" == ARGV[1] or n < tonumber(ARGV[1]) then
+  redis.call("HINCRBY", KEYS[2], KEYS[1], 1)
+end
+return n
 """),
 
     # return 1 if extended lock.  Returns an error otherwise.
     # otherwise
     lq_extend_lock=dict(
-        keys=('h_k', ), args=('expireat', 'client_id'), script="""
+        keys=('h_k', ), args=('expire_cmd', 'expiry', 'client_id'), script="""
 local rv = redis.call("GET", KEYS[1])
-if ARGV[2] == rv then
-    if 1 ~= redis.call("EXPIREAT", KEYS[1], ARGV[1]) then
-      return {err="invalid expireat"} end
+if ARGV[3] == rv then
+    if 1 ~= redis.call(ARGV[1], KEYS[1], ARGV[2]) then
+      return {err="invalid expiry"} end
     return 1
 elseif "completed" == rv then return {err="already completed"}
 elseif false == rv then return {err="expired"}
@@ -86,12 +203,18 @@ else return {err="lock stolen"} end
 
     # returns 1 if removed, 0 if key was already removed.
     lq_consume=dict(
-        keys=('h_k', 'Q', 'Qi'), args=('client_id', ), script="""
+        keys=('h_k', 'Q', 'Qi', 'Qd', 'Qc', 'Qp'),
+        args=('client_id', 'completed_ttl'), script="""
 local rv = redis.pcall("GET", KEYS[1])
 if ARGV[1] == rv or "completed" == rv then
-  redis.call("SET", KEYS[1], "completed")
-  redis.call("PERSIST", KEYS[1])  -- or EXPIRE far into the future...
+  if "completed" ~= rv then
+    redis.call("SET", KEYS[1], "completed")
+    if "" ~= ARGV[2] then redis.call("EXPIRE", KEYS[1], ARGV[2]) end
+  end
   redis.call("ZREM", KEYS[2], KEYS[1])
+  redis.call("ZREM", KEYS[4], KEYS[1])
+  redis.call("HDEL", KEYS[5], KEYS[1])
+  redis.call("HDEL", KEYS[6], KEYS[1])
   if "completed" ~= rv then redis.call("INCR", KEYS[3]) end
   return 1
 else return 0 end
@@ -99,13 +222,77 @@ else return 0 end
 
     # returns nil.  markes job completed
     lq_completed=dict(
-        keys=('h_k', 'Q', 'Qi'), args=(), script="""
+        keys=('h_k', 'Q', 'Qi', 'Qd', 'Qc', 'Qp'), args=('completed_ttl', ),
+        script="""
 if "completed" ~= redis.call("GET", KEYS[1]) then
   redis.call("INCR", KEYS[3])
   redis.call("SET", KEYS[1], "completed")
-  redis.call("PERSIST", KEYS[1])  -- or EXPIRE far into the future...
+  if "" ~= ARGV[1] then redis.call("EXPIRE", KEYS[1], ARGV[1]) end
   redis.call("ZREM", KEYS[2], KEYS[1])
+  redis.call("ZREM", KEYS[4], KEYS[1])
+  redis.call("HDEL", KEYS[5], KEYS[1])
+  redis.call("HDEL", KEYS[6], KEYS[1])
+end
+"""),
+
+    # returns nil.  marks job dead-lettered unless it is completed
+    lq_dead_letter=dict(
+        keys=('h_k', 'Q', 'Qd', 'QD'), args=('now', ),
+        script=DEAD_LETTER + """
+if "completed" ~= redis.call("GET", KEYS[1]) then
+  dead_letter(KEYS[1], KEYS[2], KEYS[3], KEYS[4], ARGV[1])
+end
+"""),
+
+    # returns 1 if requeued, 0 if not dead-lettered.  Resets the deliveries
+    lq_requeue=dict(
+        keys=('h_k', 'Q', 'Qc', 'QD'), args=(), script=SCORE + """
+if 0 == redis.call("ZREM", KEYS[4], KEYS[1]) then return 0 end
+redis.call("HDEL", KEYS[3], KEYS[1])
+if "completed" ~= redis.call("GET", KEYS[1]) then
+  enqueue(KEYS[2], KEYS[1])
+end
+return 1
+"""),
+
+    # returns {h_k, time_of_death, deliveries, payload, ...} for
+    # dead-lettered items.  payload is "" if not known
+    lq_dead_letters=dict(
+        keys=('Qc', 'QD', 'Qp'), args=('start', 'stop'), script="""
+local rv = {}
+local dead = redis.call("ZRANGE", KEYS[2], ARGV[1], ARGV[2], "WITHSCORES")
+for i = 1, #dead, 2 do
+  rv[#rv + 1] = dead[i]
+  rv[#rv + 1] = dead[i + 1]
+  rv[#rv + 1] = tonumber(redis.call("HGET", KEYS[1], dead[i]) or 0)
+  rv[#rv + 1] = redis.call("HGET", KEYS[3], dead[i]) or ""
+end
+return rv
+"""),
+
+    # returns the number of "completed" tombstones, among the given keys,
+    # that were kept forever and now expire in completed_ttl seconds
+    lq_gc=dict(keys=('gc_keys', ), args=('completed_ttl', ), script="""
+local n = 0
+for _,k in ipairs(KEYS) do
+  if string.match(k, "^%-?%d+:%d+%.?%d*:") and -1 == redis.call("TTL", k)
+      and "string" == redis.call("TYPE", k).ok
+      and "completed" == redis.call("GET", k) then
+    redis.call("EXPIRE", k, ARGV[1])
+    n = n + 1
+  end
 end
+return n
+"""),
+
+    # returns the payload of an item, or nil if not known
+    lq_payload=dict(keys=('Qp', 'h_k'), args=(), script="""
+return redis.call("HGET", KEYS[1], KEYS[2])
+"""),
+
+    # returns the number of times an item was locked by a consumer
+    lq_deliveries=dict(keys=('Qc', 'h_k'), args=(), script="""
+return tonumber(redis.call("HGET", KEYS[1], KEYS[2]) or 0)
 """),
 
     # returns 1 if removed, 0 otherwise
@@ -116,17 +303,18 @@ if ARGV[1] == redis.call("GET", KEYS[1]) then
 else return 0 end
 """),
 
-    # returns number of items {(queued + taken), completed}
+    # returns number of items {(queued + taken), completed, delayed}
     # O(log(n))
     lq_qsize_fast=dict(
-        keys=('Q', 'Qi'), args=(), script="""
-return {redis.call("ZCARD", KEYS[1]), redis.call("INCRBY", KEYS[2], 0)}
+        keys=('Q', 'Qi', 'Qd'), args=(), script="""
+return {redis.call("ZCARD", KEYS[1]), redis.call("INCRBY", KEYS[2], 0),
+        redis.call("ZCARD", KEYS[3])}
 """),
 
-    # returns number of items {in_queue, taken, completed}
+    # returns number of items {in_queue, taken, completed, delayed}
     # O(n)  -- eek!
     lq_qsize_slow=dict(
-        keys=('Q', 'Qi'), args=(), script="""
+        keys=('Q', 'Qi', 'Qd'), args=(), script="""
 local taken = 0
 local queued = 0
 for _,k in ipairs(redis.call("ZRANGE", KEYS[1], 0, -1)) do
@@ -136,28 +324,35 @@ for _,k in ipairs(redis.call("ZRANGE", KEYS[1], 0, -1)) do
     else queued = queued + 1 end
   end
 end
-return {queued, taken, redis.call("INCRBY", KEYS[2], 0)}
+return {queued, taken, redis.call("INCRBY", KEYS[2], 0),
+        redis.call("ZCARD", KEYS[3])}
 """),
 
     # returns whether an item is in queue or currently being processed.
     # raises an error if already completed.
     # O(1)
     lq_is_queued_h_k=dict(
-        keys=('Q', 'h_k'), args=(), script="""
+        keys=('Q', 'h_k', 'Qd'), args=(), script="""
 local taken = redis.call("GET", KEYS[2])
 if "completed" == taken then
   return {err="already completed"}
 elseif taken then return {true, false}
-else return {false, false ~= redis.call("ZSCORE", KEYS[1], KEYS[2])} end
+else return {false, false ~= redis.call("ZSCORE", KEYS[1], KEYS[2])
+                    or false ~= redis.call("ZSCORE", KEYS[3], KEYS[2])} end
 """),
 
     # returns whether an item is in queue or currently being processed.
     # raises an error if already completed.
-    # O(N * strlen(item)) -- eek!
+    # O(N * (strlen(item) + strlen(payload))) -- eek!
     lq_is_queued_item=dict(
-        keys=('Q', 'item'), args=(), script="""
+        keys=('Q', 'item', 'Qd', 'Qp'), args=(), script="""
+local function matches(k)
+  local payload = redis.call("HGET", KEYS[4], k)
+  if payload then return payload == string.sub(KEYS[2], 2) end
+  return string.sub(k, -string.len(KEYS[2])) == KEYS[2]
+end
 for _,k in ipairs(redis.call("ZRANGE", KEYS[1], 0, -1)) do
-  if string.sub(k, -string.len(KEYS[2])) == KEYS[2] then
+  if matches(k) then
     local taken = redis.call("GET", k)
     if taken then
       if "completed" == taken then return {err="already completed"} end
@@ -166,6 +361,10 @@ for _,k in ipairs(redis.call("ZRANGE", KEYS[1], 0, -1)) do
     return {false, true} end
   end
 end
+for _,k in ipairs(redis.call("ZRANGE", KEYS[3], 0, -1)) do
+  if matches(k) then
+    return {false, true} end
+end
 return {false, false}
 """),
 
@@ -177,28 +376,52 @@ class LockingQueue(object):
     A Distributed Locking Queue implementation for Redis.
     """
 
-    def __init__(self, mr_client, queue_path):
+    def __init__(self, mr_client, queue_path, max_deliveries=None,
+                 completed_ttl=None):
         """
         `mr_client` - an instance of the MajorityRedis client.
         `queue_path` - a Redis key specifying where the queued items are
+        `max_deliveries` - if given, an item that consumers have gotten this
+            many times without consuming it is moved to a dead-letter set
+            rather than gotten again.  See dead_letters() and requeue()
+        `completed_ttl` - if given, number of seconds to remember that an
+            item was consumed.  By default, remember forever, which keeps
+            one key per consumed item on every server.
+            An item is protected from being gotten again after it was
+            consumed only within this window, so it should be much longer
+            than a redis server may be unreachable.  See gc_completed()
         """
-        if mr_client._threadsafe:
-            self._client_id = random.randint(1, sys.maxsize)
-        else:
-            self._client_id = mr_client._client_id
-
         self._mr = mr_client
         self._params = dict(
             Q=queue_path, Qi=".%s" % queue_path,
-            client_id=self._client_id)
+            Qd=".%s.delayed" % queue_path,
+            Qc=".%s.deliveries" % queue_path,
+            QD=".%s.dead" % queue_path,
+            Qp=".%s.payloads" % queue_path,
+            max_deliveries='' if max_deliveries is None else max_deliveries,
+            completed_ttl='' if completed_ttl is None else int(completed_ttl))
+        self._set_client_id()
+        mr_client._fork_handlers.add(self)
+
+    def _set_client_id(self):
+        if self._mr._threadsafe:
+            self._client_id = random.randint(1, sys.maxsize)
+        else:
+            self._client_id = self._mr._client_id
+        self._params['client_id'] = self._client_id
+
+    def _after_fork(self):
+        """Items taken by the parent process belong to the parent"""
+        self._set_client_id()
 
-    def size(self, queued=True, taken=True, completed=False):
+    def size(self, queued=True, taken=True, completed=False, delayed=False):
         """
         Return the approximate number of items in the queue, across all servers
 
         `queued` - number of items in queue that aren't being processed
         `taken` - number of items in queue that are currently being processed
         `completed` - number of items consumed from queue
+        `delayed` - number of items put with a delay that are not yet due
 
         Because we cannot lock all redis servers at the same time and we don't
         store a lock/unlock history, we cannot get the exact number of items in
@@ -208,27 +431,25 @@ class LockingQueue(object):
         the time complexity is O(n) and this can block Redis if you have
         a large queue.  Otherwise, complexity is O(log(n))
         """
-        if not queued and not taken and not completed:
+        if not queued and not taken and not completed and not delayed:
             raise UserWarning("At least one kwarg cannot be False")
         if taken == queued:
             counts = (x[1] for x in util.run_script(
                 SCRIPTS, self._mr._map_async,
                 'lq_qsize_fast', self._mr._clients, **(self._params))
                 if not isinstance(x[1], Exception))
-            if completed and taken:
-                return max(x[0] + x[1] for x in counts)
-            i = 0 if taken else 1
-            return max(x[i] for x in counts)
+            return max(
+                (x[0] if taken else 0) + (x[1] if completed else 0)
+                + (x[2] if delayed else 0) for x in counts)
 
         counts = (x[1] for x in util.run_script(
             SCRIPTS, self._mr._map_async,
             'lq_qsize_slow', self._mr._clients, **(self._params))
             if not isinstance(x[1], Exception))
         i = 0 if queued else 1
-        if completed:
-            return max(x[2] + x[i] for x in counts)
-        else:
-            return max(x[i] for x in counts)
+        return max(
+            x[i] + (x[2] if completed else 0) + (x[3] if delayed else 0)
+            for x in counts)
 
     def is_queued(self, h_k=None, item=None, taken=True, queued=True,
                   completed=False):
@@ -301,10 +522,11 @@ class LockingQueue(object):
             0 if otherwise failed to extend_lock
             number of seconds since epoch in the future when lock will expire
         """
-        _, t_expireat = util.get_expireat(self._mr._lock_timeout)
+        t_expireat, lease = util.get_lease(
+            self._mr._lock_timeout, self._mr._relative_ttl)
         locks = list(util.run_script(
             SCRIPTS, self._mr._map_async, 'lq_extend_lock', self._mr._clients,
-            h_k=h_k, expireat=t_expireat, **(self._params)))
+            h_k=h_k, **dict(lease, **self._params)))
         if not self._verify_not_already_completed(locks, h_k):
             return -1
         if not self._have_majority(locks, h_k):
@@ -316,15 +538,17 @@ class LockingQueue(object):
         # on the other hand, if we remove the list(...) call, this could create
         # a memory leak if polling_interval is too short.
         if util.lock_still_valid(
-                t_expireat, self._mr._clock_drift, self._mr._polling_interval):
+                t_expireat, self._mr._clock_drift, self._mr._polling_interval,
+                self._mr._relative_ttl):
             list(util.run_script(
                 SCRIPTS, self._mr._map_async, 'lq_lock',
                 [cli for cli, rv in locks if "%s" % rv == "expired"],
-                h_k=h_k, expireat=t_expireat, **(self._params)))
+                h_k=h_k, **dict(lease, **self._params)))
         return util.lock_still_valid(
-            t_expireat, self._mr._clock_drift, self._mr._polling_interval)
+            t_expireat, self._mr._clock_drift, self._mr._polling_interval,
+            self._mr._relative_ttl)
 
-    def consume(self, h_k):
+    def consume(self, h_k, timeout=None):
         """Remove item from queue.  Return the percentage of servers we've
         successfully removed item on.
 
@@ -335,23 +559,129 @@ class LockingQueue(object):
 
         You choose whether a return value < 50% is a failure.  You can also
         try to consume the same item twice.
+
+        `timeout` (num) Max num seconds to wait for the servers.  Servers
+            that have not responded in time are not counted as successful.
         """
         clients = self._mr._clients
         n_success = sum(
             x[1] == 1 for x in util.run_script(
                 SCRIPTS, self._mr._map_async,
-                'lq_consume', clients, h_k=h_k, **self._params))
+                'lq_consume', clients, deadline=util.get_deadline(timeout),
+                h_k=h_k, **self._params))
         util.remove_background_thread(h_k, self._client_id)
         if n_success == 0:
             raise exceptions.ConsumeError(
                 "Failed to mark the item as completed on any redis server")
         return 100. * n_success / self._mr._n_servers
 
-    def put(self, item, priority=100, retry_condition=None):
+    def release(self, h_k):
+        """Give up the lock on an item we got from the queue, so it can be
+        gotten again right away rather than after the lock times out.
+        Return the percentage of servers we've unlocked the item on.
+        """
+        util.remove_background_thread(h_k, self._client_id)
+        n_success = sum(
+            x[1] == 1 for x in util.run_script(
+                SCRIPTS, self._mr._map_async,
+                'lq_unlock', self._mr._clients, h_k=h_k, **self._params))
+        return 100. * n_success / self._mr._n_servers
+
+    def run_workers(self, handler, concurrency=1, mode='thread', retries=0,
+                    poll_interval=1, max_items=None, block=True):
+        """
+        Get items from the queue and call handler(item) on each of them,
+        keeping up to `concurrency` items in flight.  If the handler returns,
+        consume the item.  If it raises, retry it up to `retries` times and
+        then release the item so another consumer can get it.
+        If we fail to extend the lock on an item, its handler is cancelled
+        and the item is left for whoever gets it next.
+
+        `handler` - a function that receives an item.  In asyncio mode, a
+            coroutine function.
+        `concurrency` - max number of items to handle at once
+        `mode` - 'thread' runs handlers in a pool of `concurrency` threads.
+            A cancelled handler keeps running, but its item is not consumed.
+            'asyncio' runs handlers as tasks on a new event loop, and
+            cancels the task.
+        `retries` - number of times to retry a handler that raised
+        `poll_interval` - seconds to wait when the queue looks empty
+        `max_items` - if given, stop after getting this many items
+        `block` - if True, run until KeyboardInterrupt or max_items, and
+            return the metrics.  If False, run in the background and
+            return a Workers instance with stop() and metrics() methods.
+
+        Stopping lets the items in flight finish before returning.
+        """
+        workers = Workers(
+            self, handler, concurrency=concurrency, mode=mode,
+            retries=retries, poll_interval=poll_interval, max_items=max_items)
+        if block:
+            return workers.run()
+        self._mr._run_async(workers.run)
+        return workers
+
+    def deliveries(self, h_k):
+        """Return the number of times consumers have gotten the item, `h_k`,
+        according to the server that counted the most deliveries"""
+        return max([0] + [
+            rv for _, rv in util.run_script(
+                SCRIPTS, self._mr._map_async, 'lq_deliveries',
+                self._mr._clients, h_k=h_k, **self._params)
+            if not isinstance(rv, Exception)])
+
+    def dead_letters(self, start=0, stop=-1):
+        """
+        Return a list of (item, h_k, time_of_death, deliveries) for items
+        that were delivered `max_deliveries` times without being consumed,
+        oldest first, as known by any server.
+
+        `start`, `stop` - the range of dead items to fetch from each server,
+            as in ZRANGE
+        """
+        dead = {}
+        for _, rv in util.run_script(
+                SCRIPTS, self._mr._map_async, 'lq_dead_letters',
+                self._mr._clients, start=start, stop=stop, **self._params):
+            if isinstance(rv, Exception):
+                continue
+            for i in range(0, len(rv), 4):
+                h_k, t, cnt = rv[i], float(rv[i + 1]), rv[i + 2]
+                prev_t, prev_cnt, payload = dead.get(h_k, (t, cnt, rv[i + 3]))
+                dead[h_k] = (
+                    min(t, prev_t), max(cnt, prev_cnt), payload or rv[i + 3])
+        return sorted(
+            ((self._item(h_k, payload or None), h_k, t, cnt)
+             for h_k, (t, cnt, payload) in dead.items()),
+            key=lambda x: x[2])
+
+    def requeue(self, h_k):
+        """Move a dead-lettered item back into the queue and reset its count
+        of deliveries.  Return the percentage of servers it was requeued on
+        """
+        n_success = sum(
+            x[1] == 1 for x in util.run_script(
+                SCRIPTS, self._mr._map_async,
+                'lq_requeue', self._mr._clients, h_k=h_k, **self._params))
+        return 100. * n_success / self._mr._n_servers
+
+    def promote(self):
+        """Move delayed items that are due into the queue on all servers.
+        get() does this too, so call it only to keep size() accurate when
+        nobody is getting items.  Return the max number of items moved"""
+        return max([0] + [
+            rv for _, rv in util.run_script(
+                SCRIPTS, self._mr._map_async, 'lq_promote',
+                self._mr._clients, now=time.time(), **self._params)
+            if not isinstance(rv, Exception)])
+
+    def put(self, item, priority=100, retry_condition=None, delay=None,
+            eta=None, timeout=None):
         """
         Put item onto queue.  Return tuple like (%, h_k), where % is
         the percentage of servers we've successfully put to and h_k is a
-        time and priority dependent hash of the item.
+        short, time and priority dependent id of the item.  The item itself
+        is stored once per server and only sent over the network by get().
 
         If the returned percentage value is < 50, a minority of servers know
         about the item.  If those servers die, this item will be lost.  Your
@@ -362,9 +692,16 @@ class LockingQueue(object):
             this.put('a', 101, majorityredis.retry_condition(lambda x: x
 
         `item` (str) an item you wish to queue.
-        `priority` (num) an option to get this item off the queue before other
-            items.  Lower priority scores are gotten first.
-            Priority is not guaranteed.
+        `priority` (int) an option to get this item off the queue before other
+            items.  Lower priority scores are gotten first, and items of
+            the same priority are gotten in the order they were put.
+            Must be an int in [0, MAX_PRIORITY].  Priority is not guaranteed.
+
+        `delay` (num) if given, the item cannot be gotten for this many
+            seconds.
+        `eta` (num) if given, the item cannot be gotten until this time, in
+            seconds since epoch.  Items are due according to the clock of
+            the client that gets them.
 
         `retry_condition` (func) continually retry calling this function until
             we successfully put to >50% of servers or a max limit is reached.
@@ -378,22 +715,39 @@ class LockingQueue(object):
             >>> put('a', 100, retry_condition(nretry=10,
                                               backoff=lambda x: x + 1,
                                               condition=lambda x: x[0] >= 80))
+
+        `timeout` (num) Max num seconds to wait for the servers, across all
+            retries.  Servers that have not responded in time are abandoned
+            and not counted in the returned percentage.
         """
-        h_k = "%d:%f:%s" % (priority, time.time(), item)
+        if not isinstance(priority, int) or \
+                not 0 <= priority <= MAX_PRIORITY:
+            raise UserWarning(
+                "priority must be an int in [0, %s]" % MAX_PRIORITY)
+        t = time.time()
+        h_k = "%d:%f:%016x" % (priority, t, random.getrandbits(64))
+        if delay is not None:
+            eta = t + delay
+        deadline = util.get_deadline(timeout)
         if retry_condition:
-            put = retry_condition(self._put, lambda x: x[0] > 50)
+            # stop retrying once out of time
+            put = retry_condition(
+                self._put,
+                lambda x: x[0] > 50 or util.time_left(deadline) == 0)
         else:
             put = self._put
-        return put(h_k)
+        return put(h_k, item, eta, deadline)
 
-    def _put(self, h_k):
+    def _put(self, h_k, item, eta=None, deadline=None):
         rv = util.run_script(
             SCRIPTS, self._mr._map_async, 'lq_put', self._mr._clients,
-            h_k=h_k, **self._params)
+            deadline=deadline, h_k=h_k, item=item,
+            eta='' if eta is None else repr(float(eta)), **self._params)
         cnt = sum(x[1] == 1 for x in rv)
         return 100. * cnt / self._mr._n_servers, h_k
 
-    def get(self, extend_lock=True, check_all_servers=True):
+    def get(self, extend_lock=True, check_all_servers=True,
+            min_priority=None, max_priority=None, timeout=None):
         """
         Attempt to get an item from queue and obtain a lock on it to
         guarantee nobody else has a lock on this item.
@@ -415,21 +769,82 @@ class LockingQueue(object):
             obtain a lock on it.  If False and one of the servers is not
             reachable, the min. chance you will get nothing from the queue is
             1 / n_servers.  If True, we always preference the fastest response.
+        `min_priority`, `max_priority` (int) - if given, only get items put
+            with a priority in this inclusive range.
+        `timeout` (num) Max num seconds to wait for the servers, including
+            locking the item on a majority and fetching it.  Servers that
+            have not responded in time are abandoned and count as failures.
         """
-        t_start, t_expireat = util.get_expireat(self._mr._lock_timeout)
-        client, h_k = self._get_candidate_keys(t_expireat, check_all_servers)
-        if not h_k:
+        deadline = util.get_deadline(timeout)
+        t_expireat, lease = util.get_lease(
+            self._mr._lock_timeout, self._mr._relative_ttl)
+        band = dict(
+            min_score='-inf' if min_priority is None
+            else int(min_priority) * 2 ** 32,
+            max_score='+inf' if max_priority is None
+            else '(%d' % ((int(max_priority) + 1) * 2 ** 32))
+        client, candidate = self._get_candidate_keys(
+            lease, check_all_servers, band, deadline)
+        if not candidate:
             return
-        if self._acquire_lock_majority(client, h_k, t_start, t_expireat):
-            if extend_lock:
-                util.continually_extend_lock_in_background(
-                    h_k, self.extend_lock, self._mr._polling_interval,
-                    self._mr._run_async, extend_lock, self._client_id)
-            priority, insert_time, item = h_k.decode().split(':', 2)
-            return item, h_k
+        h_k = candidate[0]
+        if not self._acquire_lock_majority(
+                client, h_k, t_expireat, lease, deadline):
+            return
+        if len(candidate) > 1 and candidate[1] is not None:
+            item = self._item(h_k, candidate[1])
+        else:
+            item = self._get_payload(client, h_k, deadline)
+        if item is None:
+            return
+        if extend_lock:
+            util.continually_extend_lock_in_background(
+                h_k, self.extend_lock, self._mr._polling_interval,
+                self._mr._run_async, extend_lock, self._client_id)
+        return item, h_k
+
+    def _get_payload(self, client, h_k, deadline=None):
+        """Fetch the item put as `h_k` from the other servers, because the
+        server we got it from did not know its payload.
+        Return None, and give up our lock on the item, if the item cannot
+        be found.  If the majority of servers do not know the payload,
+        it is lost, so dead-letter the item rather than get it again"""
+        responses = list(util.run_script(
+            SCRIPTS, self._mr._map_async, 'lq_payload',
+            [x for x in self._mr._clients if x != client],
+            deadline=deadline, h_k=h_k, **self._params))
+        for _, payload in responses:
+            if payload is not None and not isinstance(payload, Exception):
+                return self._item(h_k, payload)
+        item = self._item(h_k, None)
+        if item is not None:
+            return item
+        log.error("Could not find the item that was put", extra=dict(
+            h_k=h_k))
+        self.release(h_k)
+        n_missing = 1 + sum(rv is None for _, rv in responses)
+        if n_missing >= self._mr._n_servers // 2 + 1:
+            list(util.run_script(
+                SCRIPTS, self._mr._map_async,
+                'lq_dead_letter', self._mr._clients,
+                deadline=deadline, h_k=h_k, now=time.time(), **self._params))
 
-    def _get_candidate_keys(self, t_expireat, check_all_servers):
-        """Choose one server to get an item from.  Return (client, key)
+    @staticmethod
+    def _item(h_k, payload):
+        """Return the item given its payload, or None if it is not known.
+        Items put by older versions have no payload; the item is part of
+        the key, `h_k`"""
+        if payload is not None:
+            return util.to_str(payload)
+        priority, insert_time, item = util.to_str(h_k).split(':', 2)
+        if UID.match(item):
+            return None  # put by this version, but the payload is lost
+        return item
+
+    def _get_candidate_keys(self, lease, check_all_servers, band,
+                            deadline=None):
+        """Choose one server to get an item from.
+        Return (client, (key, payload)), where payload may be None
 
         If `check_all_servers` is True, use the results from the first server
         to that returns an item.  This could be dangerous because it
@@ -444,10 +859,11 @@ class LockingQueue(object):
             clis = random.sample(self._mr._clients, 1)
         generator = util.run_script(
             SCRIPTS, self._mr._map_async,
-            'lq_get', clis, expireat=t_expireat, **self._params)
+            'lq_get', clis, deadline=deadline, now=time.time(),
+            **dict(lease, **dict(band, **self._params)))
 
         failed_candidates = []
-        winner = (None, None)
+        winner = (None, None)  # (client, (h_k, payload))
         for cclient, ch_k in generator:
             if isinstance(ch_k, Exception):
                 failed_candidates.append((cclient, ch_k))
@@ -459,10 +875,11 @@ class LockingQueue(object):
         list(util.run_script(
             SCRIPTS, self._mr._map_async,
             'lq_unlock', failed_clients,
-            h_k=ch_k, **(self._params)))
+            deadline=deadline, h_k=ch_k, **(self._params)))
         return winner
 
-    def _acquire_lock_majority(self, client, h_k, t_start, t_expireat):
+    def _acquire_lock_majority(self, client, h_k, t_expireat, lease,
+                               deadline=None):
         """We've gotten and locked an item on a single redis instance.
         Attempt to get the lock on all remaining instances, and
         handle all scenarios where we fail to acquire the lock.
@@ -472,30 +889,63 @@ class LockingQueue(object):
         locks = util.run_script(
             SCRIPTS, self._mr._map_async, 'lq_lock',
             [x for x in self._mr._clients if x != client],
-            h_k=h_k, expireat=t_expireat, **(self._params))
+            deadline=deadline, h_k=h_k, **dict(lease, **self._params))
         locks = list(locks)
         locks.append((client, 1))
-        if not self._verify_not_already_completed(locks, h_k):
+        if not self._verify_not_already_completed(locks, h_k, deadline):
             return False
-        if not self._have_majority(locks, h_k):
+        if not self._have_majority(locks, h_k, deadline):
             return False
         if not util.lock_still_valid(
-                t_expireat, self._mr._clock_drift, self._mr._polling_interval):
+                t_expireat, self._mr._clock_drift, self._mr._polling_interval,
+                self._mr._relative_ttl):
             return False
-        return True
+        return self._count_delivery(locks, h_k, deadline)
 
-    def _verify_not_already_completed(self, locks, h_k):
+    def _verify_not_already_completed(self, locks, h_k, deadline=None):
         """If any Redis server reported that the key, `h_k`, was completed,
         return False and update all servers that don't know this fact.
         """
         locks = list(locks)
         completed = ["%s" % l == "already completed" for _, l in locks]
         if any(completed):
-            self._heal_completed(h_k, locks)
+            self._heal_completed(h_k, locks, deadline)
             return False
         return True
 
-    def _have_majority(self, locks, h_k):
+    def _count_delivery(self, locks, h_k, deadline=None):
+        """We hold the lock on `h_k` on the majority of servers, so count
+        one delivery of it.  If the majority of servers agree that it was
+        already delivered max_deliveries times, give up our locks on it,
+        dead-letter it on all servers and return False.
+        """
+        gen = util.run_script(
+            SCRIPTS, self._mr._map_async, 'lq_delivered', self._mr._clients,
+            deadline=deadline, h_k=h_k, **self._params)
+        if self._params['max_deliveries'] == '':
+            self._mr._run_async(list, gen)
+            return True
+        counts = sorted(
+            (n for _, n in gen if not isinstance(n, Exception)),
+            reverse=True)
+        # the largest count that a majority of servers reached
+        quorum = self._mr._n_servers // 2 + 1
+        if len(counts) < quorum or \
+                counts[quorum - 1] < self._params['max_deliveries']:
+            return True
+        log.warn("Item was delivered too many times.  Dead-lettering it",
+                 extra=dict(h_k=h_k))
+        list(util.run_script(
+            SCRIPTS, self._mr._map_async,
+            'lq_unlock', self._locked_clients(locks),
+            deadline=deadline, h_k=h_k, **(self._params)))
+        list(util.run_script(
+            SCRIPTS, self._mr._map_async,
+            'lq_dead_letter', self._mr._clients,
+            deadline=deadline, h_k=h_k, now=time.time(), **(self._params)))
+        return False
+
+    def _have_majority(self, locks, h_k, deadline=None):
         """Evaluate whether the number of obtained is > half the number of
         redis servers.  If didn't get majority, unlock the locks we got.
 
@@ -509,12 +959,20 @@ class LockingQueue(object):
                 h_k=h_k))
             list(util.run_script(
                 SCRIPTS, self._mr._map_async,
-                'lq_unlock', [cli for cli, lock in locks if lock == 1],
-                h_k=h_k, **(self._params)))
+                'lq_unlock', self._locked_clients(locks),
+                deadline=deadline, h_k=h_k, **(self._params)))
             return False
         return True
 
-    def _heal_completed(self, h_k, client_rv):
+    @staticmethod
+    def _locked_clients(locks):
+        """Return the clients we may hold a lock on, including servers we
+        abandoned because they did not respond in time, since they may have
+        locked the item after we stopped waiting"""
+        return [cli for cli, lock in locks
+                if lock == 1 or isinstance(lock, exceptions.Timeout)]
+
+    def _heal_completed(self, h_k, client_rv, deadline=None):
         """The given item hash, `h_k`, is "completed" on at least 1 client.
         Mark it completed on the other servers that are up and not sending
         exceptions"""
@@ -523,4 +981,50 @@ class LockingQueue(object):
         list(util.run_script(
             SCRIPTS, self._mr._map_async,
             'lq_completed', clients=outdated_clients,
-            h_k=h_k, **(self._params)))
+            deadline=deadline, h_k=h_k, **(self._params)))
+
+
+def gc_completed(mr_client, completed_ttl, batch_size=500, sleep=0):
+    """
+    Find the "completed" tombstones that are remembered forever, like
+    those of items consumed before a queue had a `completed_ttl`, and expire
+    them in `completed_ttl` seconds.
+
+    This SCANs every key in the database of each server, since tombstones
+    are keyed by the item, h_k, and do not record their queue.  It applies
+    to the tombstones of all queues, and to any other key that looks like
+    an h_k and holds the string "completed".  Tombstones that already
+    expire, like those of queues with a completed_ttl, are left alone.
+    Keys are SCANned in batches of `batch_size`, so redis is never
+    blocked for long, with `sleep` seconds between batches.
+
+    Return the number of tombstones that will now expire, summed across
+    servers.
+    """
+    return sum(mr_client._map_async(
+        lambda cli: _gc_completed(
+            mr_client, cli, int(completed_ttl), batch_size, sleep),
+        mr_client._clients))
+
+
+def _gc_completed(mr_client, client, completed_ttl, batch_size, sleep):
+    n, cursor = 0, None
+    while cursor != 0:
+        try:
+            cursor, keys = client.scan(
+                cursor or 0, match='*:*:*', count=batch_size)
+        except redis.RedisError as err:
+            log.warn("Could not scan keys on redis server", extra=dict(
+                error=err, error_type=type(err).__name__,
+                redis_client=client))
+            return n
+        if not keys:
+            continue
+        for _, rv in util.run_script(
+                SCRIPTS, mr_client._map_async, 'lq_gc', [client],
+                gc_keys=keys, completed_ttl=completed_ttl):
+            if not isinstance(rv, Exception):
+                n += rv
+        if sleep:
+            time.sleep(sleep)
+    return n
@@ -0,0 +1,309 @@
+"""
+Consume a LockingQueue from many processes, so one box can use all its cores.
+
+    def get_mr():
+        return majorityredis.MajorityRedis(
+            [redis.StrictRedis(host=x, socket_timeout=.5)
+             for x in ['r1', 'r2', 'r3']], 3)
+
+    def handler(item):
+        ...
+
+    if __name__ == '__main__':
+        majorityredis.runner.run_consumers(get_mr, 'myqueue', handler)
+
+`get_mr` and `handler` are sent to the child processes, so they should be
+functions defined at the top level of a module.  Each child process builds
+its own MajorityRedis client, and therefore has its own connections,
+background threads and client id.
+
+Within a process, Workers (see LockingQueue.run_workers) handles many
+items at once with threads or asyncio.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import threading
+import time
+
+from . import exceptions
+from . import log
+
+
+class _Job(object):
+    def __init__(self, item, h_k):
+        self.item = item
+        self.h_k = h_k
+        self.cancelled = False
+        self.task = None  # the asyncio task running the handler, if any
+
+
+class Workers(object):
+    """
+    Get items from a LockingQueue and handle up to `concurrency` of them at
+    a time.  See LockingQueue.run_workers(...)
+    """
+    def __init__(self, lq, handler, concurrency=1, mode='thread', retries=0,
+                 poll_interval=1, max_items=None):
+        if mode not in ('thread', 'asyncio'):
+            raise UserWarning("mode must be 'thread' or 'asyncio'")
+        self._lq = lq
+        self._handler = handler
+        self._concurrency = concurrency
+        self._mode = mode
+        self._retries = retries
+        self._poll_interval = poll_interval
+        self._max_items = max_items
+        self._lock = threading.Lock()
+        self._in_flight = {}  # {h_k: job}
+        self._stopping = threading.Event()
+        self._stopped = threading.Event()
+        self._running = False
+        self._loop = None
+        self._tasks = set()  # asyncio tasks running handlers
+        self._t_start = None
+        self._counts = dict(
+            gotten=0, completed=0, released=0, retried=0, cancelled=0,
+            errors=0)
+
+    def metrics(self):
+        """Return a dict with the number of items in flight, the number of
+        items gotten, completed, released after failing, retried and
+        cancelled so far, the number of items we could neither consume nor
+        release, and the number of completed items per second"""
+        with self._lock:
+            rv = dict(self._counts, in_flight=len(self._in_flight))
+        elapsed = time.time() - self._t_start if self._t_start else 0
+        rv['throughput'] = rv['completed'] / elapsed if elapsed else 0.
+        return rv
+
+    def stop(self, wait=True):
+        """Stop getting new items.  If `wait`, block until the items in
+        flight are handled"""
+        with self._lock:
+            self._stopping.set()
+            running = self._running
+        if wait and running:
+            self._stopped.wait()
+
+    def run(self):
+        """Handle items until stop() is called or `max_items` were gotten.
+        Return the metrics"""
+        with self._lock:
+            stopped = self._stopping.is_set()
+            self._running = not stopped
+        if stopped:
+            return self.metrics()  # stop() was called before we started
+        self._t_start = time.time()
+        try:
+            if self._mode == 'asyncio':
+                self._run_loop()
+            else:
+                self._run_threads()
+        finally:
+            self._stopped.set()
+        return self.metrics()
+
+    def _should_stop(self):
+        if self._max_items is not None and \
+                self._counts['gotten'] >= self._max_items:
+            return True
+        return self._stopping.is_set()
+
+    def _get(self):
+        """Get an item and start tracking it.  Return a job or None"""
+        got = self._lq.get(extend_lock=self._lost_lock)
+        if got is None:
+            return
+        job = _Job(*got)
+        with self._lock:
+            self._in_flight[job.h_k] = job
+            self._counts['gotten'] += 1
+        return job
+
+    def _lost_lock(self, h_k):
+        """Called from a background thread if we could not extend the lock
+        on an item.  Another consumer may get the item now, so cancel it"""
+        with self._lock:
+            job = self._in_flight.get(h_k)
+            if job is None:
+                return  # we consumed or released it
+            job.cancelled = True
+        log.error("Lost the lock on an item.  Cancelling its handler",
+                  extra=dict(h_k=h_k))
+        if job.task is not None:
+            self._loop.call_soon_threadsafe(job.task.cancel)
+
+    def _failed(self, job, err, attempt):
+        log.warn("Handler failed", extra=dict(
+            error=err, error_type=type(err).__name__, h_k=job.h_k,
+            attempt=attempt))
+        if attempt < self._retries and not job.cancelled:
+            with self._lock:
+                self._counts['retried'] += 1
+            return True
+        return False
+
+    def _finish(self, job, ok):
+        """Consume the item if the handler succeeded, and release it if the
+        handler failed.  If we lost the lock, leave it to its new owner"""
+        with self._lock:
+            self._in_flight.pop(job.h_k, None)
+        try:
+            if job.cancelled:
+                outcome = 'cancelled'
+            elif ok:
+                outcome = 'completed'
+                try:
+                    self._lq.consume(job.h_k)
+                except exceptions.ConsumeError as err:
+                    log.error("Could not consume item", extra=dict(
+                        error=err, h_k=job.h_k))
+                    outcome = 'released'
+            else:
+                outcome = 'released'
+                self._lq.release(job.h_k)
+        except Exception as err:
+            # we run in a thread pool that would swallow the exception
+            log.error("Could not finish item.  Its lock will time out",
+                      extra=dict(error=err, error_type=type(err).__name__,
+                                 h_k=job.h_k))
+            outcome = 'errors'
+        with self._lock:
+            self._counts[outcome] += 1
+
+    def _work(self, job):
+        attempt = 0
+        while not job.cancelled:
+            try:
+                self._handler(job.item)
+            except Exception as err:
+                if self._failed(job, err, attempt):
+                    attempt += 1
+                    continue
+                return self._finish(job, False)
+            return self._finish(job, True)
+        self._finish(job, False)
+
+    def _run_threads(self):
+        tpe = ThreadPoolExecutor(self._concurrency)
+        slots = threading.Semaphore(self._concurrency)
+        try:
+            while not self._should_stop():
+                if not slots.acquire(timeout=self._poll_interval):
+                    continue
+                if self._should_stop():
+                    slots.release()
+                    break
+                job = self._get()
+                if job is None:
+                    slots.release()
+                    self._stopping.wait(self._poll_interval)
+                    continue
+                tpe.submit(self._work, job).add_done_callback(
+                    lambda _: slots.release())
+        except KeyboardInterrupt:
+            log.info("Stopping workers.  Finishing the items in flight")
+        finally:
+            tpe.shutdown(wait=True)
+
+    def _run_loop(self):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        main = loop.create_task(self._run_asyncio(loop))
+        try:
+            try:
+                loop.run_until_complete(main)
+            except KeyboardInterrupt:
+                log.info("Stopping workers.  Finishing the items in flight")
+                self._stopping.set()
+                if not main.done():
+                    loop.run_until_complete(main)
+                elif self._tasks:
+                    loop.run_until_complete(asyncio.wait(self._tasks))
+        finally:
+            loop.close()
+
+    async def _run_asyncio(self, loop):
+        import asyncio
+        self._loop = loop
+        slots = asyncio.Semaphore(self._concurrency)
+        tasks = self._tasks
+
+        async def work(job):
+            attempt = 0
+            ok = False
+            try:
+                while not job.cancelled:
+                    try:
+                        await self._handler(job.item)
+                    except asyncio.CancelledError:
+                        break
+                    except Exception as err:
+                        if self._failed(job, err, attempt):
+                            attempt += 1
+                            continue
+                        break
+                    ok = True
+                    break
+                await loop.run_in_executor(None, self._finish, job, ok)
+            finally:
+                slots.release()
+
+        try:
+            while not self._should_stop():
+                await slots.acquire()
+                if self._should_stop():
+                    slots.release()
+                    break
+                job = await loop.run_in_executor(None, self._get)
+                if job is None:
+                    slots.release()
+                    await asyncio.sleep(self._poll_interval)
+                    continue
+                job.task = loop.create_task(work(job))
+                tasks.add(job.task)
+                job.task.add_done_callback(tasks.discard)
+        finally:
+            if tasks:
+                await asyncio.wait(tasks)
+
+
+def consume_forever(get_mr, queue_path, handler, **kwargs):
+    """
+    Get items from the queue and call handler(item) on each of them.
+    If the handler returns, consume the item.  If it raises an exception,
+    release the item so another consumer can get it.
+
+    `get_mr` - a function that returns a MajorityRedis instance
+    `queue_path` - the queue to get items from
+    `handler` - a function that receives an item
+    `kwargs` - passed to LockingQueue.run_workers, like `concurrency`
+    """
+    return get_mr().LockingQueue(queue_path).run_workers(handler, **kwargs)
+
+
+def run_consumers(get_mr, queue_path, handler, processes=None, **kwargs):
+    """
+    Run consume_forever(...) in `processes` child processes, by default
+    one per cpu, and wait for them.  On KeyboardInterrupt, terminate the
+    children.  Items they were handling are gotten again once their locks
+    time out.
+
+    `kwargs` are passed to consume_forever
+    """
+    procs = [
+        multiprocessing.Process(
+            target=consume_forever, args=(get_mr, queue_path, handler),
+            kwargs=kwargs)
+        for _ in range(processes or multiprocessing.cpu_count())]
+    for proc in procs:
+        proc.daemon = True
+        proc.start()
+    try:
+        for proc in procs:
+            proc.join()
+    except KeyboardInterrupt:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.join()
@@ -0,0 +1,569 @@
+"""
+Distributed Locking Queue for Redis built on Redis Streams.
+
+StreamQueue has the same put/get/consume/extend_lock/size/is_queued API as
+LockingQueue, but rather than a lock key per item and a sorted set, each
+server keeps the items in a stream with a consumer group.  The lease on an
+item is its entry in the group's pending entries list (PEL), and a lease
+expires when the entry has been idle for lock_timeout seconds, so there
+are no lock keys to expire and size() is O(1).
+
+An item has the same stream id on every server, unless a server already
+has a larger id, and consumers must hold the item's pending entry on the
+majority of servers.  The items a client puts are gotten in the order it
+put them, and items from different clients are ordered by the time they
+were put, to within the drift between the clients' clocks.
+StreamQueue does not support priorities, delays or dead letters.
+
+Each consumer of the group is a client_id.  Consumers that hold no items
+and have been idle for longer than lock_timeout are deleted whenever an
+item is consumed or released, so the group does not grow with every
+instance and fork that ever used the queue.
+
+StreamQueue requires Redis 6.2 or later, for XAUTOCLAIM.
+"""
+import random
+import sys
+import threading
+import time
+
+from . import util
+from . import exceptions
+from . import log
+from .lockingqueue import LockingQueue
+
+
+STREAM = """
+local G = "majorityredis"
+local function create_group(Q)
+  redis.pcall("XGROUP", "CREATE", Q, G, "0", "MKSTREAM")
+end
+-- return the stream id of the item on this server, or nil
+local function locate(Q, Qids, h_k)
+  local id = redis.call("HGET", Qids, h_k)
+  if id then return id end
+  if 0 < #redis.call("XRANGE", Q, h_k, h_k) then return h_k end
+  return nil
+end
+-- add the item with stream id h_k, or with a new id if the stream
+-- already has a larger one
+local function add(Q, Qids, h_k, item)
+  local id = redis.pcall("XADD", Q, h_k, "id", h_k, "item", item)
+  if type(id) == "table" and id.err then
+    id = redis.call("XADD", Q, "*", "id", h_k, "item", item)
+    redis.call("HSET", Qids, h_k, id)
+  end
+  return id
+end
+-- return the consumer holding the pending entry and its idle ms, or nil
+local function owner(Q, id)
+  local p = redis.call("XPENDING", Q, G, id, id, 1)
+  if 0 == #p then return nil end
+  return p[1][2], tonumber(p[1][3])
+end
+local function leased(Q, id, client_id, lease_ms)
+  local o, idle = owner(Q, id)
+  return o and o ~= client_id and idle < tonumber(lease_ms)
+end
+local function remove(Q, Qids, Qdone, h_k, id, now, completed_ttl)
+  if id then
+    redis.call("XACK", Q, G, id)
+    redis.call("XDEL", Q, id)
+  end
+  redis.call("HDEL", Qids, h_k)
+  redis.call("ZADD", Qdone, "NX", now, h_k)
+  if "" ~= completed_ttl then
+    redis.call("ZREMRANGEBYSCORE", Qdone, "-inf", now - completed_ttl)
+  end
+end
+-- delete the consumers that hold no items and were idle for a lease
+local function prune_consumers(Q, lease_ms)
+  for _, c in ipairs(redis.call("XINFO", "CONSUMERS", Q, G)) do
+    local info = {}
+    for i = 1, #c, 2 do info[c[i]] = c[i + 1] end
+    if 0 == tonumber(info["pending"])
+        and tonumber(info["idle"]) >= tonumber(lease_ms) then
+      redis.call("XGROUP", "DELCONSUMER", Q, G, info["name"])
+    end
+  end
+end
+"""
+
+# Lua scripts that are sent to redis
+SCRIPTS = dict(
+    # keys:
+    # h_k = the stream id that the client chose for the item, "ms-seq"
+    # Q = stream of items.  Entries have fields "id", h_k, and "item".
+    #     Its consumer group, "majorityredis", tracks who holds each item.
+    # Qids = hash mapping h_k to the stream id of the item on this server,
+    #        for the few items that could not be added with id h_k
+    # Qdone = sorted set of completed h_k, scored by time of completion
+    # Qcur = where XAUTOCLAIM continues looking for expired leases
+    #
+    # args:
+    # client_id = the consumer that holds the lease
+    # lease_ms = number of idle milliseconds after which a lease expires
+    # now = seconds since epoch on the client
+    # completed_ttl = seconds to remember that an item was completed, or ""
+    #                 to remember forever
+
+    # returns 1
+    sq_put=dict(
+        keys=('Q', 'Qids', 'Qdone'), args=('h_k', 'item'),
+        script=STREAM + """
+create_group(KEYS[1])
+if redis.call("ZSCORE", KEYS[3], ARGV[1])
+    or locate(KEYS[1], KEYS[2], ARGV[1]) then return 1 end
+add(KEYS[1], KEYS[2], ARGV[1], ARGV[2])
+return 1
+"""),
+
+    # returns {h_k, item} and holds its lease, or nil if nothing to get
+    sq_get=dict(
+        keys=('Q', 'Qids', 'Qdone', 'Qcur'),
+        args=('client_id', 'lease_ms', 'now', 'completed_ttl'),
+        script=STREAM + """
+create_group(KEYS[1])
+local function found(e)
+  local h_k = e[2][2]
+  if redis.call("ZSCORE", KEYS[3], h_k) then
+    -- completed on the servers that this one did not hear from
+    remove(KEYS[1], KEYS[2], KEYS[3], h_k, e[1], ARGV[3], ARGV[4])
+    return nil
+  end
+  return {h_k, e[2][4]}
+end
+-- take an item whose lease expired
+local claimed = redis.call(
+  "XAUTOCLAIM", KEYS[1], G, ARGV[1], ARGV[2],
+  redis.call("GET", KEYS[4]) or "0-0", "COUNT", 1)
+redis.call("SET", KEYS[4], claimed[1])
+for _, e in ipairs(claimed[2]) do
+  if e and e[2] then
+    local rv = found(e)
+    if rv then return rv end
+  end
+end
+-- take the first of the next 100 new items.  Skip the items that other
+-- consumers hold because they got them from another server.  XAUTOCLAIM
+-- returns those once their lease expires
+local last
+for _, g in ipairs(redis.call("XINFO", "GROUPS", KEYS[1])) do
+  local info = {}
+  for i = 1, #g, 2 do info[g[i]] = g[i + 1] end
+  if G == info["name"] then last = info["last-delivered-id"] end
+end
+for _ = 1, 100 do
+  local nxt = redis.call("XRANGE", KEYS[1], "(" .. last, "+", "COUNT", 1)
+  if 0 == #nxt then return nil end
+  last = nxt[1][1]
+  if owner(KEYS[1], last) then
+    redis.call("XGROUP", "SETID", KEYS[1], G, last)
+  else
+    -- deliver it, the next new item, to us
+    redis.call("XREADGROUP", "GROUP", G, ARGV[1], "COUNT", 1,
+               "STREAMS", KEYS[1], ">")
+    local rv = found(nxt[1])
+    if rv then return rv end
+  end
+end
+return nil
+"""),
+
+    # returns 1 if got the lease, 0 if someone else holds it, or an error
+    # if the item was completed.  Adds the item if this server missed it.
+    sq_lock=dict(
+        keys=('Q', 'Qids', 'Qdone'),
+        args=('h_k', 'item', 'client_id', 'lease_ms'),
+        script=STREAM + """
+create_group(KEYS[1])
+if redis.call("ZSCORE", KEYS[3], ARGV[1]) then
+  return {err="already completed"} end
+local id = locate(KEYS[1], KEYS[2], ARGV[1])
+  or add(KEYS[1], KEYS[2], ARGV[1], ARGV[2])
+if leased(KEYS[1], id, ARGV[3], ARGV[4]) then return 0 end
+redis.call("XCLAIM", KEYS[1], G, ARGV[3], 0, id, "FORCE", "JUSTID")
+return 1
+"""),
+
+    # returns 1 if extended the lease, or an error otherwise
+    sq_extend_lock=dict(
+        keys=('Q', 'Qids', 'Qdone'), args=('h_k', 'client_id', 'lease_ms'),
+        script=STREAM + """
+if redis.call("ZSCORE", KEYS[3], ARGV[1]) then
+  return {err="already completed"} end
+local id = locate(KEYS[1], KEYS[2], ARGV[1])
+if not id then return {err="not queued"} end
+local o, idle = owner(KEYS[1], id)
+if ARGV[2] == o then
+  redis.call("XCLAIM", KEYS[1], G, ARGV[2], 0, id, "JUSTID")
+  return 1
+elseif not o or idle >= tonumber(ARGV[3]) then return {err="expired"}
+else return {err="lock stolen"} end
+"""),
+
+    # returns 1 if released the lease, 0 otherwise.  The entry is made to
+    # look idle for lease_ms, so XAUTOCLAIM returns it right away
+    sq_unlock=dict(
+        keys=('Q', 'Qids'), args=('h_k', 'client_id', 'lease_ms'),
+        script=STREAM + """
+local id = locate(KEYS[1], KEYS[2], ARGV[1])
+if not id or ARGV[2] ~= owner(KEYS[1], id) then return 0 end
+redis.call(
+  "XCLAIM", KEYS[1], G, ARGV[2], 0, id, "IDLE", ARGV[3], "JUSTID")
+prune_consumers(KEYS[1], ARGV[3])
+return 1
+"""),
+
+    # returns 1 if completed, 0 if we do not hold the lease
+    sq_consume=dict(
+        keys=('Q', 'Qids', 'Qdone'),
+        args=('h_k', 'client_id', 'now', 'completed_ttl', 'lease_ms'),
+        script=STREAM + """
+if redis.call("ZSCORE", KEYS[3], ARGV[1]) then return 1 end
+local id = locate(KEYS[1], KEYS[2], ARGV[1])
+if not id or ARGV[2] ~= owner(KEYS[1], id) then return 0 end
+remove(KEYS[1], KEYS[2], KEYS[3], ARGV[1], id, ARGV[3], ARGV[4])
+prune_consumers(KEYS[1], ARGV[5])
+return 1
+"""),
+
+    # returns 1.  marks the item completed, whoever holds it
+    sq_completed=dict(
+        keys=('Q', 'Qids', 'Qdone'),
+        args=('h_k', 'now', 'completed_ttl'),
+        script=STREAM + """
+remove(KEYS[1], KEYS[2], KEYS[3], ARGV[1],
+       locate(KEYS[1], KEYS[2], ARGV[1]), ARGV[2], ARGV[3])
+return 1
+"""),
+
+    # returns number of items {(queued + taken), taken, completed}
+    # O(1).  Items whose lease expired count as taken.
+    sq_qsize=dict(keys=('Q', 'Qdone'), args=(), script=STREAM + """
+local pending = redis.pcall("XPENDING", KEYS[1], G)
+if type(pending) == "table" and pending.err then pending = {0} end
+return {redis.call("XLEN", KEYS[1]), pending[1],
+        redis.call("ZCARD", KEYS[2])}
+"""),
+
+    # returns whether an item is {taken, queued}.
+    # raises an error if already completed.
+    # given an item rather than h_k, O(N) -- eek!
+    sq_is_queued=dict(
+        keys=('Q', 'Qids', 'Qdone'), args=('h_k', 'item', 'lease_ms'),
+        script=STREAM + """
+local function status(h_k, id)
+  if redis.call("ZSCORE", KEYS[3], h_k) then
+    return {err="already completed"} end
+  if not id then return {0, 0} end
+  local o, idle = owner(KEYS[1], id)
+  if o and idle < tonumber(ARGV[3]) then return {1, 0} end
+  return {0, 1}
+end
+if "" ~= ARGV[1] then
+  return status(ARGV[1], locate(KEYS[1], KEYS[2], ARGV[1])) end
+for _, e in ipairs(redis.call("XRANGE", KEYS[1], "-", "+")) do
+  if ARGV[2] == e[2][4] then return status(e[2][2], e[1]) end
+end
+return {0, 0}
+"""),
+)
+
+
+class StreamQueue(object):
+    """
+    A Distributed Locking Queue implementation for Redis built on Redis
+    Streams.  See the module docstring and LockingQueue.
+    """
+
+    def __init__(self, mr_client, queue_path, completed_ttl=None):
+        """
+        `mr_client` - an instance of the MajorityRedis client.
+        `queue_path` - a Redis key specifying where the stream of items is
+        `completed_ttl` - if given, number of seconds to remember that an
+            item was consumed.  By default, remember forever.
+            An item is protected from being gotten again after it was
+            consumed only within this window, so it should be much longer
+            than a redis server may be unreachable.
+        """
+        self._mr = mr_client
+        self._params = dict(
+            Q=queue_path, Qids=".%s.ids" % queue_path,
+            Qdone=".%s.completed" % queue_path,
+            Qcur=".%s.autoclaim" % queue_path,
+            lease_ms=int(mr_client._lock_timeout * 1000),
+            completed_ttl='' if completed_ttl is None else int(completed_ttl))
+        self._ids_lock = threading.Lock()
+        self._last_id = (0, 0)  # (ms, seq) of the last stream id we chose
+        self._set_client_id()
+        mr_client._fork_handlers.add(self)
+
+    def _set_client_id(self):
+        if self._mr._threadsafe:
+            self._client_id = random.randint(1, sys.maxsize)
+        else:
+            self._client_id = self._mr._client_id
+        self._params['client_id'] = self._client_id
+
+    def _after_fork(self):
+        """Items taken by the parent process belong to the parent"""
+        self._ids_lock = threading.Lock()
+        self._set_client_id()
+
+    # Workers only needs get, consume and release
+    run_workers = LockingQueue.run_workers
+
+    def size(self, queued=True, taken=True, completed=False):
+        """
+        Return the approximate number of items in the queue, across all servers
+
+        `queued` - number of items in queue that aren't being processed
+        `taken` - number of items in queue that are currently being processed
+        `completed` - number of items consumed from queue
+
+        Items whose lease expired count as taken until they are gotten again.
+        Complexity is O(1)
+        """
+        if not queued and not taken and not completed:
+            raise UserWarning("At least one kwarg cannot be False")
+        counts = [x[1] for x in util.run_script(
+            SCRIPTS, self._mr._map_async,
+            'sq_qsize', self._mr._clients, **(self._params))
+            if not isinstance(x[1], Exception)]
+        return max(
+            (x[0] - x[1] if queued else 0) + (x[1] if taken else 0)
+            + (x[2] if completed else 0) for x in counts)
+
+    def is_queued(self, h_k=None, item=None, taken=True, queued=True,
+                  completed=False):
+        """
+        Return True if item is queued on majority of servers, False otherwise
+
+        `item` - A value that we've put into the queue one or more times
+        `h_k` - the stream id that uniquely identifies a put
+
+        `queued` - item is queued but not currently being processed
+        `taken` - item is currently being processed
+        `completed` - item has been consumed from queue
+
+        If passing an item hash, `h_k`, runtime is O(log(N))
+        If passing an `item` runtime is a slow O(N), and blocks your redis
+            while running.  We return the status of the first put of the item.
+        """
+        if not taken and not queued:
+            raise UserWarning("either taken or queued must be True")
+        if not h_k and not item:
+            raise UserWarning("Must pass item or item_hash.")
+        results = list(util.run_script(
+            SCRIPTS, self._mr._map_async, 'sq_is_queued', self._mr._clients,
+            h_k=h_k or '', item='' if h_k else item, **self._params))
+        if h_k:
+            self._verify_not_already_completed(results, h_k)
+        nerrs, cnt = 0, 0
+        for cli, taken_queued in results:
+            if isinstance(taken_queued, Exception):
+                if completed and str(taken_queued) == "already completed":
+                    return True
+                nerrs += 1
+                if nerrs > self._mr._n_servers // 2:
+                    raise exceptions.NoMajority(
+                        "Too many exceptions from Redis servers")
+            elif taken and queued:
+                cnt += (taken_queued[0] == 1 or taken_queued[1] == 1)
+            elif taken:
+                cnt += taken_queued[0] == 1
+            elif queued:
+                cnt += taken_queued[1] == 1
+            if cnt > self._mr._n_servers // 2:
+                return True
+        return False
+
+    def extend_lock(self, h_k):
+        """
+        If you have received an item from the queue and wish to hold the lock
+        on it for an amount of time close to or longer than the timeout, you
+        must extend the lock!
+
+        Returns one of the following:
+            -1 if a redis server reported that the item is completed
+            0 if otherwise failed to extend_lock
+            the time on the local monotonic clock when the lock will expire
+        """
+        t_expireat = util.monotonic() + self._mr._lock_timeout
+        locks = list(util.run_script(
+            SCRIPTS, self._mr._map_async, 'sq_extend_lock', self._mr._clients,
+            h_k=h_k, **self._params))
+        if not self._verify_not_already_completed(locks, h_k):
+            return -1
+        if not self._have_majority(locks, h_k):
+            return 0
+        # Re-lease the item on servers where our lease expired
+        if self._lock_still_valid(t_expireat):
+            list(util.run_script(
+                SCRIPTS, self._mr._map_async, 'sq_lock',
+                [cli for cli, rv in locks if "%s" % rv == "expired"],
+                h_k=h_k, item='', **self._params))
+        return self._lock_still_valid(t_expireat)
+
+    def consume(self, h_k, timeout=None):
+        """Remove item from queue.  Return the percentage of servers we've
+        successfully removed item on.  See LockingQueue.consume(...)
+        """
+        n_success = sum(
+            x[1] == 1 for x in util.run_script(
+                SCRIPTS, self._mr._map_async,
+                'sq_consume', self._mr._clients,
+                deadline=util.get_deadline(timeout), h_k=h_k, now=time.time(),
+                **self._params))
+        util.remove_background_thread(h_k, self._client_id)
+        if n_success == 0:
+            raise exceptions.ConsumeError(
+                "Failed to mark the item as completed on any redis server")
+        return 100. * n_success / self._mr._n_servers
+
+    def release(self, h_k):
+        """Give up the lock on an item we got from the queue, so it can be
+        gotten again right away rather than after the lock times out.
+        Return the percentage of servers we've unlocked the item on.
+        """
+        util.remove_background_thread(h_k, self._client_id)
+        n_success = sum(
+            x[1] == 1 for x in util.run_script(
+                SCRIPTS, self._mr._map_async,
+                'sq_unlock', self._mr._clients, h_k=h_k, **self._params))
+        return 100. * n_success / self._mr._n_servers
+
+    def put(self, item, retry_condition=None, timeout=None):
+        """
+        Put item onto queue.  Return tuple like (%, h_k), where % is
+        the percentage of servers we've successfully put to and h_k is the
+        stream id of the item.  See LockingQueue.put(...)
+        """
+        h_k = self._next_id()
+        deadline = util.get_deadline(timeout)
+        if retry_condition:
+            # stop retrying once out of time
+            put = retry_condition(
+                self._put,
+                lambda x: x[0] > 50 or util.time_left(deadline) == 0)
+        else:
+            put = self._put
+        return put(h_k, item, deadline)
+
+    def _next_id(self):
+        """Return a stream id, "ms-seq", larger than the last one we chose.
+        The high bits of seq count the ids we chose in the same millisecond,
+        and its low 32 bits are random, so other clients' ids do not
+        collide with ours"""
+        with self._ids_lock:
+            ms, n = int(time.time() * 1000), 0
+            if ms <= self._last_id[0]:
+                ms, n = self._last_id[0], self._last_id[1] + 1
+            self._last_id = (ms, n)
+        return "%d-%d" % (ms, n << 32 | random.getrandbits(32))
+
+    def _put(self, h_k, item, deadline=None):
+        rv = util.run_script(
+            SCRIPTS, self._mr._map_async, 'sq_put', self._mr._clients,
+            deadline=deadline, h_k=h_k, item=item, **self._params)
+        cnt = sum(x[1] == 1 for x in rv)
+        return 100. * cnt / self._mr._n_servers, h_k
+
+    def get(self, extend_lock=True, check_all_servers=True, timeout=None):
+        """
+        Attempt to get an item from queue and obtain a lock on it to
+        guarantee nobody else has a lock on this item.
+
+        Returns an (item, h_k) or None.  See LockingQueue.get(...)
+        """
+        deadline = util.get_deadline(timeout)
+        t_expireat = util.monotonic() + self._mr._lock_timeout
+        client, got = self._get_candidate(check_all_servers, deadline)
+        if not got:
+            return
+        h_k, item = got
+        if self._acquire_lock_majority(
+                client, h_k, item, t_expireat, deadline):
+            if extend_lock:
+                util.continually_extend_lock_in_background(
+                    h_k, self.extend_lock, self._mr._polling_interval,
+                    self._mr._run_async, extend_lock, self._client_id)
+            return util.to_str(item), h_k
+
+    def _get_candidate(self, check_all_servers, deadline):
+        """Get an item from one server.  Return (client, (h_k, item))
+        The items that slower servers gave us are released in the
+        background"""
+        if check_all_servers:
+            clis = list(self._mr._clients)
+            random.shuffle(clis)
+        else:
+            clis = random.sample(self._mr._clients, 1)
+        generator = util.run_script(
+            SCRIPTS, self._mr._map_async, 'sq_get', clis,
+            deadline=deadline, now=time.time(), **self._params)
+        for client, got in generator:
+            if got and not isinstance(got, Exception):
+                self._mr._run_async(self._release_others, generator, got[0])
+                return client, got
+        return None, None
+
+    def _release_others(self, generator, h_k):
+        for client, got in generator:
+            if got and not isinstance(got, Exception) and got[0] != h_k:
+                list(util.run_script(
+                    SCRIPTS, self._mr._map_async, 'sq_unlock', [client],
+                    h_k=got[0], **self._params))
+
+    def _acquire_lock_majority(self, client, h_k, item, t_expireat,
+                               deadline=None):
+        """We've gotten and leased an item on a single redis instance.
+        Attempt to lease it on all remaining instances, and
+        handle all scenarios where we fail to acquire the lease.
+
+        Return True if acquired majority of leases, False otherwise.
+        """
+        locks = list(util.run_script(
+            SCRIPTS, self._mr._map_async, 'sq_lock',
+            [x for x in self._mr._clients if x != client],
+            deadline=deadline, h_k=h_k, item=item, **self._params))
+        locks.append((client, 1))
+        if not self._verify_not_already_completed(locks, h_k, deadline):
+            return False
+        if not self._have_majority(locks, h_k, deadline):
+            return False
+        return bool(self._lock_still_valid(t_expireat))
+
+    def _lock_still_valid(self, t_expireat):
+        # leases expire after a relative idle time, like relative_ttl locks
+        return util.lock_still_valid(
+            t_expireat, self._mr._clock_drift, self._mr._polling_interval,
+            relative_ttl=True)
+
+    def _verify_not_already_completed(self, locks, h_k, deadline=None):
+        """If any Redis server reported that the item, `h_k`, was completed,
+        return False and mark it completed on the servers that don't know.
+        """
+        if any(str(l) == "already completed" for _, l in locks):
+            list(util.run_script(
+                SCRIPTS, self._mr._map_async, 'sq_completed',
+                [cli for cli, rv in locks if not isinstance(rv, Exception)],
+                deadline=deadline, h_k=h_k, now=time.time(), **self._params))
+            return False
+        return True
+
+    def _have_majority(self, locks, h_k, deadline=None):
+        """Evaluate whether the number of leases obtained is > half the
+        number of redis servers.  If not, release the leases we got.
+        """
+        cnt = sum(x[1] == 1 for x in locks)
+        if cnt < (self._mr._n_servers // 2 + 1):
+            log.warn("Could not get majority of locks for item.", extra=dict(
+                h_k=h_k))
+            list(util.run_script(
+                SCRIPTS, self._mr._map_async, 'sq_unlock',
+                LockingQueue._locked_clients(locks),
+                deadline=deadline, h_k=h_k, **(self._params)))
+            return False
+        return True
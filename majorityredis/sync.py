@@ -0,0 +1,526 @@
+"""
+Anti-entropy sync.  Rebuild the data on a replaced (or stale) redis server
+from the majority state of the surviving servers, rather than waiting for
+clients to touch every key, lock and queued item again.
+
+From the command line:
+
+    $ python -m majorityredis.sync --n-servers 3 \
+        --source redis://r1:6379 --source redis://r2:6379 \
+        --target redis://r3:6379 --queue myqueue
+
+Or from python:
+
+    >>> majorityredis.sync.sync(mr, target_client, queues=['myqueue'])
+"""
+import argparse
+import re
+import time
+
+import redis
+
+from . import log
+from . import util
+from .getset import SCRIPTS as GETSET_SCRIPTS
+
+
+# Lua scripts that are sent to the target.  Counters only grow, so merge
+# them atomically: a client may increment them while we sync
+SCRIPTS = dict(
+    # set each counter to the larger of its value and the given count
+    # returns number of counters set
+    sync_max=dict(keys=('counters', ), args=('counts', ), script="""
+local n = 0
+for i = 1, #KEYS do
+  if tonumber(redis.call("GET", KEYS[i]) or 0) < tonumber(ARGV[i]) then
+    redis.call("SET", KEYS[i], ARGV[i])
+    n = n + 1
+  end
+end
+return n
+"""),
+
+    # set each field of a hash of counters to the larger of its value and
+    # the given count.  fields = for each field: name, count
+    # returns number of fields set
+    sync_hmax=dict(keys=('counter', ), args=('fields', ), script="""
+local n = 0
+for i = 1, #ARGV, 2 do
+  if tonumber(redis.call("HGET", KEYS[1], ARGV[i]) or 0)
+      < tonumber(ARGV[i + 1]) then
+    redis.call("HSET", KEYS[1], ARGV[i], ARGV[i + 1])
+    n = n + 1
+  end
+end
+return n
+"""),
+)
+
+
+class Throttle(object):
+    """Sleep as needed to perform at most `max_ops_per_second` operations"""
+    def __init__(self, max_ops_per_second=None):
+        self._max_ops_per_second = max_ops_per_second
+        self._t_start = time.time()
+        self._n_ops = 0
+
+    def __call__(self, n_ops):
+        if not self._max_ops_per_second:
+            return
+        self._n_ops += n_ops
+        delay = self._n_ops / float(self._max_ops_per_second) \
+            - (time.time() - self._t_start)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def sync(mr_client, target, queues=(), locks=True, getset=True,
+         batch_size=500, max_ops_per_second=None):
+    """
+    Copy the majority state of the cluster onto the `target` redis server.
+    Keys are streamed from the other servers with SCAN and ZSCAN, and
+    written to the target in pipelined batches.  Newer data already on the
+    target is kept, so it is safe to sync while clients use the cluster.
+
+    `mr_client` - a MajorityRedis instance connected to the surviving servers.
+        If its clients include the target, the target is ignored as a source.
+    `target` - a redis.StrictRedis client connected to the server to rebuild
+    `queues` - the queue_path of each LockingQueue to rebuild
+    `locks` (bool) - rebuild fencing counters and currently held locks
+    `getset` (bool) - rebuild the keys written with set, incrby and delete,
+        including conflict-free counters
+    `batch_size` - number of keys to read and write per request
+    `max_ops_per_second` - if given, throttle the sync so the servers
+        receive at most this many keys per second
+
+    Return a dict with the number of keys synced for each data structure
+    """
+    sources = [cli for cli in mr_client._clients
+               if not _same_server(cli, target)]
+    throttle = Throttle(max_ops_per_second)
+    stats = {}
+    if getset:
+        stats['getset'] = sync_getset(
+            mr_client, sources, target, batch_size, throttle)
+    if locks:
+        stats['locks'] = sync_locks(
+            mr_client, sources, target, batch_size, throttle)
+    for queue_path in queues:
+        stats['queue:%s' % queue_path] = sync_queue(
+            mr_client, sources, target, queue_path, batch_size, throttle)
+    if queues:
+        stats['completed'] = sync_completed(
+            sources, target, batch_size, throttle)
+    return stats
+
+
+def sync_getset(mr_client, sources, target, batch_size, throttle):
+    """Copy the most recently written value of each GetSet key onto target.
+    Return the number of keys examined"""
+    prefix = '%s.majorityredis_getset_meta:' % (
+        mr_client._getset_history_prefix)
+    n = 0
+    for metas in _scan(sources, prefix + '*', batch_size):
+        paths = [util.to_str(meta)[len(prefix):] for meta in metas]
+
+        def cmds(pipe):
+            for path, meta in zip(paths, metas):
+                pipe.hget(meta, 'ts')
+                pipe.get(path)
+                pipe.pttl(path)
+        winners = {}
+        for rv in _read(sources, cmds):
+            for i, path in enumerate(paths):
+                ts, val, pttl = rv[3 * i:3 * i + 3]
+                if ts is None or any(
+                        isinstance(x, Exception) for x in (ts, val, pttl)):
+                    continue
+                if path not in winners or \
+                        float(ts) > float(winners[path][0]):
+                    winners[path] = (ts, val, pttl)
+        heal_keys, heals = [], []
+        for path, (ts, val, pttl) in winners.items():
+            heal_keys.extend((path, prefix + path))
+            heals.extend((
+                ts, 'del' if val is None else 'set',
+                '' if val is None else val,
+                pttl if val is not None and pttl > 0 else ''))
+        if heal_keys:
+            _run_on_target(
+                GETSET_SCRIPTS, mr_client, 'gs_heal_many', target,
+                heal_keys=heal_keys, heals=heals,
+                tombstone_ttl=mr_client._getset_tombstone_ttl)
+        n += len(paths)
+        throttle(len(paths))
+    return n + _sync_counters(mr_client, sources, target, batch_size, throttle)
+
+
+def _sync_counters(mr_client, sources, target, batch_size, throttle):
+    """Merge the counts of each conflict-free counter onto target.
+    Return the number of counters examined"""
+    prefix = '%s.majorityredis_counter:' % (mr_client._getset_history_prefix)
+    n = 0
+    for counters in _scan(sources, prefix + '*', batch_size):
+        merged = [{} for _ in counters]
+
+        def cmds(pipe):
+            for counter in counters:
+                pipe.hgetall(counter)
+        for rv in _read(sources, cmds):
+            for cnts, merged_cnts in zip(rv, merged):
+                if isinstance(cnts, Exception):
+                    continue
+                for field, cnt in cnts.items():
+                    field = util.to_str(field)
+                    if field != 'total':
+                        merged_cnts[field] = max(
+                            int(cnt), merged_cnts.get(field, 0))
+        for counter, merged_cnts in zip(counters, merged):
+            fields = []
+            for field, cnt in merged_cnts.items():
+                fields.extend((field, cnt))
+            if fields:
+                _run_on_target(
+                    GETSET_SCRIPTS, mr_client, 'gs_counter_merge', target,
+                    counter=counter, fields=fields)
+        n += len(counters)
+        throttle(len(counters))
+    return n
+
+
+def sync_locks(mr_client, sources, target, batch_size, throttle):
+    """Copy the fencing counter, owner and readers of each lock onto target.
+    Every path that was ever locked has a fencing counter, ".<path>.fence".
+    Return the number of locks examined"""
+    quorum = mr_client._n_servers // 2 + 1
+    n = 0
+    for fences in _scan(sources, '.*.fence', batch_size):
+        paths = [util.to_str(fence)[1:-len('.fence')] for fence in fences]
+
+        def cmds(pipe):
+            for path, fence in zip(paths, fences):
+                pipe.get(fence)
+                pipe.get(path)
+                pipe.pttl(path)
+                pipe.zrange('.%s.readers' % path, 0, -1, withscores=True)
+        state = dict((path, dict(fence=0, owners={}, readers={}))
+                     for path in paths)
+        for rv in _read(sources + [target], cmds):
+            for i, path in enumerate(paths):
+                fence, owner, pttl, readers = rv[4 * i:4 * i + 4]
+                st = state[path]
+                if fence is not None and not isinstance(fence, Exception):
+                    st['fence'] = max(st['fence'], int(fence))
+                if owner is not None and not isinstance(owner, Exception) \
+                        and not isinstance(pttl, Exception) and pttl > 0:
+                    cnt, min_pttl = st['owners'].get(owner, (0, pttl))
+                    st['owners'][owner] = (cnt + 1, min(pttl, min_pttl))
+                if not isinstance(readers, Exception):
+                    for reader, score in readers:
+                        st['readers'][reader] = max(
+                            score, st['readers'].get(reader, score))
+        _run_on_target(
+            SCRIPTS, mr_client, 'sync_max', target,
+            counters=['.%s.fence' % path for path in state],
+            counts=[st['fence'] for st in state.values()])
+        pipe = target.pipeline(transaction=False)
+        for path, st in state.items():
+            for owner, (cnt, pttl) in st['owners'].items():
+                if cnt >= quorum:
+                    pipe.set(path, owner, px=pttl, nx=True)
+            for reader, score in st['readers'].items():
+                pipe.execute_command(
+                    'ZADD', '.%s.readers' % path, score, reader)
+        pipe.execute()
+        n += len(paths)
+        throttle(len(paths))
+    return n
+
+
+def sync_queue(mr_client, sources, target, queue_path, batch_size, throttle):
+    """Copy the queued, delayed, dead-lettered, taken and completed items
+    of a LockingQueue, and their counts of deliveries, onto target.
+    An item queued on any server is queued on the target unless
+    some server knows it was completed.
+    Return the number of items examined"""
+    Q, Qi = queue_path, '.%s' % queue_path
+    Qd, Qc, QD, Qp = ('.%s.%s' % (queue_path, x)
+                      for x in ('delayed', 'deliveries', 'dead', 'payloads'))
+    quorum = mr_client._n_servers // 2 + 1
+    n = 0
+    for h_ks in _zscan(sources, Q, batch_size):
+
+        def cmds(pipe):
+            for h_k in h_ks:
+                pipe.zscore(Q, h_k)
+                pipe.get(h_k)
+                pipe.pttl(h_k)
+                pipe.hget(Qp, h_k)
+        scores = {}
+        payloads = {}
+        completed = {}  # {h_k: milliseconds to remember it was completed}
+        owners = dict((h_k, {}) for h_k in h_ks)
+        for rv in _read(sources + [target], cmds):
+            for i, h_k in enumerate(h_ks):
+                score, owner, pttl, payload = rv[4 * i:4 * i + 4]
+                if score is not None and not isinstance(score, Exception):
+                    scores[h_k] = max(score, scores.get(h_k, score))
+                if payload is not None and \
+                        not isinstance(payload, Exception):
+                    payloads[h_k] = payload
+                if owner is None or isinstance(owner, Exception):
+                    continue
+                if owner == b'completed':
+                    if isinstance(pttl, Exception) or pttl < 0:
+                        pttl = float('inf')
+                    completed[h_k] = max(pttl, completed.get(h_k, 0))
+                elif not isinstance(pttl, Exception) and pttl > 0:
+                    cnt, min_pttl = owners[h_k].get(owner, (0, pttl))
+                    owners[h_k][owner] = (cnt + 1, min(pttl, min_pttl))
+        pipe = target.pipeline(transaction=False)
+        for h_k in h_ks:
+            if h_k in completed:
+                pipe.set(h_k, 'completed', px=None if completed[h_k] == float(
+                    'inf') else completed[h_k])
+                pipe.zrem(Q, h_k)
+                continue
+            if h_k not in scores:
+                continue  # consumed or promoted since we scanned it
+            pipe.execute_command('ZADD', Q, scores[h_k], h_k)
+            if h_k in payloads:
+                pipe.hset(Qp, h_k, payloads[h_k])
+            for owner, (cnt, pttl) in owners[h_k].items():
+                if cnt >= quorum:
+                    pipe.set(h_k, owner, px=pttl, nx=True)
+        pipe.execute()
+        n += len(h_ks)
+        throttle(len(h_ks))
+
+    n += _sync_zset(sources, target, Qd, Qp, batch_size, throttle)
+    n += _sync_zset(sources, target, QD, Qp, batch_size, throttle)
+    _sync_counts(mr_client, sources, target, Qc, batch_size, throttle)
+
+    n_completed = [int(rv[0] or 0) for rv in _read(
+        sources + [target], lambda pipe: pipe.get(Qi))
+        if not isinstance(rv[0], Exception)]
+    if n_completed:
+        _run_on_target(SCRIPTS, mr_client, 'sync_max', target,
+                       counters=[Qi], counts=[max(n_completed)])
+    return n
+
+
+def sync_completed(sources, target, batch_size, throttle):
+    """Copy the "completed" tombstones of LockingQueue items onto target,
+    including those of items already removed from every queue.  Tombstones
+    are shared by all queues.  Return the number of tombstones copied"""
+    h_k_re = re.compile(br'^-?\d+:\d+\.?\d*:')
+    n = 0
+    for keys in _scan(sources, '*:*:*', batch_size):
+        keys = [k for k in keys if h_k_re.match(k)]
+
+        def cmds(pipe):
+            for key in keys:
+                pipe.get(key)
+                pipe.pttl(key)
+        completed = {}  # {h_k: milliseconds to remember it was completed}
+        for rv in _read(sources + [target], cmds):
+            for i, key in enumerate(keys):
+                val, pttl = rv[2 * i:2 * i + 2]
+                if val != b'completed':
+                    continue
+                if isinstance(pttl, Exception) or pttl < 0:
+                    pttl = float('inf')
+                completed[key] = max(pttl, completed.get(key, 0))
+        pipe = target.pipeline(transaction=False)
+        for key, pttl in completed.items():
+            pipe.set(key, 'completed',
+                     px=None if pttl == float('inf') else pttl)
+        pipe.execute()
+        n += len(completed)
+        throttle(len(keys))
+    return n
+
+
+def _sync_zset(sources, target, key, payloads_key, batch_size, throttle):
+    """Copy the union of a sorted set of queue items, and their payloads,
+    onto target, except for completed items.  Members on many servers get
+    the largest score.  Return the number of members examined"""
+    n = 0
+    for h_ks in _zscan(sources, key, batch_size):
+
+        def cmds(pipe):
+            for h_k in h_ks:
+                pipe.zscore(key, h_k)
+                pipe.get(h_k)
+                pipe.pttl(h_k)
+                pipe.hget(payloads_key, h_k)
+        scores = {}
+        payloads = {}
+        completed = {}  # {h_k: milliseconds to remember it was completed}
+        for rv in _read(sources + [target], cmds):
+            for i, h_k in enumerate(h_ks):
+                score, owner, pttl, payload = rv[4 * i:4 * i + 4]
+                if score is not None and not isinstance(score, Exception):
+                    scores[h_k] = max(score, scores.get(h_k, score))
+                if payload is not None and \
+                        not isinstance(payload, Exception):
+                    payloads[h_k] = payload
+                if owner == b'completed':
+                    if isinstance(pttl, Exception) or pttl < 0:
+                        pttl = float('inf')
+                    completed[h_k] = max(pttl, completed.get(h_k, 0))
+        pipe = target.pipeline(transaction=False)
+        for h_k in h_ks:
+            if h_k in completed:
+                pipe.set(h_k, 'completed', px=None if completed[h_k] == float(
+                    'inf') else completed[h_k])
+                pipe.zrem(key, h_k)
+            elif h_k in scores:  # else removed since we scanned it
+                pipe.execute_command('ZADD', key, scores[h_k], h_k)
+                if h_k in payloads:
+                    pipe.hset(payloads_key, h_k, payloads[h_k])
+        pipe.execute()
+        n += len(h_ks)
+        throttle(len(h_ks))
+    return n
+
+
+def _sync_counts(mr_client, sources, target, key, batch_size, throttle):
+    """Copy the largest value of each field of a hash of counters"""
+    counts = {}
+    for cli in sources + [target]:
+        try:
+            for field, cnt in cli.hscan_iter(key, count=batch_size):
+                counts[field] = max(int(cnt), counts.get(field, 0))
+        except redis.RedisError as err:
+            log.warn("Could not scan hash on redis server", extra=dict(
+                error=err, error_type=type(err).__name__, redis_client=cli,
+                key=key))
+    fields = list(counts.items())
+    for i in range(0, len(fields), batch_size):
+        batch = fields[i:i + batch_size]
+        _run_on_target(
+            SCRIPTS, mr_client, 'sync_hmax', target, counter=key,
+            fields=[x for field_cnt in batch for x in field_cnt])
+        throttle(len(batch))
+
+
+def _same_server(client, other):
+    if client is other:
+        return True
+    kw1 = client.connection_pool.connection_kwargs
+    kw2 = other.connection_pool.connection_kwargs
+    return all(kw1.get(k) == kw2.get(k)
+               for k in ('host', 'port', 'db', 'path'))
+
+
+def _scan(sources, match, batch_size):
+    """Yield lists of distinct keys matching the pattern on any source"""
+    seen = set()
+    for cli in sources:
+        batch = []
+        try:
+            for key in cli.scan_iter(match=match, count=batch_size):
+                if key in seen:
+                    continue
+                seen.add(key)
+                batch.append(key)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        except redis.RedisError as err:
+            log.warn("Could not scan keys on redis server", extra=dict(
+                error=err, error_type=type(err).__name__, redis_client=cli))
+        if batch:
+            yield batch
+
+
+def _zscan(sources, key, batch_size):
+    """Yield lists of distinct members of a sorted set on any source"""
+    seen = set()
+    for cli in sources:
+        batch = []
+        try:
+            for member, _ in cli.zscan_iter(key, count=batch_size):
+                if member in seen:
+                    continue
+                seen.add(member)
+                batch.append(member)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        except redis.RedisError as err:
+            log.warn("Could not scan sorted set on redis server", extra=dict(
+                error=err, error_type=type(err).__name__, redis_client=cli,
+                key=key))
+        if batch:
+            yield batch
+
+
+def _read(clients, cmds):
+    """Run the commands that `cmds(pipeline)` adds to a pipeline on each
+    client.  Return a list of results for each client that responded"""
+    rv = []
+    for cli in clients:
+        pipe = cli.pipeline(transaction=False)
+        cmds(pipe)
+        try:
+            rv.append(pipe.execute(raise_on_error=False))
+        except redis.RedisError as err:
+            log.warn("Could not read from redis server", extra=dict(
+                error=err, error_type=type(err).__name__, redis_client=cli))
+    return rv
+
+
+def _run_on_target(scripts, mr_client, script_name, target, **kwargs):
+    for _, rv in util.run_script(
+            scripts, mr_client._map_async, script_name, [target], **kwargs):
+        if isinstance(rv, Exception):
+            raise rv
+        return rv
+
+
+def main(argv=None):
+    from .api import MajorityRedis
+    parser = argparse.ArgumentParser(description=(
+        "Rebuild a replaced redis server from the majority state of the"
+        " other servers in a MajorityRedis cluster"))
+    parser.add_argument(
+        '--source', action='append', required=True,
+        help="redis url of a surviving server.  Pass once per server")
+    parser.add_argument(
+        '--target', required=True, help="redis url of the server to rebuild")
+    parser.add_argument(
+        '--n-servers', type=int,
+        help="number of servers in the cluster, including the target."
+        "  By default, the number of sources plus one")
+    parser.add_argument(
+        '--queue', action='append', default=[],
+        help="queue_path of a LockingQueue to rebuild.  Pass once per queue")
+    parser.add_argument('--no-getset', action='store_true')
+    parser.add_argument('--no-locks', action='store_true')
+    parser.add_argument('--getset-history-prefix', default='')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--max-ops-per-second', type=int)
+    parser.add_argument('--socket-timeout', type=float, default=5)
+    ns = parser.parse_args(argv)
+
+    sources = [redis.StrictRedis.from_url(url, socket_timeout=ns.socket_timeout)
+               for url in ns.source]
+    target = redis.StrictRedis.from_url(
+        ns.target, socket_timeout=ns.socket_timeout)
+    mr = MajorityRedis(
+        sources, ns.n_servers or len(sources) + 1,
+        lock_timeout=ns.socket_timeout * 2,
+        polling_interval=ns.socket_timeout * 2,
+        getset_history_prefix=ns.getset_history_prefix)
+    stats = sync(
+        mr, target, queues=ns.queue, locks=not ns.no_locks,
+        getset=not ns.no_getset, batch_size=ns.batch_size,
+        max_ops_per_second=ns.max_ops_per_second)
+    log.info("Finished syncing redis server", extra=dict(
+        target=ns.target, **stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,13 @@
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, Future, wait
 import functools
+import os
 import random
 import redis
 import sys
+import threading
 import time
+import weakref
 
 from . import log
 from . import exceptions
@@ -16,6 +20,31 @@ SHAS = defaultdict(dict)
 
 BACKGROUND_TASKS = {}
 
+# A clock that never goes backwards
+monotonic = time.monotonic
+
+# MajorityRedis instances to reset in the child process after os.fork()
+FORK_HANDLERS = weakref.WeakSet()
+
+
+def reset_after_fork():
+    """Reset state that must not be shared between a forked child process
+    and its parent.  Threads, like those extending locks in the background,
+    do not survive a fork, and the child must use its own client ids and
+    connections.
+
+    This runs automatically in the child if python has os.register_at_fork.
+    Otherwise, call it first thing in the child process.
+    """
+    SHAS.clear()
+    BACKGROUND_TASKS.clear()
+    for obj in list(FORK_HANDLERS):
+        obj._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
 
 def continually_extend_lock_in_background(
         h_k, extend_lock, polling_interval, run_async, callback, client_id):
@@ -68,11 +97,13 @@ def remove_background_thread(h_k, client_id):
         callback(h_k)
 
 
-def lock_still_valid(t_expireat, clock_drift, polling_interval):
+def lock_still_valid(t_expireat, clock_drift, polling_interval,
+                     relative_ttl=False):
     if t_expireat < 0:
         return False
+    now = monotonic() if relative_ttl else time.time()
     secs_left = \
-        t_expireat - time.time() - clock_drift - polling_interval
+        t_expireat - now - clock_drift - polling_interval
     if secs_left < 0:
         return False
     return secs_left
@@ -83,6 +114,48 @@ def get_expireat(timeout):
     return t, int(t + timeout)
 
 
+def get_lease(timeout, relative_ttl=False):
+    """Return (t_expireat, script_params) for a lock that should last
+    `timeout` seconds.  `script_params` are the `expire_cmd` and `expiry`
+    arguments that lua scripts use to expire a lock.
+
+    By default, servers receive an absolute EXPIREAT in whole seconds and
+    t_expireat is the same number of seconds since epoch.
+    If `relative_ttl`, servers receive a PEXPIRE in milliseconds and
+    t_expireat is measured on the local monotonic clock from before the
+    request is sent, as the Redlock algorithm does.
+    """
+    if relative_ttl:
+        t_expireat = monotonic() + timeout
+        return t_expireat, dict(
+            expire_cmd='PEXPIRE', expiry=int(timeout * 1000))
+    _, t_expireat = get_expireat(timeout)
+    return t_expireat, dict(expire_cmd='EXPIREAT', expiry=t_expireat)
+
+
+def get_deadline(timeout):
+    """Return the time on the monotonic clock by which an operation given
+    `timeout` seconds must finish, or None if there is no time limit"""
+    if timeout is None:
+        return None
+    return monotonic() + timeout
+
+
+def time_left(deadline):
+    """Return the number of seconds left until `deadline`, or None if
+    there is no deadline"""
+    if deadline is None:
+        return None
+    return max(0, deadline - monotonic())
+
+
+def to_str(value):
+    """Decode bytes received from redis"""
+    if isinstance(value, bytes):
+        return value.decode()
+    return value
+
+
 def _get_sha(scripts, script_name, client):
     try:
         rv = SHAS[script_name][client]
@@ -125,13 +198,232 @@ def _run_script(scripts, script_name, client, keys, args):
         return (client, err)
 
 
-def run_script(scripts, map_async, script_name, clients, **kwargs):
-    keys = [kwargs[x] for x in scripts[script_name]['keys']]
-    args = [kwargs[x] if x != 'randint' else random.randint(1, sys.maxsize)
-            for x in scripts[script_name]['args']]
-    return map_async(
-        lambda client: _run_script(scripts, script_name, client, keys, args),
-        clients)
+def _script_params(names, kwargs):
+    """Return the values of the named script parameters.
+    A parameter given as a list or tuple is expanded into many values"""
+    rv = []
+    for x in names:
+        val = kwargs[x] if x != 'randint' else random.randint(1, sys.maxsize)
+        if isinstance(val, (list, tuple)):
+            rv.extend(val)
+        else:
+            rv.append(val)
+    return rv
+
+
+def run_script(scripts, map_async, script_name, clients, deadline=None,
+               **kwargs):
+    """Run a lua script on each of the `clients`.  Return a generator of
+    (client, return_value) pairs, where return_value may be an exception.
+
+    `deadline` - if given, a time on the monotonic clock (see get_deadline)
+        after which we stop waiting for servers.  Servers that have not
+        responded by then are abandoned: the request still runs in the
+        background, but its client is yielded with an exceptions.Timeout.
+        This requires `map_async` to start its work when called, not when
+        its results are iterated.
+    """
+    keys = _script_params(scripts[script_name]['keys'], kwargs)
+    args = _script_params(scripts[script_name]['args'], kwargs)
+    if deadline is None:
+        return map_async(
+            lambda client: _run_script(
+                scripts, script_name, client, keys, args),
+            clients)
+    clients = list(clients)
+    futures = [Future() for _ in clients]
+
+    def _run(client, future):
+        future.set_result(
+            _run_script(scripts, script_name, client, keys, args))
+    # map_async starts the requests; we wait on the futures, not the map,
+    # so that we can stop waiting at the deadline no matter how map blocks
+    map_async(_run, clients, futures)
+    return _until_deadline(futures, clients, deadline)
+
+
+def _until_deadline(futures, clients, deadline):
+    """Yield the (client, rv) pair of each future as it completes, and an
+    exceptions.Timeout for each client that has not responded by the
+    `deadline`"""
+    pending = set(futures)
+    while pending:
+        done, pending = wait(
+            pending, timeout=max(0, deadline - monotonic()),
+            return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            yield future.result()
+    for client, future in zip(clients, futures):
+        if future in pending:
+            yield (client, exceptions.Timeout(
+                "Abandoned redis server that did not respond in time"))
+
+
+class CoalescingClient(object):
+    """
+    Wraps a redis client so that the EVALSHA calls concurrent threads make
+    within `window` seconds of each other are sent to the server as one
+    pipeline.  Under high concurrency, this trades a little latency for far
+    fewer round trips and syscalls.  All other commands go straight to the
+    wrapped client.
+
+    The first caller of a batch waits `window` seconds, sends the batch and
+    hands each caller its response.
+    """
+    def __init__(self, client, window=.0002, max_batch_size=500):
+        self._client = client
+        self._window = window
+        self._max_batch_size = max_batch_size
+        self._lock = threading.Lock()
+        self._pending = []  # [(args, future)]
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self._client)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def evalsha(self, *args):
+        future = Future()
+        with self._lock:
+            self._pending.append((args, future))
+            leader = len(self._pending) == 1
+        if leader:
+            time.sleep(self._window)
+            while self._flush():
+                pass
+        return future.result()
+
+    def _flush(self):
+        """Send up to max_batch_size pending calls.  Return True if more
+        calls are pending"""
+        with self._lock:
+            batch = self._pending[:self._max_batch_size]
+            self._pending = self._pending[self._max_batch_size:]
+            more = bool(self._pending)
+        try:
+            pipe = self._client.pipeline(transaction=False)
+            for args, _ in batch:
+                pipe.evalsha(*args)
+            results = pipe.execute(raise_on_error=False)
+        except Exception as err:
+            # every caller in the batch waits on its future, so never leave
+            # one unresolved
+            results = [err] * len(batch)
+        for (_, future), rv in zip(batch, results):
+            if isinstance(rv, Exception):
+                future.set_exception(rv)
+            else:
+                future.set_result(rv)
+        return more
+
+
+class Subscriber(object):
+    """
+    Keeps one pubsub per server, subscribed to every channel that callers
+    currently subscribe to, and a background thread per server that hands
+    each message to `on_message(client, channel, data)`.
+
+    A PubSub is not thread-safe, so callers only change the set of wanted
+    channels, and each server's background thread is the only code that
+    touches its pubsub.  It subscribes to the wanted channels between
+    messages, and subscribes again to servers that were down.
+    `on_error(client)`, if given, is called after the connection to a server
+    fails, since messages may have been missed while it was down.
+    """
+    # seconds a background thread waits for a message before it applies
+    # changes to the wanted channels
+    poll_interval = .05
+
+    def __init__(self, mr_client, on_message, on_error=None):
+        self._mr = mr_client
+        self._on_message = on_message
+        self._on_error = on_error
+        self._after_fork()
+
+    def _after_fork(self):
+        """Our listening threads and connections belong to the parent"""
+        self._lock = threading.Condition()
+        self._channels = {}  # {channel: number of subscribers}
+        self._pubsubs = {}  # {client: pubsub}
+        self._subscribed = {}  # {client: channels, or None if failing}
+
+    def subscribe(self, channel):
+        """Subscribe to channel.  Return once every server that is up has
+        subscribed, or after polling_interval"""
+        t_deadline = monotonic() + self._mr._polling_interval
+        with self._lock:
+            self._channels[channel] = self._channels.get(channel, 0) + 1
+            new = [cli for cli in self._mr._clients
+                   if cli not in self._pubsubs]
+            for cli in new:
+                self._pubsubs[cli] = cli.pubsub(ignore_subscribe_messages=True)
+                self._subscribed[cli] = set()
+                self._mr._run_async(self._listen, cli, self._pubsubs[cli])
+            while not all(
+                    chans is None or channel in chans
+                    for chans in self._subscribed.values()):
+                secs_left = t_deadline - monotonic()
+                if secs_left <= 0:
+                    break
+                self._lock.wait(secs_left)
+
+    def unsubscribe(self, channel):
+        with self._lock:
+            n = self._channels.pop(channel, 0) - 1
+            if n > 0:
+                self._channels[channel] = n
+
+    def _resubscribe(self, client, pubsub):
+        """Subscribe to the channels that pubsub is missing, and
+        unsubscribe from those nobody wants anymore"""
+        with self._lock:
+            wanted = set(self._channels)
+        subscribed = set(to_str(c) for c in pubsub.channels)
+        if wanted - subscribed:
+            pubsub.subscribe(*(wanted - subscribed))
+        if subscribed - wanted:
+            pubsub.unsubscribe(*(subscribed - wanted))
+        with self._lock:
+            self._subscribed[client] = wanted
+            self._lock.notify_all()
+
+    def _listen(self, client, pubsub):
+        timeout = min(1, self._mr._polling_interval)
+        while self._pubsubs.get(client) is pubsub:
+            try:
+                self._resubscribe(client, pubsub)
+                msg = pubsub.get_message(timeout=self.poll_interval)
+            except Exception as err:
+                log.warn("Error listening to redis server", extra=dict(
+                    error=err, error_type=type(err).__name__,
+                    redis_client=client))
+                with self._lock:
+                    self._subscribed[client] = None
+                    self._lock.notify_all()
+                time.sleep(timeout)
+                if self._on_error is not None:
+                    self._handle(self._on_error, client)
+                continue
+            if msg is None or msg['type'] != 'message':
+                continue
+            self._handle(
+                self._on_message, client, to_str(msg['channel']), msg['data'])
+        pubsub.close()
+
+    def _handle(self, func, client, *args):
+        try:
+            func(client, *args)
+        except Exception as err:
+            log.warn("Failed to handle pubsub message", extra=dict(
+                error=err, error_type=type(err).__name__,
+                redis_client=client))
 
 
 def retry_condition(
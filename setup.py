@@ -1,10 +1,4 @@
-try:
-    from distutils.core import setup  # , Extension
-    from setuptools import find_packages
-except ImportError:
-    print ("Please install Distutils and setuptools"
-           " before installing this package")
-    raise
+from setuptools import setup, find_packages
 
 setup(
     name='majorityredis',
@@ -20,10 +14,10 @@ setup(
     url='https://github.com/adgaudio/majorityredis',
 
     packages=find_packages(),
+    python_requires='>=3.5',
     install_requires=[
-        'redis>=2.9.1',
+        'redis>=3.3',
         'nose>=1.3.3',
         'colorlog>=2.2.0',
-        'futures>=3.0.3'
     ],
 )
@@ -0,0 +1,39 @@
+import time
+import unittest
+
+try:
+    import fakeredis
+except ImportError:
+    raise unittest.SkipTest("fakeredis is required to run these tests")
+
+import majorityredis
+
+
+class SlowRedis(fakeredis.FakeStrictRedis):
+    """A client whose scripts take `delay` seconds to respond"""
+    delay = 0
+
+    def evalsha(self, *args):
+        time.sleep(self.delay)
+        return super(SlowRedis, self).evalsha(*args)
+
+
+def _mr(n_servers=3):
+    servers = [fakeredis.FakeServer() for _ in range(n_servers)]
+    clients = [SlowRedis(server=s) for s in servers]
+    return majorityredis.MajorityRedis(
+        clients, n_servers, lock_timeout=5, polling_interval=1,
+        threadsafe=True)
+
+
+def test_lock_returns_false_when_wait_for_expires_on_slow_servers():
+    mr = _mr()
+    assert mr.Lock().lock('p', extend_lock=False)
+    for cli in mr._clients[1:]:
+        cli.delay = .25
+    # the first attempt waits on the slow servers twice, to lock and then
+    # to unlock, so the deadline runs out while reading the ttl of the lock
+    t = time.time()
+    assert mr.Lock().lock(
+        'p', wait_for=5, extend_lock=False, timeout=.6) is False
+    assert time.time() - t < 1.5
@@ -0,0 +1,38 @@
+import unittest
+
+try:
+    import fakeredis
+except ImportError:
+    raise unittest.SkipTest("fakeredis is required to run these tests")
+
+import majorityredis
+from majorityredis.lockingqueue import gc_completed
+
+
+def _mr(n_servers=3):
+    servers = [fakeredis.FakeServer() for _ in range(n_servers)]
+    clients = [fakeredis.FakeStrictRedis(server=s) for s in servers]
+    return majorityredis.MajorityRedis(
+        clients, n_servers, lock_timeout=5, polling_interval=1)
+
+
+def _consume(q, item):
+    q.put(item)
+    _, h_k = q.get(extend_lock=False)
+    q.consume(h_k)
+    return h_k
+
+
+def test_gc_completed_keeps_the_ttl_of_each_queue():
+    mr = _mr()
+    h_k1 = _consume(mr.LockingQueue('q1', completed_ttl=100), 'a')
+    h_k2 = _consume(mr.LockingQueue('q2', completed_ttl=1000), 'b')
+    h_k3 = _consume(mr.LockingQueue('q3'), 'c')
+    for cli in mr._clients:
+        cli.set('app:key:1', 'completed')
+    assert gc_completed(mr, 10) == 3
+    for cli in mr._clients:
+        assert 90 < cli.ttl(h_k1) <= 100
+        assert 990 < cli.ttl(h_k2) <= 1000
+        assert 0 < cli.ttl(h_k3) <= 10
+        assert cli.ttl('app:key:1') == -1
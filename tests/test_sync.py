@@ -0,0 +1,56 @@
+import unittest
+from unittest import mock
+
+try:
+    import fakeredis
+except ImportError:
+    raise unittest.SkipTest("fakeredis is required to run these tests")
+
+import majorityredis
+from majorityredis import sync
+
+
+def _mr(n_servers=3):
+    servers = [fakeredis.FakeServer() for _ in range(n_servers)]
+    clients = [fakeredis.FakeStrictRedis(server=s) for s in servers]
+    return majorityredis.MajorityRedis(
+        clients, n_servers, lock_timeout=5, polling_interval=1)
+
+
+def _removed_after_scan(key):
+    """Wrap sync._zscan so the first member of each batch is removed from
+    `key` on every server after it was scanned, but before it is read"""
+    zscan = sync._zscan
+
+    def _zscan(sources, zkey, batch_size):
+        for batch in zscan(sources, zkey, batch_size):
+            if zkey == key:
+                for cli in sources:
+                    cli.zrem(zkey, batch[0])
+            yield batch
+    return _zscan
+
+
+def test_sync_queue_skips_members_removed_after_scan():
+    mr = _mr()
+    q = mr.LockingQueue('q')
+    q.put('a')
+    q.put('b')
+    sources, target = mr._clients[:2], mr._clients[2]
+    target.flushall()
+    with mock.patch.object(sync, '_zscan', _removed_after_scan('q')):
+        sync.sync_queue(mr, sources, target, 'q', 500, sync.Throttle())
+    assert target.zcard('q') == 1
+
+
+def test_sync_zset_skips_members_removed_after_scan():
+    mr = _mr()
+    q = mr.LockingQueue('q')
+    q.put('a', delay=60)
+    q.put('b', delay=60)
+    sources, target = mr._clients[:2], mr._clients[2]
+    target.flushall()
+    with mock.patch.object(
+            sync, '_zscan', _removed_after_scan('.q.delayed')):
+        sync.sync_queue(mr, sources, target, 'q', 500, sync.Throttle())
+    assert target.zcard('.q.delayed') == 1